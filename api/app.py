@@ -9,6 +9,7 @@ from flask import Flask, jsonify, send_file, request, after_this_request
 from flask_caching import Cache
 
 from glob import glob
+from time import time
 from datetime import datetime
 import os
 import traceback
@@ -17,8 +18,6 @@ import numpy as np
 from ast import literal_eval
 from csv import DictWriter
 
-from subprocess import Popen
-
 import fiona
 import rasterio
 from rasterio.mask import raster_geometry_mask
@@ -26,6 +25,7 @@ from rasterio.mask import raster_geometry_mask
 from all_your_base import SCRATCH, RANGESAT_DIRS, isfloat
 
 from database import Location
+from database.pasturestats_db import read_cache_stamp
 from database.pasturestats import (
     query_scenes_coverage,
     query_pasture_stats,
@@ -57,7 +57,8 @@ from database.scenemeta import (
     scenemeta_location_intrayear
 )
 
-from biomass.landsat import LandSatScene
+from biomass.landsat import LandSatScene, is_multi_window
+from biomass.reproject import reproject_raster
 from biomass.raster_processing import (
     make_raster_difference,
     make_aggregated_rasters,
@@ -72,6 +73,46 @@ _thisdir = os.path.dirname(__file__)
 STATIC_DIR = _join(_thisdir, 'static')
 
 
+# the ingest touches <out_dir>/.api_cache_stamp after it writes a scene
+# (see database.pasturestats_db.touch_cache_stamp). Every api process checks
+# the stamps at most every _cache_check_interval seconds and clears its
+# cache when one of them changed
+_cache_check_interval = 10.0
+_cache_checked = 0.0
+_cache_stamps = None
+_location_out_dirs = {}
+
+
+def _out_dirs():
+    for rangesat_dir in RANGESAT_DIRS:
+        for loc_path in glob('{}/*'.format(rangesat_dir)):
+            if not isdir(loc_path):
+                continue
+
+            if loc_path not in _location_out_dirs:
+                try:
+                    _location_out_dirs[loc_path] = Location(loc_path).out_dir
+                except Exception:
+                    _location_out_dirs[loc_path] = None
+
+    return [out_dir for out_dir in _location_out_dirs.values() if out_dir is not None]
+
+
+@app.before_request
+def invalidate_cache():
+    global _cache_checked, _cache_stamps
+
+    now = time()
+    if now - _cache_checked < _cache_check_interval:
+        return
+    _cache_checked = now
+
+    stamps = {out_dir: read_cache_stamp(out_dir) for out_dir in _out_dirs()}
+    if _cache_stamps is not None and stamps != _cache_stamps:
+        cache.clear()
+    _cache_stamps = stamps
+
+
 def exception_factory(msg='Error Handling Request',
                       stacktrace=None):
     if stacktrace is None:
@@ -341,25 +382,22 @@ def dump_measure(ls_dir, product, scale=None):
 
 
 def reproject_raster_to_wgs(src, scale=None):
-    dst = src[:-4] + '.wgs.vrt'
-    dst2 = src[:-4] + '.wgs.tif'
+    reproject_raster(src, scale=scale)
 
-    if exists(dst):
-        os.remove(dst)
-    if exists(dst2):
-        os.remove(dst2)
 
-    cmd = ['gdalwarp', '-t_srs', 'EPSG:4326', '-of', 'vrt', src, dst]
-    p = Popen(cmd)
-    p.wait()
+def dump_window_band(ls_dir, product):
+    """
+    the bands of a scene clipped to windows are only stored per window.
+    Writes its pixel_qa or aerosol band as a sparse GeoTIFF of the full
+    grid (and the WGS84 copy) so it is served like the band of a scene
+    """
+    dst_fn = _join(ls_dir, f'{product}.tif')
+    if not is_multi_window(ls_dir) or exists(dst_fn):
+        return
 
-    cmd = ['gdal_translate', '-co', 'COMPRESS=LZW', '-of', 'GTiff']
-    if scale is not None:
-        cmd += ['-ot', 'Int16', '-scale'] + [str(v) for v in scale]
-    cmd += [dst, dst2]
-    p = Popen(cmd)
-    p.wait()
-    assert exists(dst)
+    with LandSatScene(ls_dir) as ls:
+        ls.dump_band(ls.default_key if product == 'pixel_qa' else ls.aerosol_key, dst_fn)
+    reproject_raster_to_wgs(dst_fn)
 
 
 @app.route('/raster/<location>/<product_id>/<product>')
@@ -378,6 +416,9 @@ def raster(location, product_id, product):
                 _location = Location(loc_path)
                 out_dir = _location.out_dir
 
+                if product in ['pixel_qa', 'aerosol']:
+                    dump_window_band(_join(out_dir, product_id), product)
+
                 fn = []
                 if not utm:
                     if product in ['ndvi', 'pixel_qa', 'rgb', 'aerosol']:
@@ -529,35 +570,7 @@ def max_seasonal_pasture_rasterprocessing(location):
                 dst_fn = file_path.replace('.tif', '.wrs.tif')
 
                 if not utm:
-                    try:
-                        dst_vrt_fn = dst_fn.replace('.tif', '.vrt')
-
-                        if exists(dst_vrt_fn):
-                            os.remove(dst_vrt_fn)
-
-                        cmd = ['gdalwarp', '-t_srs', 'EPSG:4326', '-of', 'vrt', utm_dst_fn, dst_vrt_fn]
-                        p = Popen(cmd)
-                        p.wait()
-
-                        assert exists(dst_vrt_fn)
-                    except:
-                        if exists(dst_vrt_fn):
-                            os.remove(dst_vrt_fn)
-                        raise
-
-                    try:
-                        if exists(dst_fn):
-                            os.remove(dst_fn)
-
-                        cmd = ['gdal_translate', '-co', 'COMPRESS=LZW', '-of', 'GTiff', dst_vrt_fn, dst_fn]
-                        p = Popen(cmd)
-                        p.wait()
-
-                        assert exists(dst_fn)
-                    except:
-                        if exists(dst_fn):
-                            os.remove(dst_fn)
-                        raise
+                    reproject_raster(utm_dst_fn, dst_fn)
 
                 @after_this_request
                 def remove_file(response):
@@ -566,8 +579,6 @@ def max_seasonal_pasture_rasterprocessing(location):
                             os.remove(utm_dst_fn)
                         if exists(dst_fn):
                             os.remove(dst_fn)
-                        if exists(dst_vrt_fn):
-                            os.remove(dst_vrt_fn)
                     except Exception as error:
                         app.logger.error("Error removing or closing downloaded file handle", error)
                     return response
@@ -612,6 +623,9 @@ def intrayear_rasterprocessing(location, product):
                 fns = []
                 for product_id in product_ids:
 
+                    if product in ['pixel_qa', 'aerosol']:
+                        dump_window_band(_join(out_dir, product_id), product)
+
                     fn = None
                     if not utm:
                         if product in ['ndvi', 'nbr', 'nbr2', 'pixel_qa', 'rgb', 'aerosol']:
@@ -699,6 +713,9 @@ def interyear_rasterprocessing(location, product):
                 fns = []
                 for product_id in product_ids:
 
+                    if product in ['pixel_qa', 'aerosol']:
+                        dump_window_band(_join(out_dir, product_id), product)
+
                     fn = None
                     if not utm:
                         if product in ['ndvi', 'nbr', 'nbr2', 'pixel_qa', 'rgb', 'aerosol']:
@@ -2231,6 +2248,9 @@ def intrayear_histogram(location, ranch, pasture=None):
                 total_px = 0
                 for product_id in product_ids:
 
+                    if product == 'pixel_qa':
+                        dump_window_band(_join(out_dir, product_id), product)
+
                     if product in ['ndvi', 'nbr', 'nbr2', 'pixel_qa']:
                         fn = glob(_join(out_dir, product_id, '*{}.tif'.format(product)))
 
@@ -2296,6 +2316,9 @@ def interyear_histogram(location, ranch, pasture=None):
                 total_px = 0
                 for product_id in product_ids:
 
+                    if product == 'pixel_qa':
+                        dump_window_band(_join(out_dir, product_id), product)
+
                     if product in ['ndvi', 'nbr', 'nbr2', 'pixel_qa']:
                         fn = glob(_join(out_dir, product_id, '*{}.tif'.format(product)))
 
@@ -0,0 +1,338 @@
+"""
+Calibration search for the biomass models.
+
+Evaluates every combination of summer index, fall index, discriminate
+index and discriminate threshold (and the linear and log transformed
+forms of the model) against a table of field plots with measured biomass
+and per-plot index values (e.g. from scripts/extract_plots.py).
+
+For a fixed discriminate index and threshold the summer and fall
+regressions are fit to disjoint sets of plots, so their errors add. The
+simple regressions are solved in closed form for all (discriminate,
+threshold) masks and indices at once with matrix products and the errors
+of every (summer, fall) pair are combined by broadcasting. Candidates are
+ranked by k-fold cross-validated RMSE in biomass units (g/m^2) using the
+same clipping and back transform as BiomassModel.
+"""
+
+import csv
+import numpy as np
+
+
+_default_indices = ('ndvi', 'nbr', 'nbr2', 'evi', 'tcg', 'tcw', 'savi',
+                    'msavi', 'ndmi', 'rdvi', 'mtvii', 'psri', 'ci', 'nci',
+                    'ndci', 'satvi', 'sf', 'ndii7', 'ndwi', 'sti')
+
+
+def _tofloat(x):
+    try:
+        return float(x)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+def load_plot_table(fn):
+    """
+    loads a plot table as a list of dicts. Accepts csv files (e.g.
+    compiled.csv) or parquet files/datasets (requires pandas)
+    """
+    if fn.endswith('.csv'):
+        with open(fn) as fp:
+            return list(csv.DictReader(fp))
+
+    import pandas as pd
+    return pd.read_parquet(fn).to_dict('records')
+
+
+def _table_to_arrays(rows, biomass_field, indices):
+    """
+    returns y (n,) and X (n, K). Plots missing the biomass or any of the
+    indices are dropped so every candidate is scored on the same plots
+    """
+    y = np.array([_tofloat(row.get(biomass_field)) for row in rows])
+    X = np.array([[_tofloat(row.get(indexname)) for indexname in indices] for row in rows])
+    X = X.reshape(len(rows), len(indices))
+
+    valid = np.isfinite(y) & np.all(np.isfinite(X), axis=1)
+    return y[valid], X[valid]
+
+
+def _fit(W, X, y):
+    """
+    closed form simple least squares of y on each column of X for each
+    row of weights W (M, n). Returns intercepts and slopes (M, K), nan
+    where the fit is undetermined
+    """
+    n = W.sum(axis=1)[:, None]
+    Sx = W @ X
+    Sy = (W @ y)[:, None]
+    Sxx = W @ (X * X)
+    Sxy = W @ (X * y[:, None])
+
+    den = n * Sxx - Sx * Sx
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slp = (n * Sxy - Sx * Sy) / den
+        intercept = (Sy - slp * Sx) / n
+
+    invalid = (n < 3) | (np.abs(den) <= 1e-12 * np.maximum(n * Sxx, 1e-12))
+    slp[np.broadcast_to(invalid, slp.shape)] = np.nan
+    intercept[np.broadcast_to(invalid, intercept.shape)] = np.nan
+    return intercept, slp
+
+
+def _predict(intercept, slp, x, log_transformed_estimate):
+    """
+    mirrors the summer_vi/fall_vi calculation in BiomassModel
+    """
+    est = intercept + slp * x
+    clip = np.logical_not((slp < 0) & (intercept == 0))
+    est = np.where(clip & (est < 0), 0.0, est)
+    if log_transformed_estimate:
+        with np.errstate(over='ignore'):
+            est = np.exp(est)
+    return est
+
+
+def _thresholds(x, n_thresholds):
+    q = np.linspace(0.0, 1.0, n_thresholds + 2)[1:-1]
+    thresholds = np.unique(np.round(np.quantile(x, q), 6))
+
+    # LandSatScene.threshold only accepts thresholds in [-1, 1]
+    return thresholds[(thresholds >= -1.0) & (thresholds <= 1.0)]
+
+
+def _discriminated_errors(y, X, masks, folds, log_transformed_estimate):
+    """
+    cross-validated squared error (M, K, K) for every (mask, summer, fall)
+    """
+    yt = np.log(y) if log_transformed_estimate else y
+    M, K = masks.shape[0], X.shape[1]
+
+    sse = np.zeros((M, K, K))
+    for k in np.unique(folds):
+        train = folds != k
+        test = folds == k
+
+        Wtr, Wte = masks[:, train], masks[:, test]
+        Xte, yte = X[test], y[test]
+
+        s_int, s_slp = _fit(Wtr, X[train], yt[train])
+        f_int, f_slp = _fit(1.0 - Wtr, X[train], yt[train])
+
+        # (M, K, n_test)
+        s_est = _predict(s_int[:, :, None], s_slp[:, :, None], Xte.T[None, :, :], log_transformed_estimate)
+        f_est = _predict(f_int[:, :, None], f_slp[:, :, None], Xte.T[None, :, :], log_transformed_estimate)
+
+        with np.errstate(over='ignore', invalid='ignore'):
+            s_err = np.einsum('mi,mki->mk', Wte, (s_est - yte) ** 2)
+            f_err = np.einsum('mi,mki->mk', 1.0 - Wte, (f_est - yte) ** 2)
+
+        sse += s_err[:, :, None] + f_err[:, None, :]
+
+    return sse
+
+
+def _pair_fit(X, y):
+    """
+    least squares of y = a + b * X[:, s] + c * X[:, f] for every (s, f)
+    pair. Returns a, b, c (K, K)
+    """
+    n = float(len(y))
+    S = X.sum(axis=0)
+    XX = X.T @ X
+    Xy = X.T @ y
+    K = X.shape[1]
+
+    G = np.empty((K, K, 3, 3))
+    G[:, :, 0, 0] = n
+    G[:, :, 0, 1] = G[:, :, 1, 0] = S[:, None]
+    G[:, :, 0, 2] = G[:, :, 2, 0] = S[None, :]
+    G[:, :, 1, 1] = np.diag(XX)[:, None]
+    G[:, :, 2, 2] = np.diag(XX)[None, :]
+    G[:, :, 1, 2] = G[:, :, 2, 1] = XX
+
+    rhs = np.empty((K, K, 3))
+    rhs[:, :, 0] = y.sum()
+    rhs[:, :, 1] = Xy[:, None]
+    rhs[:, :, 2] = Xy[None, :]
+
+    coef = np.einsum('skij,skj->ski', np.linalg.pinv(G), rhs)
+    a, b, c = coef[:, :, 0], coef[:, :, 1], coef[:, :, 2]
+
+    # the same index as summer and fall is not identifiable
+    a[np.diag_indices(K)] = np.nan
+    return a, b, c
+
+
+def _undiscriminated_errors(y, X, folds):
+    """
+    cross-validated squared error (K, K) of the linear model without a
+    discriminate index (biomass = summer_vi + fall_vi)
+    """
+    K = X.shape[1]
+    sse = np.zeros((K, K))
+    for k in np.unique(folds):
+        train = folds != k
+        test = folds == k
+
+        a, b, c = _pair_fit(X[train], y[train])
+        Xte = X[test]
+
+        s_est = _predict(a[:, :, None], b[:, :, None], Xte.T[:, None, :], False)
+        f_est = _predict(np.zeros_like(c)[:, :, None], c[:, :, None], Xte.T[None, :, :], False)
+        sse += np.sum((s_est + f_est - y[test]) ** 2, axis=2)
+
+    return sse
+
+
+def search(rows, biomass_field, indices=None, discriminate_indices=None, n_thresholds=19,
+           log_transformed=(False, True), folds=5, n_best=10, seed=0, verbose=True):
+    """
+    Scores every model combination and returns the n_best candidates
+    ranked by cross-validated RMSE as a list of dicts with the
+    satellite_pars fields, cv_rmse and n. The coefficients of the
+    candidates are refit on all of the plots.
+
+    :param rows: list of dicts (plot table)
+    :param biomass_field: field with the measured biomass (g/m^2)
+    :param indices: summer/fall index candidates
+    :param discriminate_indices: discriminate index candidates, includes
+                                 'none' for the undiscriminated model
+    :param n_thresholds: number of quantiles of the discriminate index
+                         to use as thresholds
+    :param log_transformed: forms of the model to evaluate
+    :param folds: number of cross-validation folds
+    """
+    if indices is None:
+        indices = [indexname for indexname in _default_indices if indexname in rows[0]]
+    indices = list(indices)
+
+    if discriminate_indices is None:
+        discriminate_indices = indices + ['none']
+    discriminate_indices = list(discriminate_indices)
+
+    for indexname in discriminate_indices:
+        if indexname != 'none':
+            assert indexname in indices, indexname
+
+    y, X = _table_to_arrays(rows, biomass_field, indices)
+    n = len(y)
+    assert n >= 2 * folds, 'not enough plots (%i) for %i folds' % (n, folds)
+
+    rng = np.random.RandomState(seed)
+    fold_ids = rng.permutation(np.arange(n) % folds)
+
+    # one mask (summer = 1) per (discriminate index, threshold)
+    mask_defs = []
+    masks = []
+    for indexname in discriminate_indices:
+        if indexname == 'none':
+            continue
+        d = X[:, indices.index(indexname)]
+        for threshold in _thresholds(d, n_thresholds):
+            mask_defs.append((indexname, float(threshold)))
+            masks.append(d > threshold)
+    masks = np.array(masks, dtype=np.float64).reshape(len(masks), n)
+
+    candidates = []
+    for log_transformed_estimate in log_transformed:
+        n_scored = 0
+        _y = y
+        _X, _masks, _folds = X, masks, fold_ids
+        if log_transformed_estimate:
+            # log transformed models can't be fit to zero biomass plots
+            keep = y > 0
+            _y, _X, _masks, _folds = y[keep], X[keep], masks[:, keep], fold_ids[keep]
+
+        if len(mask_defs) > 0:
+            sse = _discriminated_errors(_y, _X, _masks, _folds, log_transformed_estimate)
+            cv_rmse = np.sqrt(sse / len(_y))
+            cv_rmse[~np.isfinite(cv_rmse)] = np.inf
+
+            yt = np.log(_y) if log_transformed_estimate else _y
+            s_int, s_slp = _fit(_masks, _X, yt)
+            f_int, f_slp = _fit(1.0 - _masks, _X, yt)
+
+            n_scored += cv_rmse.size
+            flat = cv_rmse.ravel()
+            best = np.argsort(flat)[:n_best]
+            for i in best:
+                if not np.isfinite(flat[i]):
+                    continue
+                m, s, f = np.unravel_index(i, cv_rmse.shape)
+                discriminate_index, discriminate_threshold = mask_defs[m]
+                candidates.append(dict(discriminate_index=discriminate_index,
+                                       discriminate_threshold=discriminate_threshold,
+                                       summer_index=indices[s],
+                                       summer_int=float(s_int[m, s]),
+                                       summer_slp=float(s_slp[m, s]),
+                                       fall_index=indices[f],
+                                       fall_int=float(f_int[m, f]),
+                                       fall_slp=float(f_slp[m, f]),
+                                       log_transformed_estimate=log_transformed_estimate,
+                                       cv_rmse=float(flat[i]),
+                                       n=len(_y)))
+
+        if 'none' in discriminate_indices and not log_transformed_estimate:
+            sse = _undiscriminated_errors(_y, _X, _folds)
+            cv_rmse = np.sqrt(sse / len(_y))
+            cv_rmse[~np.isfinite(cv_rmse)] = np.inf
+
+            a, b, c = _pair_fit(_X, _y)
+
+            n_scored += cv_rmse.size
+            flat = cv_rmse.ravel()
+            best = np.argsort(flat)[:n_best]
+            for i in best:
+                if not np.isfinite(flat[i]):
+                    continue
+                s, f = np.unravel_index(i, cv_rmse.shape)
+                candidates.append(dict(discriminate_index='None',
+                                       discriminate_threshold=0.0,
+                                       summer_index=indices[s],
+                                       summer_int=float(a[s, f]),
+                                       summer_slp=float(b[s, f]),
+                                       fall_index=indices[f],
+                                       fall_int=0.0,
+                                       fall_slp=float(c[s, f]),
+                                       log_transformed_estimate=False,
+                                       cv_rmse=float(flat[i]),
+                                       n=len(_y)))
+
+        if verbose:
+            print('log_transformed_estimate={}: scored {} candidates'
+                  .format(log_transformed_estimate, n_scored))
+
+    candidates.sort(key=lambda c: c['cv_rmse'])
+    return candidates[:n_best]
+
+
+def to_satellite_pars(candidate, satellites=(9, 8, 7, 5), required_coverage=0.5, minimum_area_ha=1.8):
+    """
+    returns the satellite_pars list for a candidate in the format of the
+    models section of the site configs
+    """
+    keys = ('discriminate_threshold', 'discriminate_index', 'summer_int', 'summer_slp',
+            'summer_index', 'fall_int', 'fall_slp', 'fall_index')
+
+    satellite_pars = []
+    for satellite in satellites:
+        pars = dict(satellite=int(satellite))
+        pars.update({key: candidate[key] for key in keys})
+        pars['required_coverage'] = required_coverage
+        pars['minimum_area_ha'] = minimum_area_ha
+        pars['log_transformed_estimate'] = candidate['log_transformed_estimate']
+        satellite_pars.append(pars)
+
+    return satellite_pars
+
+
+def to_models(candidates, name='Herbaceous', **kwargs):
+    """
+    returns a models section (list of dicts) with one model per candidate
+    """
+    models = []
+    for i, candidate in enumerate(candidates):
+        _name = name if i == 0 else '%s_%i' % (name, i + 1)
+        models.append(dict(name=_name, satellite_pars=to_satellite_pars(candidate, **kwargs)))
+    return models
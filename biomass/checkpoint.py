@@ -0,0 +1,108 @@
+"""
+Stage checkpoints for scene processing.
+
+The outputs of every stage are written atomically (to a temporary file
+that is renamed into place) so an interrupted stage never leaves a partial
+file behind. When a stage completes it is recorded with the hash of its
+inputs in <out_dir>/.checkpoints/<archive>.json. A rerun skips the stages
+whose input hash is unchanged and whose outputs still exist, so a scene
+that failed in its last stage only repeats that stage.
+"""
+
+import os
+import json
+import socket
+import hashlib
+import threading
+from time import time
+from contextlib import contextmanager
+
+from os.path import join as _join
+from os.path import exists as _exists
+from os.path import split as _split
+
+
+def _tmp_fn(dst_fn):
+    # unique per host, process and thread (hosts of a lease queue share the
+    # out_dir). Ends with .tmp so the scene directory globs for *.tif skip it
+    return '%s.%s.%i.%i.tmp' % (dst_fn, socket.gethostname(), os.getpid(), threading.get_ident())
+
+
+@contextmanager
+def atomic_output(dst_fn):
+    """
+    yields a temporary path to write dst_fn to. The temporary file is
+    renamed to dst_fn if the block completes and removed if it raises
+    """
+    tmp_fn = _tmp_fn(dst_fn)
+    try:
+        yield tmp_fn
+        os.replace(tmp_fn, dst_fn)
+    finally:
+        if _exists(tmp_fn):
+            os.remove(tmp_fn)
+
+
+def file_identity(fn):
+    """
+    cheap identity of an input file (name, size and modification time)
+    """
+    st = os.stat(fn)
+    return _split(fn)[-1], st.st_size, st.st_mtime_ns
+
+
+def input_hash(*inputs):
+    """
+    sha1 of the json representation of the inputs of a stage
+    """
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class StageCheckpoints(object):
+    """
+    completed stages of a scene. Threads of a pipeline update different
+    stages of the same scene so updates are serialized with a lock
+    """
+    def __init__(self, fn):
+        self.fn = fn
+        self._lock = threading.Lock()
+
+        stages = {}
+        if _exists(fn):
+            try:
+                with open(fn) as fp:
+                    stages = json.load(fp)
+            except ValueError:
+                stages = {}
+        self.stages = stages
+
+    @staticmethod
+    def for_archive(out_dir, archive):
+        return StageCheckpoints(_join(out_dir, '.checkpoints', '%s.json' % archive))
+
+    def is_done(self, stage, _input_hash):
+        """
+        True if stage completed with the same input hash and its outputs
+        still exist
+        """
+        d = self.stages.get(stage)
+        if d is None or d['input_hash'] != _input_hash:
+            return False
+
+        return all(_exists(fn) for fn in d['outputs'])
+
+    def mark_done(self, stage, _input_hash, outputs=(), **info):
+        """
+        records a completed stage. info is stored with the stage (e.g. the
+        product_id of the clip)
+        """
+        with self._lock:
+            self.stages[stage] = dict(info, input_hash=_input_hash, outputs=list(outputs), finished=time())
+            self._dump()
+
+    def _dump(self):
+        head = _split(self.fn)[0]
+        os.makedirs(head, exist_ok=True)
+        with atomic_output(self.fn) as tmp_fn:
+            with open(tmp_fn, 'w') as fp:
+                json.dump(self.stages, fp, indent=2)
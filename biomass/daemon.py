@@ -0,0 +1,230 @@
+"""
+Long-running ingest of the scene archives that appear in watched
+directories.
+
+Downloading a scene used to be followed by running process_scenes.py,
+build_sqlite_db.py and build_scenemeta_coverage_db.py by hand. The
+IngestDaemon polls the scene directories and takes every new archive
+through the steps on its own:
+
+    settle     the size and mtime of the archive did not change between
+               two polls and it is older than settle seconds (downloads
+               that are still being written are left alone)
+    validate   the archive is streamed once (biomass.validation) and the
+               result is recorded in the manifest. Invalid archives are
+               not processed
+    process    ScenePipeline: extract, clip, model, write. The pasture
+               stats and scene coverage are upserted into the location
+               databases and the api cache stamp is touched
+
+Ready archives are processed newest acquisition first in batches of
+batch_size, the directories are polled again between batches, so a scene
+downloaded during a long backfill waits for at most one batch.
+
+The queue depth and the latency of the recent scenes (seconds from the
+archive being discovered to its outputs being written) are written to
+<out_dir>/ingest_status.json after every poll and batch.
+"""
+
+import os
+import json
+import threading
+from time import time
+
+from os.path import join as _join
+
+from biomass.ingest import find_scenes, scene_members
+from biomass.mosaic import group_same_date, same_date_key
+from biomass.pipeline import ScenePipeline
+from biomass.validation import validate_archive
+from biomass.checkpoint import atomic_output
+from database.manifest import archive_name, INVALID
+
+
+def newest_first(scn_fns):
+    """
+    sorts scenes (archives or same-date groups) by acquisition date,
+    newest first
+    """
+    def _key(scn_fn):
+        fn = scene_members(scn_fn)[0]
+        return same_date_key(fn)[1], archive_name(fn)
+    return sorted(scn_fns, key=_key, reverse=True)
+
+
+class IngestDaemon(object):
+    """
+    :param cfg: SiteConfig
+    :param manifest: ProcessingManifest of cfg.out_dir
+    :param scene_dirs: directories polled for archives
+    :param poll_interval: seconds between polls when there is nothing to do
+    :param settle: seconds an archive must be unmodified before it is ingested
+    :param batch_size: scenes processed between polls
+    :param validate: validate archives before they are processed
+    :param retry_failed: process scenes that failed again
+    :param pipeline_kwargs: workers and queue sizes of the ScenePipeline
+    :param recent: number of recent results kept in the status
+    """
+    def __init__(self, cfg, manifest, scene_dirs, poll_interval=60, settle=120, batch_size=4,
+                 validate=True, retry_failed=False, pipeline_kwargs=None, recent=50):
+        self.cfg = cfg
+        self.manifest = manifest
+        self.scene_dirs = scene_dirs
+        self.poll_interval = poll_interval
+        self.settle = settle
+        self.batch_size = batch_size
+        self.validate = validate
+        self.retry_failed = retry_failed
+        self.status_fn = _join(cfg.out_dir, 'ingest_status.json')
+        self.recent = recent
+
+        if pipeline_kwargs is None:
+            pipeline_kwargs = {}
+        self.pipeline = ScenePipeline(cfg, manifest, retry_failed=retry_failed, **pipeline_kwargs)
+
+        self._stop = threading.Event()
+        self._seen = {}        # archive -> (size, mtime) at the last poll
+        self._discovered = {}  # archive -> time it was first seen
+        self._queue = []       # scenes ready to be processed, newest first
+        self._settling = 0
+        self._in_flight = 0
+        self._results = []
+        self._counts = {}
+        self._t0 = time()
+
+    def stop(self):
+        """
+        stops the daemon once the current batch is finished
+        """
+        self._stop.set()
+
+    def poll(self):
+        """
+        scans the scene directories and returns the archives that are ready
+        """
+        now = time()
+        fns = []
+        for scene_dir in self.scene_dirs:
+            fns.extend(find_scenes(scene_dir))
+
+        ready = []
+        settling = 0
+        seen = {}
+        for fn in fns:
+            try:
+                st = os.stat(fn)
+            except OSError:
+                continue
+
+            seen[fn] = (st.st_size, st.st_mtime)
+            if fn not in self._discovered:
+                self._discovered[fn] = now
+
+            if self._seen.get(fn) == seen[fn] and now - st.st_mtime >= self.settle:
+                ready.append(fn)
+            else:
+                settling += 1
+
+        self._seen = seen
+        self._settling = settling
+
+        self.manifest.register(ready)
+        return self.manifest.unprocessed(ready, retry_failed=self.retry_failed)
+
+    def validate_scenes(self, fns):
+        """
+        validates the archives that have not been validated since they were
+        last modified and returns the ones that are valid
+        """
+        validated = self.manifest.validated()
+
+        valid = []
+        for fn in fns:
+            if validated.get(archive_name(fn), 0.0) <= self._seen[fn][1]:
+                res = validate_archive(fn)
+                print('validated {}\t{}\t{:.1f}s\t{}'.format(fn, res['valid'], res['elapsed'], res['error'] or ''))
+                state = self.manifest.record_validation(fn, res['valid'], checksum=res['md5'], error=res['error'])
+                if state == INVALID:
+                    self._count('invalid')
+                    continue
+            valid.append(fn)
+
+        return valid
+
+    def _count(self, status):
+        self._counts[status] = self._counts.get(status, 0) + 1
+
+    def _record(self, res):
+        latency = time() - min(self._discovered.get(fn, time()) for fn in scene_members(res['scn_fn']))
+        self._count(res['status'])
+        self._results.append(dict(scn_fn=res['scn_fn'], status=res['status'], product_id=res.get('product_id'),
+                                  elapsed=res['elapsed'], latency=latency, finished=time()))
+        self._results = self._results[-self.recent:]
+
+        print('{}\t{}\t{:.1f}s\tlatency {:.1f}s'.format(res['scn_fn'], res['status'], res['elapsed'], latency))
+        if res['status'] == 'failed':
+            print(res['error'])
+
+        for fn in scene_members(res['scn_fn']):
+            self._discovered.pop(fn, None)
+
+    def status(self):
+        """
+        dict with the queue depth, counts and latencies of the recent scenes
+        """
+        latencies = sorted(r['latency'] for r in self._results if r['status'] == 'processed')
+        if len(latencies) > 0:
+            latency = dict(mean=sum(latencies) / len(latencies), max=latencies[-1],
+                           median=latencies[len(latencies) // 2])
+        else:
+            latency = None
+
+        return dict(updated=time(), uptime=time() - self._t0, queue_depth=len(self._queue) + self._in_flight,
+                    queued=len(self._queue), in_flight=self._in_flight, settling=self._settling,
+                    counts=self._counts, latency=latency, recent=self._results[::-1])
+
+    def write_status(self):
+        with atomic_output(self.status_fn) as tmp_fn:
+            with open(tmp_fn, 'w') as fp:
+                json.dump(self.status(), fp, indent=2)
+
+    def run_once(self):
+        """
+        polls the directories and processes a batch of the newest scenes
+
+        :return: number of scenes processed
+        """
+        fns = self.poll()
+        if self.validate:
+            fns = self.validate_scenes(fns)
+
+        if self.cfg.mosaic_same_date:
+            fns = group_same_date(fns, self.cfg.bbox)
+
+        self._queue = newest_first(fns)
+        batch = self._queue[:self.batch_size]
+        self._queue = self._queue[self.batch_size:]
+        self._in_flight = len(batch)
+        self.write_status()
+
+        if len(batch) == 0:
+            return 0
+
+        for res in self.pipeline.run(batch):
+            self._in_flight -= 1
+            self._record(res)
+            self.write_status()
+
+        return len(batch)
+
+    def run(self):
+        """
+        ingests scenes until stop is called
+        """
+        print('watching %s' % ', '.join(self.scene_dirs))
+        while not self._stop.is_set():
+            if self.run_once() == 0:
+                self._stop.wait(self.poll_interval)
+
+        self._queue = []
+        self.write_status()
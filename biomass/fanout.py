@@ -0,0 +1,166 @@
+"""
+Processing a scene archive for several sites in one pass.
+
+Sites like Zumwalt2 - Zumwalt5 are covered by the same archives. Instead
+of extracting and decoding an archive once per site config, the archive
+is extracted to SCRATCH once and opened once, and every site that needs
+it is clipped from the same open datasets (windows that overlap between
+sites are served from the GDAL block cache). The full-scene rgb is
+rendered once and copied to the sites. The models and pasture analysis
+then run per site and each site's outputs, database rows and manifest are
+written as with process_scene.
+
+Same-date mosaics are not fanned out; sites with mosaic_same_date are
+processed with process_scenes.py.
+"""
+
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from time import time
+
+from os.path import join as _join
+
+from biomass.landsat import LandSatScene
+from biomass.ingest import SiteConfig, ScenePool, screen_scene, clip_extracted, extract, model_scene, \
+    write_scene, record_result
+from database.manifest import open_manifest, PROCESSING
+
+
+def _fail(ctx, cfg, manifest, error):
+    ctx['status'] = 'failed'
+    manifest.mark_failed(ctx['scn_fn'], error=error)
+    return dict(scn_fn=ctx['scn_fn'], cfg_fn=cfg.cfg_fn, status='failed', error=error)
+
+
+def fan_out_scene(scn_fn, sites, retry_failed=True):
+    """
+    processes an archive for every site that needs it
+
+    :param sites: list of (SiteConfig, ProcessingManifest)
+    :return: list of result dicts (scn_fn, cfg_fn, status, ...), one per site
+    """
+    t0 = time()
+    results = []
+    pending = []
+
+    for cfg, manifest in sites:
+        if not manifest.claim(scn_fn, config_hash=cfg.config_hash, retry_failed=retry_failed):
+            results.append(dict(scn_fn=scn_fn, cfg_fn=cfg.cfg_fn, status='claimed'))
+            continue
+
+        try:
+            ctx = screen_scene(scn_fn, cfg)
+        except Exception:
+            results.append(_fail(dict(scn_fn=scn_fn), cfg, manifest, traceback.format_exc()))
+            continue
+
+        if ctx['status'] == 'pending':
+            pending.append((cfg, manifest, ctx))
+        else:
+            res = dict(ctx, product_id=None, outputs=[])
+            record_result(scn_fn, res, manifest)
+            results.append(dict(res, cfg_fn=cfg.cfg_fn))
+
+    # sites whose clip and rgb are up to date
+    clipped = []
+    to_clip = []
+    for cfg, manifest, ctx in pending:
+        if ctx['clip_done'] and ctx['rgb_done']:
+            product_id = ctx['checkpoints'].stages['clip']['product_id']
+            ctx.update(status='clipped', ls=LandSatScene(_join(cfg.out_dir, product_id)), product_id=product_id)
+            clipped.append((cfg, manifest, ctx))
+        else:
+            to_clip.append((cfg, manifest, ctx))
+
+    if len(to_clip) > 0:
+        try:
+            with to_clip[0][0].scratch.reserve(scn_fn) as scn_path:
+                print('extracting...')
+                extract(scn_fn, scn_path)
+                _ls = LandSatScene(scn_path)
+
+                # the rgb is dumped for the first site and copied to the others
+                rgb_fn = None
+                for cfg, manifest, ctx in to_clip:
+                    try:
+                        print(cfg.cfg_fn)
+                        clip_extracted(ctx, _ls, cfg, rgb_fn=rgb_fn)
+                        clipped.append((cfg, manifest, ctx))
+                        if rgb_fn is None:
+                            rgb_fn = _join(ctx['ls'].basedir, 'rgb.tif')
+                    except Exception:
+                        results.append(_fail(ctx, cfg, manifest, traceback.format_exc()))
+                _ls = None
+        except Exception:
+            error = traceback.format_exc()
+            for cfg, manifest, ctx in to_clip:
+                if ctx['status'] == 'pending':
+                    results.append(_fail(ctx, cfg, manifest, error))
+
+    for cfg, manifest, ctx in clipped:
+        try:
+            model_scene(ctx, cfg)
+            res = write_scene(ctx, cfg)
+        except Exception:
+            results.append(_fail(ctx, cfg, manifest, traceback.format_exc()))
+            continue
+
+        record_result(scn_fn, res, manifest)
+        results.append(dict(res, scn_fn=scn_fn, cfg_fn=cfg.cfg_fn))
+
+    elapsed = time() - t0
+    for res in results:
+        res['elapsed'] = elapsed
+    return results
+
+
+#
+# worker state. Set by the pool initializer so the site configs are
+# loaded once per worker process
+#
+_worker_sites = None
+
+
+def init_worker(cfg_fns):
+    global _worker_sites
+    _worker_sites = []
+    for cfg_fn in cfg_fns:
+        cfg = SiteConfig(cfg_fn)
+        _worker_sites.append((cfg, open_manifest(cfg.out_dir)))
+
+
+def fan_out_one(scn_fn, retry_failed=True):
+    return fan_out_scene(scn_fn, _worker_sites, retry_failed=retry_failed)
+
+
+class FanOutPool(ScenePool):
+    """
+    ScenePool fanning every archive out to several sites. Yields the list
+    of results of an archive (one per site). When a worker dies (or
+    raises) the archive is marked as failed for the sites that were
+    processing it, archives in flight when a worker died are retried up to
+    max_retries times
+    """
+    def __init__(self, cfg_fns, workers, manifests, max_retries=1, retry_failed=True):
+        assert len(cfg_fns) == len(manifests)
+        super(FanOutPool, self).__init__(None, workers, None, max_retries=max_retries)
+        self.cfg_fns = cfg_fns
+        self.manifests = manifests
+        self.retry_failed = retry_failed
+
+    def _start(self):
+        self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                             initializer=init_worker,
+                                             initargs=(self.cfg_fns,))
+
+    def _submit(self, scn_fn, attempt):
+        # a retry claims the archives failed by the dead worker
+        return self._executor.submit(fan_out_one, scn_fn, retry_failed=self.retry_failed or attempt > 1)
+
+    def _scene_failed(self, scn_fn, error):
+        results = []
+        for cfg_fn, manifest in zip(self.cfg_fns, self.manifests):
+            if manifest.state(scn_fn) == PROCESSING:
+                manifest.mark_failed(scn_fn, error=error)
+                results.append(dict(scn_fn=scn_fn, cfg_fn=cfg_fn, status='failed', elapsed=None, error=error))
+        return results
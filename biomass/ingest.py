@@ -0,0 +1,890 @@
+"""
+Scene ingestion for the site configs (process_scene.py / process_scenes.py).
+
+A site config is loaded once per worker process (models, pasture
+shapefile and bounds) and the workers of a ScenePool process many scenes
+each. The pool restarts workers that die on fatal errors (e.g. a GDAL
+segfault) and retries the scenes that were in flight.
+
+The state of every archive is recorded in the processing manifest of the
+site's out_dir (see database.manifest).
+
+A scene is an archive or, with mosaic_same_date, a tuple of the archives
+acquired on the same date by the same sensor that are merged into one
+product before modelling (see biomass.mosaic).
+"""
+
+import os
+import sys
+import csv
+import shutil
+import tarfile
+import json
+import hashlib
+import threading
+import traceback
+import multiprocessing
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from glob import glob
+from time import time
+
+from os.path import join as _join
+from os.path import exists as _exists
+
+import yaml
+import fiona
+import rasterio
+from rasterio.warp import transform_bounds
+
+from biomass.landsat import LandSatScene, get_gz_scene_bounds
+from biomass.rangesat_biomass import ModelPars, SatModelPars, BiomassModel, build_pasture_masks, \
+    build_grid_pasture_masks
+from biomass.reproject import reproject_scene
+from biomass.scratch import ScratchManager
+from biomass.mosaic import mosaic_archives
+from biomass.prescreen import prescreen_scene
+from biomass.checkpoint import StageCheckpoints, atomic_output, file_identity, input_hash
+from database.manifest import open_manifest, archive_name, PROCESSING
+from database.pasturestats_db import upsert_scene, has_scene_rows, touch_cache_stamp
+from all_your_base import get_sf_wgs_bounds, bounds_intersect, GEODATA_DIRS, SCRATCH
+
+
+_pasture_stats_fieldnames = [
+    'product_id', 'key', 'total_px', 'snow_px', 'water_px',
+    'aerosol_px', 'valid_px', 'coverage', 'area_ha',
+    'model', 'biomass_mean_gpm', 'biomass_ci90_gpm',
+    'biomass_10pct_gpm', 'biomass_50pct_gpm', 'biomass_75pct_gpm', 'biomass_90pct_gpm',
+    'biomass_total_kg', 'biomass_sd_gpm', 'summer_vi_mean_gpm',
+    'fall_vi_mean_gpm', 'fraction_summer',
+    'product_id', 'satellite', 'acquisition_date',
+    'wrs', 'bounds', 'wgs_bounds', 'valid_pastures_cnt',
+    'ndvi_mean', 'ndvi_sd', 'ndvi_10pct', 'ndvi_50pct', 'ndvi_75pct', 'ndvi_90pct', 'ndvi_ci90',
+    'nbr_mean', 'nbr_sd', 'nbr_10pct', 'nbr_50pct', 'nbr_75pct', 'nbr_90pct', 'nbr_ci90',
+    'nbr2_mean', 'nbr2_sd', 'nbr2_10pct', 'nbr2_50pct', 'nbr2_75pct', 'nbr2_90pct', 'nbr2_ci90']
+
+_rgb_gamma = 1.5
+
+# bumped when a change to the processing code changes the biomass grids
+# or pasture stats, the scenes processed by an earlier version are stale
+PROCESSING_VERSION = 1
+
+_fingerprint_fn = 'fingerprint.json'
+
+# estimate of the space an extracted scene takes in SCRATCH relative to
+# the size of the archive
+_extract_factor = 1.1
+
+
+def ranch_wgs_bounds(sf, key, delimiter='+', reverse_key=False):
+    """
+    wgs bounds of the pastures of each ranch of an opened shapefile
+
+    :return: list of (w, s, e, n) sorted by ranch
+    """
+    bounds = {}
+    for feature in sf:
+        tokens = feature['properties'][key].split(delimiter)
+        ranch = tokens[0] if reverse_key else tokens[-1]
+        b = fiona.bounds(feature)
+        if ranch in bounds:
+            _b = bounds[ranch]
+            b = min(b[0], _b[0]), min(b[1], _b[1]), max(b[2], _b[2]), max(b[3], _b[3])
+        bounds[ranch] = b
+
+    return [tuple(transform_bounds(sf.crs_wkt, 'EPSG:4326', *bounds[ranch])) for ranch in sorted(bounds)]
+
+
+class SiteConfig(object):
+    """
+    site config yaml (e.g. scripts/rcr_config.yaml) with the models
+    built and the pasture shapefile opened
+    """
+    def __init__(self, cfg_fn):
+        assert cfg_fn.endswith('.yaml'), "Is %s a config file?" % cfg_fn
+
+        with open(cfg_fn) as fp:
+            yaml_txt = fp.read()
+            config_hash = hashlib.sha1(yaml_txt.encode()).hexdigest()
+            yaml_txt = yaml_txt.replace('{GEODATA}', GEODATA_DIRS[0])
+            _d = yaml.safe_load(yaml_txt)
+
+        # the models of the config, used for the stage checkpoints
+        models_hash = input_hash(_d['models'])
+
+        # a scene only depends on the model parameters of its satellite
+        satellite_models = {}
+        for _m in _d['models']:
+            for pars in _m['satellite_pars']:
+                satellite_models.setdefault(int(pars['satellite']), []).append((_m['name'], pars))
+
+        models = []
+        for _m in _d['models']:
+            _satellite_pars = {}
+            for pars in _m['satellite_pars']:
+                _satellite_pars[pars['satellite']] = SatModelPars(**pars)
+            models.append(ModelPars(_m['name'], _satellite_pars))
+
+        # open shape file and determine the bounds
+        sf_fn = os.path.abspath(_d['sf_fn'])
+
+        self.cfg_fn = cfg_fn
+        self.config_hash = config_hash
+        self.models_hash = models_hash
+        self.satellite_models_hashes = {satellite: input_hash(pars) for satellite, pars in satellite_models.items()}
+        self.models = models
+        self.sf_fn = sf_fn
+        self.sf = fiona.open(sf_fn, 'r')
+        self.bbox = get_sf_wgs_bounds(sf_fn)
+        self.sf_feature_properties_key = _d.get('sf_feature_properties_key', 'key')
+        self.sf_feature_properties_delimiter = _d.get('sf_feature_properties_delimiter', '+')
+        self.out_dir = _d['out_dir']
+        self.landsat_scene_directory = _d.get('landsat_scene_directory', None)
+        self.wrs_blacklist = _d.get('wrs_blacklist', None)
+        self.wrs_whitelist = _d.get('wrs_whitelist', None)
+        self.workers = _d.get('workers', None)
+        self.reverse_key = _d.get('reverse_key', False)
+
+        # merge archives of overlapping paths/rows acquired on the same date
+        # into one product per date
+        self.mosaic_same_date = _d.get('mosaic_same_date', False)
+
+        # clip_mode: ranches clips a window around every ranch (windows
+        # that overlap are merged) instead of the bbox of the site. For
+        # sites whose ranches are far apart
+        self.clip_mode = _d.get('clip_mode', 'bbox')
+        assert self.clip_mode in ('bbox', 'ranches'), self.clip_mode
+        self.clip_windows = None
+        if self.clip_mode == 'ranches':
+            self.clip_windows = ranch_wgs_bounds(self.sf, self.sf_feature_properties_key,
+                                                 self.sf_feature_properties_delimiter, self.reverse_key)
+
+        # archives whose expected pasture coverage (from the qa band) is
+        # below prescreen_coverage are not processed. Cloudy pixels only
+        # count as invalid with prescreen_clouds
+        self.prescreen_coverage = _d.get('prescreen_coverage', None)
+        self.prescreen_clouds = _d.get('prescreen_clouds', False)
+
+        # the pasture stats are upserted into <out_dir>/sqlite3.db, the
+        # csvs are kept as an audit trail unless write_csv is false
+        self.update_db = _d.get('update_db', True)
+        self.write_csv = _d.get('write_csv', True)
+
+        # held while the location database is used. Lease workers set it
+        # to the db lock shared by the hosts (see biomass.work_queue)
+        self.db_lock = nullcontext()
+
+        # archives are extracted to SCRATCH within scratch_budget_gb (default
+        # 90% of SCRATCH) or to the disk backed scratch_fallback directory
+        scratch_budget = _d.get('scratch_budget_gb', None)
+        if scratch_budget is not None:
+            scratch_budget = int(float(scratch_budget) * 1024**3)
+        self._scratch_kwargs = dict(budget=scratch_budget, fallback=_d.get('scratch_fallback', None))
+        self._scratch = None
+        self._scratch_lock = threading.Lock()
+
+        years = _d.get('years', None)
+        if years is not None:
+            years = [int(yr) for yr in years]
+        self.years = years
+
+        self._pasture_masks = {}
+        self._sf_lock = threading.Lock()
+
+    def pasture_masks(self, ls):
+        """
+        returns the pasture masks for the grid of ls. The masks are cached
+        by grid signature and the shapefile is only read by one thread at
+        a time
+        """
+        key = ls.grid_signature
+        with self._sf_lock:
+            if key not in self._pasture_masks:
+                self._pasture_masks[key] = build_pasture_masks(self.sf, ls, self.sf_feature_properties_key)
+            return self._pasture_masks[key]
+
+    def grid_pasture_masks(self, crs, transform, width, height):
+        """
+        returns the pasture masks for a grid that is not backed by a
+        scene (e.g. the window of the qa band read by the prescreen)
+        """
+        key = ('grid', crs.to_wkt(), tuple(transform)[:6], width, height)
+        with self._sf_lock:
+            if key not in self._pasture_masks:
+                self._pasture_masks[key] = build_grid_pasture_masks(self.sf, crs.to_wkt(), transform, width, height,
+                                                                    self.sf_feature_properties_key)
+            return self._pasture_masks[key]
+
+    @property
+    def scratch(self):
+        """
+        ScratchManager of the site, created on first use. Stale scratch
+        directories are not removed (see cleanup_scratch)
+        """
+        with self._scratch_lock:
+            if self._scratch is None:
+                self._scratch = ScratchManager(**self._scratch_kwargs)
+            return self._scratch
+
+    def cleanup_scratch(self):
+        """
+        removes the stale scene directories and reservations in SCRATCH.
+        Called once by the driver at start-up, the workers never do
+        """
+        if not self.scratch.available:
+            return []
+        return self.scratch.cleanup_stale()
+
+    def record_pasture_fingerprints(self):
+        """
+        records the fingerprints of the pastures the stats of out_dir are
+        computed with unless they are recorded already, so update_pastures
+        can tell which pastures a later edit of the shapefile changed
+        """
+        from biomass.pastures import fingerprints_recorded, pasture_fingerprints, save_fingerprints
+
+        if fingerprints_recorded(self.out_dir):
+            return
+
+        with self._sf_lock:
+            fingerprints = pasture_fingerprints(self.sf, self.sf_feature_properties_key)
+        save_fingerprints(self.out_dir, fingerprints, sf_fn=self.sf_fn)
+
+    def close(self):
+        self.sf.close()
+
+
+def find_scenes(landsat_scene_directory, manifest=None, recursive=True, retry_failed=False, rescreen=False):
+    """
+    returns the archives in landsat_scene_directory. If a manifest is
+    specified the archives are registered and the ones that have already
+    been processed are skipped
+
+    :param rescreen: include the archives skipped by the prescreen
+    """
+    if recursive:
+        fns = glob(_join(landsat_scene_directory, '**', '*.tar'), recursive=True)
+    else:
+        fns = glob(_join(landsat_scene_directory, '*.tar'))
+
+    if manifest is not None:
+        manifest.register(fns)
+        if rescreen:
+            manifest.requeue_low_coverage(fns)
+        fns = manifest.unprocessed(fns, retry_failed=retry_failed)
+
+    return sorted(fns)
+
+
+def scene_members(scn_fn):
+    """
+    returns the list of archives of a scene
+    """
+    if isinstance(scn_fn, (tuple, list)):
+        return list(scn_fn)
+    return [scn_fn]
+
+
+def scene_name(scn_fn):
+    """
+    name the checkpoints and pasture stats csv of a scene are stored under
+    """
+    return archive_name(scene_members(scn_fn)[0])
+
+
+def extract(tar_fn, dst):
+    print(tar_fn, dst)
+
+    tar = tarfile.open(tar_fn)
+    tar.extractall(path=dst)
+    tar.close()
+
+
+def pasture_stats_rows(results):
+    """
+    yields a dict for every pasture and model of the scene results with
+    the _pasture_stats_fieldnames
+    """
+    for _res_d in results:  # scene
+        _res = _res_d['res']
+        _ls_summary = _res_d['ls_summary']
+
+        for _pasture in _res:  # pasture
+            _model_stats = _pasture['model_stats']
+            _ls_stats = _pasture['ls_stats']
+            _pasture = {k: v for k, v in _pasture.items() if k not in ('model_stats', 'ls_stats')}
+
+            for _model, _model_d in _model_stats.items():
+                _model_d = _model_d.asdict()
+                _model_d.update(_pasture)
+                _model_d.update(_ls_summary)
+                _model_d.update(_ls_stats)
+                yield _model_d
+
+
+def dump_pasture_stats(results, dst_fn):
+    with atomic_output(dst_fn) as tmp_fn:
+        with open(tmp_fn, 'w', newline='') as _fp:
+            writer = csv.DictWriter(_fp, fieldnames=_pasture_stats_fieldnames)
+            writer.writeheader()
+            for _model_d in pasture_stats_rows(results):
+                writer.writerow(_model_d)
+
+
+def upsert_pasture_stats(results, product_id, cfg, config_hash=None):
+    """
+    upserts the pasture stats of a scene into the location database
+
+    :param config_hash: pasture_stats stage hash the rows are stamped with
+    """
+    rows = [[_model_d.get(k) for k in _pasture_stats_fieldnames] for _model_d in pasture_stats_rows(results)]
+    with cfg.db_lock:
+        n = upsert_scene(cfg.out_dir, product_id, rows, key_delimiter=cfg.sf_feature_properties_delimiter,
+                         reverse_key=cfg.reverse_key, config_hash=config_hash)
+    print('upserted %i pasture stats rows' % n)
+    return n
+
+
+def _sf_identity(sf_fn):
+    # the .shp and its sidecar files (.dbf, .prj, ...)
+    return [file_identity(fn) for fn in sorted(glob(os.path.splitext(sf_fn)[0] + '.*'))]
+
+
+def scene_satellite(scn_fn):
+    """
+    satellite of a scene, e.g. 8 for LC08_L2SP_042028_20200601_20200610_02_T1.tar
+    """
+    return int(archive_name(scene_members(scn_fn)[0])[2:4])
+
+
+def config_fingerprint(scn_fn, cfg):
+    """
+    hashes of the parts of the site config the outputs of a scene depend
+    on: the clip bounds, the model parameters for the satellite of the
+    scene, the processing version, the shapefile and the pasture keys
+    """
+    if cfg.clip_windows is None or not isinstance(scn_fn, str):
+        # mosaics are clipped to the bbox
+        bbox = input_hash(cfg.bbox)
+    else:
+        bbox = input_hash(cfg.bbox, cfg.clip_windows)
+
+    return dict(bbox=bbox,
+                models=cfg.satellite_models_hashes.get(scene_satellite(scn_fn)),
+                version=PROCESSING_VERSION,
+                sf=input_hash(_sf_identity(cfg.sf_fn)),
+                keys=input_hash(cfg.sf_feature_properties_key, cfg.sf_feature_properties_delimiter,
+                                cfg.reverse_key, cfg.update_db, cfg.write_csv))
+
+
+# the parts of the config_fingerprint each stage depends on
+STAGE_FINGERPRINT = dict(clip=('bbox',),
+                         rgb=(),
+                         biomass=('bbox', 'models', 'version'),
+                         pasture_stats=('bbox', 'models', 'version', 'sf', 'keys'),
+                         reproject=('bbox', 'models', 'version'))
+
+
+def stage_hashes(scn_fn, cfg, fingerprint=None):
+    """
+    input hashes of the stages of a scene. A stage is redone when its hash
+    changes, the hashes of later stages include the hashes they depend on
+
+    :param fingerprint: config_fingerprint of the scene
+    """
+    if fingerprint is None:
+        fingerprint = config_fingerprint(scn_fn, cfg)
+
+    if isinstance(scn_fn, str):
+        archive = file_identity(scn_fn)
+    else:
+        archive = [file_identity(fn) for fn in scn_fn]
+    if cfg.clip_windows is None or not isinstance(scn_fn, str):
+        clip = input_hash('clip', archive, cfg.bbox)
+    else:
+        clip = input_hash('clip', archive, cfg.bbox, cfg.clip_windows)
+    rgb = input_hash('rgb', archive, _rgb_gamma)
+    biomass = input_hash('biomass', clip, fingerprint['models'], fingerprint['version'], 'int16')
+    pasture_stats = input_hash('pasture_stats', biomass, fingerprint['sf'], fingerprint['keys'])
+    reproject = input_hash('reproject', rgb, biomass)
+    return dict(clip=clip, rgb=rgb, biomass=biomass, pasture_stats=pasture_stats, reproject=reproject)
+
+
+def write_fingerprint(scn_dir, fingerprint, hashes):
+    """
+    stamps the outputs of a scene with the config fingerprint and stage
+    hashes they were made with (<scn_dir>/fingerprint.json)
+    """
+    with atomic_output(_join(scn_dir, _fingerprint_fn)) as tmp_fn:
+        with open(tmp_fn, 'w') as fp:
+            json.dump(dict(config=fingerprint, stages=hashes), fp, indent=2, sort_keys=True)
+
+
+def read_fingerprint(scn_dir):
+    """
+    returns the fingerprint.json of a scene or None
+    """
+    fn = _join(scn_dir, _fingerprint_fn)
+    if not _exists(fn):
+        return None
+
+    with open(fn) as fp:
+        return json.load(fp)
+
+
+def _scene_files(scn_dir):
+    return sorted(fn for fn in glob(_join(scn_dir, '**', '*'), recursive=True) if os.path.isfile(fn))
+
+
+def screen_scene(scn_fn, cfg):
+    """
+    Checks that a scene overlaps the site and passes the prescreen and
+    loads its stage checkpoints
+
+    :return: dict(scn_fn, status='pending', checkpoints, hashes, fingerprint, clip_done, rgb_done),
+             dict(scn_fn, status='no-overlap') or
+             dict(scn_fn, status='low-coverage', coverage, reason)
+    """
+    for fn in scene_members(scn_fn):
+        scn_bounds = get_gz_scene_bounds(fn)
+        if not bounds_intersect(cfg.bbox, scn_bounds):
+            print('bounds do not intersect', cfg.bbox, scn_bounds)
+            return dict(scn_fn=scn_fn, status='no-overlap')
+
+    if cfg.prescreen_coverage is not None:
+        # the coverage of a mosaic is at most the sum of the coverages of
+        # its archives
+        coverage = sum(prescreen_scene(fn, cfg)['coverage'] for fn in scene_members(scn_fn))
+        if coverage < cfg.prescreen_coverage:
+            reason = 'expected pasture coverage %0.3f < %0.3f' % (coverage, cfg.prescreen_coverage)
+            print(scn_fn, reason)
+            return dict(scn_fn=scn_fn, status='low-coverage', coverage=coverage, reason=reason)
+
+    checkpoints = StageCheckpoints.for_archive(cfg.out_dir, scene_name(scn_fn))
+    fingerprint = config_fingerprint(scn_fn, cfg)
+    hashes = stage_hashes(scn_fn, cfg, fingerprint)
+    return dict(scn_fn=scn_fn, status='pending', checkpoints=checkpoints, hashes=hashes, fingerprint=fingerprint,
+                clip_done=checkpoints.is_done('clip', hashes['clip']),
+                rgb_done=checkpoints.is_done('rgb', hashes['rgb']))
+
+
+def clip_extracted(ctx, _ls, cfg, rgb_fn=None):
+    """
+    Clips an extracted scene to the site and dumps its rgb. Stages that
+    are up to date are skipped
+
+    :param ctx: dict from screen_scene
+    :param _ls: LandSatScene of the extracted archive
+    :param rgb_fn: rgb of _ls already dumped for another site, copied
+                   instead of dumping it again
+    """
+    out_dir = cfg.out_dir
+    checkpoints = ctx['checkpoints']
+    hashes = ctx['hashes']
+    product_id = _ls.product_id
+
+    if ctx['clip_done']:
+        ls = LandSatScene(_join(out_dir, product_id))
+    else:
+        print('clip')
+        if cfg.clip_windows is None:
+            ls = _ls.clip(cfg.bbox, out_dir)
+        else:
+            ls = _ls.clip_windows(cfg.bbox, cfg.clip_windows, out_dir)
+        checkpoints.mark_done('clip', hashes['clip'], _scene_files(ls.basedir), product_id=product_id,
+                              config=ctx['fingerprint'])
+
+    if not ctx['rgb_done']:
+        dst_fn = _join(ls.basedir, 'rgb.tif')
+        if rgb_fn is None:
+            _ls.dump_rgb(dst_fn, gamma=_rgb_gamma)
+        else:
+            with atomic_output(dst_fn) as tmp_fn:
+                shutil.copyfile(rgb_fn, tmp_fn)
+        checkpoints.mark_done('rgb', hashes['rgb'], [dst_fn])
+
+    print('ls.basedir', ls.basedir)
+    ctx.update(status='clipped', ls=ls, product_id=product_id)
+    return ctx
+
+
+def extract_and_clip(scn_fn, cfg, verbose=True):
+    """
+    Extracts a scene archive to SCRATCH, clips it to the site and dumps
+    the rgb. The extracted scene is removed once it has been clipped.
+    The archive is not extracted if the clip and rgb are up to date.
+
+    The archives of a same-date scene are clipped and mosaicked (the
+    mosaic is checkpointed as the clip) and the rgb is dumped from the
+    mosaic.
+
+    :return: dict(scn_fn, status='clipped', ls, product_id, checkpoints, hashes),
+             dict(scn_fn, status='no-overlap') or
+             dict(scn_fn, status='low-coverage', coverage, reason)
+    """
+    out_dir = cfg.out_dir
+
+    ctx = screen_scene(scn_fn, cfg)
+    if ctx['status'] != 'pending':
+        return ctx
+
+    if verbose:
+        print(scn_fn, out_dir)
+
+    checkpoints = ctx['checkpoints']
+    hashes = ctx['hashes']
+
+    if ctx['clip_done'] and ctx['rgb_done']:
+        print('clip and rgb are up to date')
+        product_id = checkpoints.stages['clip']['product_id']
+        ctx.update(status='clipped', ls=LandSatScene(_join(out_dir, product_id)), product_id=product_id)
+    elif not isinstance(scn_fn, str):
+        if ctx['clip_done']:
+            product_id = checkpoints.stages['clip']['product_id']
+            ls = LandSatScene(_join(out_dir, product_id))
+        else:
+            ls, summary = mosaic_archives(scn_fn, cfg.bbox, out_dir, cfg.scratch)
+            product_id = ls.product_id
+            checkpoints.mark_done('clip', hashes['clip'], _scene_files(ls.basedir),
+                                  product_id=product_id, members=summary['members'], config=ctx['fingerprint'])
+
+        rgb_fn = _join(ls.basedir, 'rgb.tif')
+        ls.dump_rgb(rgb_fn, gamma=_rgb_gamma)
+        checkpoints.mark_done('rgb', hashes['rgb'], [rgb_fn])
+        print('ls.basedir', ls.basedir)
+        ctx.update(status='clipped', ls=ls, product_id=product_id)
+    else:
+        # waits until the extracted archive fits in the scratch budget
+        with cfg.scratch.reserve(scn_fn) as scn_path:
+            print('extracting...')
+            extract(scn_fn, scn_path)
+
+            # Load and crop LandSat Scene
+            print('load')
+            _ls = LandSatScene(scn_path)
+            clip_extracted(ctx, _ls, cfg)
+            _ls = None
+
+    return ctx
+
+
+def pasture_stats_done(checkpoints, hashes, product_id, cfg):
+    """
+    True if the pasture stats of a scene are up to date. Without a csv
+    (write_csv=False) the checkpoint has no outputs to verify, the rows of
+    the scene are looked up in the location database instead
+    """
+    if not checkpoints.is_done('pasture_stats', hashes['pasture_stats']):
+        return False
+
+    d = checkpoints.stages['pasture_stats']
+    if len(d['outputs']) > 0 or not cfg.update_db or d.get('db_rows') == 0:
+        return True
+    with cfg.db_lock:
+        return has_scene_rows(cfg.out_dir, product_id, hashes['pasture_stats'])
+
+
+def model_scene(ctx, cfg):
+    """
+    Runs the biomass models on a clipped scene and analyzes the pastures.
+    Skipped if the biomass grids and pasture stats are up to date
+    """
+    ls = ctx['ls']
+    checkpoints = ctx['checkpoints']
+    hashes = ctx['hashes']
+
+    biomass_done = checkpoints.is_done('biomass', hashes['biomass'])
+    stats_done = pasture_stats_done(checkpoints, hashes, ctx['product_id'], cfg)
+    ctx.update(biomass_done=biomass_done, stats_done=stats_done,
+               bio_model=None, res=None, ls_summary=None)
+
+    if biomass_done and stats_done:
+        print('biomass and pasture stats are up to date')
+        return ctx
+
+    # Build biomass model
+    bio_model = BiomassModel(ls, cfg.models)
+    ctx['bio_model'] = bio_model
+
+    if not stats_done:
+        # Analyze pastures
+        print('analyzing pastures')
+        ctx['res'] = bio_model.analyze_pastures(cfg.sf, cfg.sf_feature_properties_key,
+                                                cfg.sf_feature_properties_delimiter,
+                                                pasture_masks=cfg.pasture_masks(ls))
+
+        # get a summary dictionary of the landsat scene
+        print('compiling summary')
+        ctx['ls_summary'] = ls.summary_dict()
+
+    return ctx
+
+
+def write_scene(ctx, cfg):
+    """
+    Exports the grids, writes the pasture stats and reprojects the scene.
+    Every stage that completes is checkpointed
+
+    :return: dict(status='processed', product_id, outputs)
+    """
+    out_dir = cfg.out_dir
+    product_id = ctx['product_id']
+    ls_dir = ctx['ls'].basedir
+    checkpoints = ctx['checkpoints']
+    hashes = ctx['hashes']
+
+    if not ctx['biomass_done']:
+        # Export grids
+        print('exporting grids')
+        biomass_dir = _join(ls_dir, 'biomass')
+        ctx['bio_model'].export_grids(biomass_dir=biomass_dir, dtype=rasterio.int16)
+        checkpoints.mark_done('biomass', hashes['biomass'],
+                              _scene_files(biomass_dir) + [_join(ls_dir, '%s_ndvi.tif' % product_id)],
+                              config=ctx['fingerprint'])
+
+    stats_fn = _join(out_dir, '%s_pasture_stats.csv' % scene_name(ctx['scn_fn']))
+    if not ctx['stats_done']:
+        results = [dict(res=ctx['res'], ls_summary=ctx['ls_summary'])]
+        db_rows = None
+        if cfg.update_db:
+            db_rows = upsert_pasture_stats(results, product_id, cfg, config_hash=hashes['pasture_stats'])
+
+        if cfg.write_csv:
+            dump_pasture_stats(results, stats_fn)
+
+        checkpoints.mark_done('pasture_stats', hashes['pasture_stats'],
+                              [stats_fn] if cfg.write_csv else [], db_rows=db_rows, config=ctx['fingerprint'])
+        cfg.record_pasture_fingerprints()
+
+    if checkpoints.is_done('reproject', hashes['reproject']):
+        print('reprojection is up to date')
+    else:
+        print('reprojecting scene')
+        checkpoints.mark_done('reproject', hashes['reproject'], reproject_scene(ls_dir), config=ctx['fingerprint'])
+
+    write_fingerprint(ls_dir, ctx['fingerprint'], hashes)
+
+    outputs = _scene_files(ls_dir)
+    if cfg.write_csv:
+        outputs.append(stats_fn)
+
+    touch_cache_stamp(out_dir)
+
+    # release the datasets of the scene
+    ctx['ls'] = ctx['bio_model'] = None
+    return dict(status='processed', product_id=product_id, outputs=outputs)
+
+
+def process_scene(scn_fn, cfg, verbose=True):
+    """
+    Extracts, clips and analyzes a scene archive for a site and writes
+    the pasture stats to the location database (and csv) in cfg.out_dir.
+
+    :param scn_fn: path to .tar or .tar.gz archive or tuple of same-date archives
+    :param cfg: SiteConfig
+    :return: dict(status='processed', 'no-overlap' or 'low-coverage', product_id, outputs)
+    """
+    ctx = extract_and_clip(scn_fn, cfg, verbose=verbose)
+    if ctx['status'] == 'no-overlap':
+        return dict(status='no-overlap', product_id=None, outputs=[])
+
+    if ctx['status'] == 'low-coverage':
+        return dict(status='low-coverage', product_id=None, outputs=[],
+                    coverage=ctx['coverage'], reason=ctx['reason'])
+
+    model_scene(ctx, cfg)
+    return write_scene(ctx, cfg)
+
+
+def claim_scene(scn_fn, cfg, manifest, retry_failed=True, takeover=False):
+    """
+    claims the archives of a scene in the manifest. Archives of a same-date
+    scene that are claimed by another worker or already processed are
+    left out of the mosaic
+
+    :return: the scene with the claimed archives or None
+    """
+    claimed = [fn for fn in scene_members(scn_fn)
+               if manifest.claim(fn, config_hash=cfg.config_hash, retry_failed=retry_failed, takeover=takeover)]
+
+    if len(claimed) == 0:
+        return None
+    if len(claimed) == 1:
+        return claimed[0]
+    return tuple(claimed)
+
+
+def record_result(scn_fn, res, manifest):
+    """
+    records the result of process_scene in the manifest. Every archive
+    of a same-date scene is recorded with the product of the mosaic
+    """
+    for fn in scene_members(scn_fn):
+        if res['status'] == 'no-overlap':
+            manifest.mark_skipped(fn)
+        elif res['status'] == 'low-coverage':
+            manifest.mark_low_coverage(fn, res['coverage'], reason=res['reason'])
+        else:
+            # the checksum of the archive is recorded when it is validated
+            # (see biomass.validation), it is not read again here
+            manifest.mark_done(fn, product_id=res['product_id'], outputs=res['outputs'])
+
+
+def fail_scene(scn_fn, error, manifest):
+    for fn in scene_members(scn_fn):
+        manifest.mark_failed(fn, error=error)
+
+
+def run_scene(scn_fn, cfg, manifest, retry_failed=True, takeover=False):
+    """
+    processes a scene and records the result in the manifest. Scenes
+    that are claimed by another worker or already processed are skipped
+    """
+    t0 = time()
+    try:
+        claimed = claim_scene(scn_fn, cfg, manifest, retry_failed=retry_failed, takeover=takeover)
+    except Exception:
+        # archives claimed before the manifest raised are not left processing
+        error = traceback.format_exc()
+        fail_scene([fn for fn in scene_members(scn_fn) if manifest.state(fn) == PROCESSING], error, manifest)
+        return dict(scn_fn=scn_fn, status='failed', error=error, elapsed=time() - t0)
+
+    if claimed is None:
+        return dict(scn_fn=scn_fn, status='claimed', elapsed=time() - t0)
+    scn_fn = claimed
+
+    try:
+        res = process_scene(scn_fn, cfg)
+        record_result(scn_fn, res, manifest)
+    except Exception:
+        error = traceback.format_exc()
+        fail_scene(scn_fn, error, manifest)
+        return dict(scn_fn=scn_fn, status='failed', error=error, elapsed=time() - t0)
+
+    res['scn_fn'] = scn_fn
+    res['elapsed'] = time() - t0
+    return res
+
+
+def default_workers(scn_fns, scratch=SCRATCH):
+    """
+    number of scenes that can be processed concurrently without
+    overfilling SCRATCH, limited to the number of cpus
+    """
+    cpu_count = multiprocessing.cpu_count()
+    if len(scn_fns) == 0 or not _exists(scratch):
+        return cpu_count
+
+    scene_size = max(os.path.getsize(fn) for scn_fn in scn_fns for fn in scene_members(scn_fn)) * _extract_factor
+    free = shutil.disk_usage(scratch).free
+    return max(1, min(cpu_count, int(free // scene_size)))
+
+
+#
+# worker state. These are set by the pool initializer so that the site
+# config is loaded once per worker process
+#
+_worker_cfg = None
+_worker_manifest = None
+
+
+def _init_worker(cfg_fn):
+    global _worker_cfg, _worker_manifest
+    _worker_cfg = SiteConfig(cfg_fn)
+    _worker_manifest = open_manifest(_worker_cfg.out_dir)
+
+
+def _process_one(scn_fn):
+    return run_scene(scn_fn, _worker_cfg, _worker_manifest)
+
+
+class ScenePool(object):
+    """
+    Long-lived pool of workers processing scenes for a site config.
+
+    Scenes are submitted as workers become available so the scenes in
+    flight are known when a worker dies. In that case the pool is
+    restarted and the scenes that were in flight are marked as failed in
+    the manifest and retried up to max_retries times. A scene whose worker
+    raises is marked as failed and not retried.
+    """
+    def __init__(self, cfg_fn, workers, manifest, max_retries=1):
+        assert workers > 0
+        self.cfg_fn = cfg_fn
+        self.manifest = manifest
+        self.workers = workers
+        self.max_retries = max_retries
+        self._executor = None
+
+    def _start(self):
+        self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                             initializer=_init_worker,
+                                             initargs=(self.cfg_fn,))
+
+    def _shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _submit(self, scn_fn, attempt):
+        return self._executor.submit(_process_one, scn_fn)
+
+    def _scene_failed(self, scn_fn, error):
+        """
+        marks a scene that was in flight as failed when its worker died or
+        raised. Returns the result yielded when it is not retried
+        """
+        fail_scene(scn_fn, error, self.manifest)
+        return dict(scn_fn=scn_fn, status='failed', elapsed=None, error=error)
+
+    def imap(self, scn_fns):
+        """
+        processes the scenes and yields result dicts (scn_fn, status,
+        elapsed and error for failures) as scenes finish
+        """
+        queue = list(scn_fns)[::-1]
+        attempts = {}
+        in_flight = {}
+
+        self._start()
+        try:
+            while len(queue) > 0 or len(in_flight) > 0:
+                while len(queue) > 0 and len(in_flight) < self.workers:
+                    scn_fn = queue.pop()
+                    attempts[scn_fn] = attempts.get(scn_fn, 0) + 1
+                    in_flight[self._submit(scn_fn, attempts[scn_fn])] = scn_fn
+
+                done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+
+                broken = False
+                for future in done:
+                    scn_fn = in_flight.pop(future)
+                    try:
+                        res = future.result()
+                    except BrokenProcessPool:
+                        broken = True
+                        in_flight[future] = scn_fn
+                        continue
+                    except Exception:
+                        # e.g. the manifest could not be updated, the scene
+                        # must not be left processing
+                        res = self._scene_failed(scn_fn, traceback.format_exc())
+                    yield res
+
+                if broken:
+                    print('worker died, restarting pool', file=sys.stderr)
+                    for future, scn_fn in in_flight.items():
+                        res = self._scene_failed(scn_fn, 'worker died while processing scene')
+                        if attempts[scn_fn] > self.max_retries:
+                            yield res
+                        else:
+                            queue.append(scn_fn)
+                    in_flight = {}
+                    self._shutdown()
+                    self._start()
+        finally:
+            self._shutdown()
+
+    def close(self):
+        self._shutdown()
@@ -5,8 +5,8 @@
 
 import os
 import io
+import json
 import tarfile
-import shutil
 from datetime import date
 
 from glob import glob
@@ -17,7 +17,13 @@ import numpy as np
 
 import rasterio
 from rasterio.io import MemoryFile
-from rasterio.warp import transform_bounds
+from rasterio.crs import CRS
+from rasterio.transform import rowcol, array_bounds, Affine
+from rasterio.warp import transform_bounds, transform
+from rasterio.windows import Window, from_bounds
+from rasterio.windows import transform as window_transform
+
+from .checkpoint import atomic_output
 
 # Landsat 8 Tasseled Cap Coefficients
 # https://community.hexagongeospatial.com/t5/Spatial-Modeler-Tutorials/Tasseled-Cap-Transformation-for-Landsat-8/ta-p/1609
@@ -26,6 +32,82 @@ from rasterio.warp import transform_bounds
 # https://gis.stackexchange.com/a/156255
 
 
+# index of each flag in the unpacked qa band of (l2sp, pre-collection) scenes
+_qa_flags = dict(fill=(0, 15), clear=(6, 14), water=(7, 13), cloud_shadow=(4, 12), snow=(5, 11), cloud=(3, 10))
+
+
+def unpack_qa(pixel_qa, l2sp):
+    """
+    unpacks the qa_pixel (l2sp) or pixel_qa band into an (m, n, 16) array of bits
+    """
+    pixel_qa = np.array(pixel_qa, dtype=np.uint16)
+    m, n = pixel_qa.shape
+    bqa = np.unpackbits(pixel_qa.view(np.uint8)).reshape((m, n, 16))
+
+    if l2sp:
+        return bqa
+    return np.concatenate((bqa[:, :, 8:], bqa[:, :, :8]), axis=2)
+
+
+def qa_flag(bqa, name, l2sp):
+    """
+    returns a flag (fill, clear, water, cloud_shadow, snow, cloud) of an unpacked qa band
+    """
+    return bqa[:, :, _qa_flags[name][(1, 0)[l2sp]]]
+
+
+# scene directories clipped to several windows (see LandSatScene.clip_windows)
+_windows_fn = 'windows.json'
+
+
+def is_multi_window(scn_dir):
+    """
+    True if scn_dir was clipped to several windows (opens as a MultiWindowScene)
+    """
+    return os.path.isdir(scn_dir) and _exists(_join(scn_dir, _windows_fn))
+
+
+def merge_windows(windows):
+    """
+    merges overlapping (row0, col0, row1, col1) windows until none overlap
+    """
+    windows = [list(w) for w in windows]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(windows)):
+            for j in range(i + 1, len(windows)):
+                a, b = windows[i], windows[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    windows[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del windows[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return sorted(tuple(w) for w in windows)
+
+
+def grid_windows(full, windows, pad=1):
+    """
+    (row0, col0, row1, col1) windows of the grid of full containing windows
+    (rasterio Windows of the same source grid as full), padded by pad pixels
+    and merged
+    """
+    full_height, full_width = int(full.height), int(full.width)
+
+    _windows = []
+    for _window in windows:
+        row0 = max(0, int(np.floor(_window.row_off - full.row_off)) - pad)
+        col0 = max(0, int(np.floor(_window.col_off - full.col_off)) - pad)
+        row1 = min(full_height, int(np.ceil(_window.row_off + _window.height - full.row_off)) + pad)
+        col1 = min(full_width, int(np.ceil(_window.col_off + _window.width - full.col_off)) + pad)
+        if row1 > row0 and col1 > col0:
+            _windows.append((row0, col0, row1, col1))
+
+    return merge_windows(_windows)
+
+
 def get_gz_scene_bounds(fn):
     assert _exists(fn), fn
     
@@ -52,11 +134,18 @@ class LandSatScene(object):
     The qa_pixel band and vegatiation documented here
     https://pubs.usgs.gov/fs/2015/3034/pdf/fs2015-3034.pdf
     """
+    def __new__(cls, fn):
+        # directories clipped to several windows open as a MultiWindowScene
+        if cls is LandSatScene and is_multi_window(fn):
+            cls = MultiWindowScene
+        return super(LandSatScene, cls).__new__(cls)
+
     def __init__(self, fn):
         if not _exists(fn):
             raise OSError
 
         self.tar = None
+        self._samples = None
 
         if os.path.isdir(fn):
             self.__open_dir(fn)
@@ -104,13 +193,34 @@ class LandSatScene(object):
     def bands(self):
         return [k for k in self._d.keys() if k != '.xml']
 
-    def __del__(self):
+    def close(self):
+        """
+        closes the datasets (and the archive) of the scene
+        """
         for key, ds in self._d.items():
             try:
                 ds.close()
             except:
                 pass
 
+        if self.tar is not None:
+            self.tar.close()
+            self.tar = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __del__(self):
+        # _d is not set if __init__ failed
+        for key, ds in getattr(self, '_d', {}).items():
+            try:
+                ds.close()
+            except:
+                pass
+
     def __open_targz(self, fn):
         assert fn.endswith('.tar.gz') or fn.endswith('.tar')
 
@@ -165,18 +275,7 @@ class LandSatScene(object):
         # dropping those bits for the sake of performance
 
 
-        if self.l2sp:
-            # ds = self.get_dataset('pixel_qa')
-            pixel_qa = np.array(self._d['qa_pixel'].read(1), dtype=np.uint16)
-            m, n = pixel_qa.shape
-            self.bqa = np.unpackbits(pixel_qa.view(np.uint8)).reshape((m, n, 16))
-            # self.bqa = np.concatenate((bqa[:, :, 8], bqa[:, :, :8]), axis=2)
-        else:
-            # ds = self.get_dataset('pixel_qa')
-            pixel_qa = np.array(self._d['pixel_qa'].read(1), dtype=np.uint16)
-            m, n = pixel_qa.shape
-            bqa = np.unpackbits(pixel_qa.view(np.uint8)).reshape((m, n, 16))
-            self.bqa = np.concatenate((bqa[:, :, 8:], bqa[:, :, :8]), axis=2)
+        self.bqa = unpack_qa(self._d[self.default_key].read(1), self.l2sp)
 
     @property
     def cellsize(self):
@@ -187,6 +286,15 @@ class LandSatScene(object):
         assert px_x == px_y
         return px_x
 
+    @property
+    def grid_signature(self):
+        """
+        hashable description of the raster grid. Scenes of the same wrs
+        path/row clipped to the same bounds have the same grid signature
+        """
+        src = self._d[self.default_key]
+        return src.crs.to_wkt(), tuple(src.transform)[:6], src.width, src.height
+
     def summary_dict(self):
         return dict(product_id=self.product_id, satellite=self.satellite,
                     acquisition_date=self.acquisition_date, wrs=self.wrs,
@@ -328,10 +436,7 @@ class LandSatScene(object):
 
     @property
     def qa_fill(self):
-        if self.l2sp:
-            return self.bqa[:, :, 0]
-        else:
-            return self.bqa[:, :, 15-0]
+        return qa_flag(self.bqa, 'fill', self.l2sp)
 
     @property
     def qa_notclear(self):
@@ -340,38 +445,23 @@ class LandSatScene(object):
 
     @property
     def qa_clear(self):
-        if self.l2sp:
-            return self.bqa[:, :, 6]
-        else:
-            return self.bqa[:, :, 15-1]
+        return qa_flag(self.bqa, 'clear', self.l2sp)
 
     @property
     def qa_water(self):
-        if self.l2sp:
-            return self.bqa[:, :, 7]
-        else:
-            return self.bqa[:, :, 15-2]
+        return qa_flag(self.bqa, 'water', self.l2sp)
 
     @property
     def qa_cloud_shadow(self):
-        if self.l2sp:
-            return self.bqa[:, :, 4]
-        else:
-            return self.bqa[:, :, 15-3]
+        return qa_flag(self.bqa, 'cloud_shadow', self.l2sp)
 
     @property
     def qa_snow(self):
-        if self.l2sp:
-            return self.bqa[:, :, 5]
-        else:
-            return self.bqa[:, :, 15-4]
+        return qa_flag(self.bqa, 'snow', self.l2sp)
 
     @property
     def qa_cloud(self):
-        if self.l2sp:
-            return self.bqa[:, :, 3]
-        else:
-            return self.bqa[:, :, 15-5]
+        return qa_flag(self.bqa, 'cloud', self.l2sp)
 
     @property
     def qa_cloud_confidence(self):
@@ -388,16 +478,23 @@ class LandSatScene(object):
             return self.bqa[:, :, 15-8] + 2.0 * self.bqa[:, :, 15-9]
 
     @property
-    def aerosol(self):
+    def aerosol_key(self):
+        """
+        band of the aerosol (or atmospheric opacity) qa
+        """
         if self.l2sp:
             assert self.satellite in [8, 9], self.satellite
-            return self._d['sr_qa_aerosol'].read(1, masked=True)
+            return 'sr_qa_aerosol'
 
         else:
             if self.satellite == 8:
-                return self._d['sr_aerosol'].read(1, masked=True)
+                return 'sr_aerosol'
             else:
-                return self._d['sr_atmos_opacity'].read(1, masked=True)
+                return 'sr_atmos_opacity'
+
+    @property
+    def aerosol(self):
+        return self._read_band(self.aerosol_key)
 
     def threshold_aerosol(self, threshold=101, mask=None):
         aero = self.aerosol
@@ -409,15 +506,85 @@ class LandSatScene(object):
         mask[np.where(aero > threshold)] = 1
         return mask
 
+    def _read_band(self, measure):
+        """
+        reads a band as a masked array. While sampling only the
+        sample windows are read (see sample)
+        """
+        if self._samples is None:
+            return self._d[measure].read(1, masked=True)
+
+        if measure not in self._samples:
+            src = self._d[measure]
+            size = self._sample_window
+            half = size // 2
+
+            data = []
+            for row, col in self._sample_px:
+                window = Window(col - half, row - half, size, size)
+                data.append(src.read(1, window=window, masked=True, boundless=True))
+
+            self._samples[measure] = np.ma.stack(data)
+
+        return self._samples[measure]
+
+    def sample(self, points, indices, window=1, crs='EPSG:4326'):
+        """
+        samples indices at points without computing the full scene
+
+        :param points: sequence of (x, y) coordinates
+        :param indices: sequence of index names (see get_index)
+        :param window: 1, 3, or 5. size of the window centered on the
+                       pixel containing each point. Windows are averaged
+        :param crs: crs of the points. None if the points are already
+                    in the crs of the scene
+        :return: list of dictionaries (one per point) with the row and col
+                 of the pixel and the value of each index. Values are None
+                 where the window is masked or the point is off the scene
+        """
+        assert window in (1, 3, 5), window
+
+        xs = [float(x) for x, y in points]
+        ys = [float(y) for x, y in points]
+
+        src = self._d[self.default_key]
+        if crs is not None:
+            xs, ys = transform(crs, src.crs, xs, ys)
+
+        rows, cols = rowcol(src.transform, xs, ys)
+
+        table = []
+        for (x, y), row, col in zip(points, rows, cols):
+            table.append(dict(x=x, y=y, row=int(row), col=int(col)))
+
+        n = len(table)
+        if n == 0:
+            return table
+
+        self._sample_px = list(zip(rows, cols))
+        self._sample_window = window
+        self._samples = {}
+        try:
+            for indexname in indices:
+                data = np.ma.masked_invalid(self.get_index(indexname))
+                values = np.ma.mean(data.reshape((n, -1)), axis=1)
+
+                for i, v in enumerate(values):
+                    table[i][indexname] = None if v is np.ma.masked else float(v)
+        finally:
+            self._samples = None
+
+        return table
+
     def _band_proc(self, measure):
         if self.l2sp:
-            data = self._d[measure].read(1, masked=True)
+            data = self._read_band(measure)
             print(np.min(data), np.max(data))
             data = np.ma.masked_less(data, 7273)
             data = np.ma.masked_greater(data, 43636)
             return data * 0.0000275 - 0.2
         else:
-            return np.abs(self._d[measure].read(1, masked=True))
+            return np.abs(self._read_band(measure))
 
     def _tasseled_cap_greenness__5(self):
         return -0.1603 * self._band_proc('sr_band1') + \
@@ -675,15 +842,16 @@ class LandSatScene(object):
                 count=3,
                 compress='lzw')
 
-            with rasterio.open(dst_fn, 'w', **profile) as dst:
-                dst.write(rgb.astype(rasterio.ubyte))
+            with atomic_output(dst_fn) as tmp_fn:
+                with rasterio.open(tmp_fn, 'w', **profile) as dst:
+                    dst.write(rgb.astype(rasterio.ubyte))
 
     def _veg_proc(self, measure):
 
         if self.l2sp:
             return self._band_proc(measure)
         else:
-            res = self._d[measure].read(1, masked=True)
+            res = self._read_band(measure)
             res = np.ma.masked_values(res, -9999.0)
             res = np.ma.array(res, dtype=np.float64)
             res *= 0.0001
@@ -822,20 +990,14 @@ class LandSatScene(object):
                 blockysize=512,
                 compress="PACKBITS")
 
-            with rasterio.open(dst_fn, 'w', **profile) as dst:
-                dst.write(_data.astype(dtype), 1)
-
-    def clip(self, bounds, outdir, bands=None):
-        """
-        crops the scene
-        """
-        assert outdir is not None
-        assert self.product_id is not None
-        outdir = _join(outdir, self.product_id)
+            with atomic_output(dst_fn) as tmp_fn:
+                with rasterio.open(tmp_fn, 'w', **profile) as dst:
+                    dst.write(_data.astype(dtype), 1)
 
+    def _clip_bands(self, bands):
         if bands is None:
             bands = self.bands
-        
+
         if not self.l2sp:
             bands = [k for k in bands if 'toa' not in k]
             bands = [k for k in bands if 'sensor' not in k]
@@ -852,11 +1014,45 @@ class LandSatScene(object):
             bands = [k for k in bands if 'b8' not in k]
             bands = [k for k in bands if 'bt_band6' not in k]
 
-        from rasterio.windows import Window
+        return bands
+
+    @staticmethod
+    def _clip_window(src, bounds):
+        """
+        window of src containing the wgs bounds
+        """
+        _bounds = transform_bounds('epsg:4326', src.crs, *bounds)
+        bounds_window = src.window(*_bounds)
+        bounds_window = bounds_window.intersection(
+            Window(0, 0, src.width, src.height))
+
+        # Get the window with integer height
+        # and width that contains the bounds window.
+        return bounds_window.round_lengths(op='ceil')
+
+    def _write_xml(self, outdir):
+        dst_fn = _join(outdir, '%s.xml' % self.product_id)
+        with atomic_output(dst_fn) as tmp_fn:
+            with open(tmp_fn, 'w') as fp:
+                fp.write(self._d['.xml'])
+
+    def clip(self, bounds, outdir, bands=None):
+        """
+        crops the scene
+        """
+        assert outdir is not None
+        assert self.product_id is not None
+        outdir = _join(outdir, self.product_id)
+
+        bands = self._clip_bands(bands)
+
+        # the clipped bands are replaced atomically. The outputs of the
+        # later stages in outdir are left in place
+        os.makedirs(outdir, exist_ok=True)
 
-        if _exists(outdir):
-            shutil.rmtree(outdir)
-        os.makedirs(outdir)
+        # the directory may have been clipped to windows before
+        if _exists(_join(outdir, _windows_fn)):
+            os.remove(_join(outdir, _windows_fn))
 
         for measure in self._d:
             try:
@@ -865,22 +1061,13 @@ class LandSatScene(object):
                 continue
 
             if '.xml' in measure:
-                dst_fn = _join(outdir, '%s.xml' % self.product_id)
-                with open(dst_fn, 'w') as fp:
-                    fp.write(src)
+                self._write_xml(outdir)
                 continue
 
             if measure is not None and measure not in bands:
                 continue
 
-            _bounds = transform_bounds('epsg:4326', src.crs, *bounds)
-            bounds_window = src.window(*_bounds)
-            bounds_window = bounds_window.intersection(
-                Window(0, 0, src.width, src.height))
-
-            # Get the window with integer height
-            # and width that contains the bounds window.
-            out_window = bounds_window.round_lengths(op='ceil')
+            out_window = self._clip_window(src, bounds)
 
             height = int(out_window.height)
             width = int(out_window.width)
@@ -894,9 +1081,379 @@ class LandSatScene(object):
                 compress='lzw')
 
             dst_fn = _join(outdir, '%s_%s.tif' % (self.product_id, measure))
-            with rasterio.open(dst_fn, 'w', **profile) as out:
-                out.write(src.read(window=out_window,
-                                   out_shape=(src.count, height, width)))
+            with atomic_output(dst_fn) as tmp_fn:
+                with rasterio.open(tmp_fn, 'w', **profile) as out:
+                    out.write(src.read(window=out_window,
+                                       out_shape=(src.count, height, width)))
 
         return LandSatScene(outdir)
 
+    def clip_windows(self, bounds, windows_bounds, outdir, bands=None, pad=1):
+        """
+        crops the scene to windows of the grid clip(bounds) produces, e.g.
+        one window per ranch of a site whose ranches are far apart.
+        Windows that overlap are merged. Every window is stored as a
+        scene in <outdir>/<product_id>/windows/w<i> and the directory opens
+        as a MultiWindowScene
+
+        :param windows_bounds: list of wgs bounds
+        :param pad: pixels added around each window
+        """
+        assert outdir is not None
+        assert self.product_id is not None
+
+        src = self.get_dataset(self.default_key)
+        full = self._clip_window(src, bounds)
+        full_height, full_width = int(full.height), int(full.width)
+
+        # windows as (row0, col0, row1, col1) in the clipped grid
+        windows = grid_windows(full, [src.window(*transform_bounds('epsg:4326', src.crs, *_bounds))
+                                      for _bounds in windows_bounds], pad=pad)
+        if len(windows) == 0:
+            return self.clip(bounds, outdir, bands=bands)
+
+        bands = self._clip_bands(bands)
+        outdir = _join(outdir, self.product_id)
+
+        for i, (row0, col0, row1, col1) in enumerate(windows):
+            window_dir = _join(outdir, 'windows', 'w%i' % i)
+            os.makedirs(window_dir, exist_ok=True)
+            self._write_xml(window_dir)
+
+            for measure in bands:
+                try:
+                    _src = self.get_dataset(measure)
+                except KeyError:
+                    continue
+
+                # offsets in the clipped grid of the band so the windows
+                # sample the same pixels as clip
+                _full = self._clip_window(_src, bounds)
+                out_window = Window(_full.col_off + col0, _full.row_off + row0, col1 - col0, row1 - row0)
+
+                height = row1 - row0
+                width = col1 - col0
+
+                profile = _src.profile
+                profile.update(
+                    driver='GTiff',
+                    height=height,
+                    width=width,
+                    transform=_src.window_transform(out_window),
+                    compress='lzw')
+
+                dst_fn = _join(window_dir, '%s_%s.tif' % (self.product_id, measure))
+                with atomic_output(dst_fn) as tmp_fn:
+                    with rasterio.open(tmp_fn, 'w', **profile) as out:
+                        out.write(_src.read(window=out_window,
+                                            out_shape=(_src.count, height, width)))
+
+        self._write_xml(outdir)
+        meta = dict(product_id=self.product_id, crs=src.crs.to_wkt(),
+                    transform=tuple(src.window_transform(full))[:6], width=full_width, height=full_height,
+                    windows=[(row0, col0, row1 - row0, col1 - col0) for row0, col0, row1, col1 in windows])
+        with atomic_output(_join(outdir, _windows_fn)) as tmp_fn:
+            with open(tmp_fn, 'w') as fp:
+                json.dump(meta, fp, indent=2)
+
+        return LandSatScene(outdir)
+
+
+
+class MultiWindowScene(LandSatScene):
+    """
+    Scene clipped to several windows of one grid (see
+    LandSatScene.clip_windows). LandSatScene(scn_dir) returns a
+    MultiWindowScene for these directories.
+
+    The bands, qa and indices are packed: arrays have shape (1, n) with
+    the pixels of the windows concatenated, so the BiomassModel and the
+    pasture analysis treat the windows as one scene. Grids are dumped as
+    sparse GeoTIFFs of the full grid (tiles outside of the windows are not
+    written and read as nodata).
+    """
+    def __init__(self, fn):
+        if not _exists(fn):
+            raise OSError
+
+        with open(_join(fn, _windows_fn)) as fp:
+            meta = json.load(fp)
+
+        self.tar = None
+        self._samples = None
+        self.isdir = True
+        self.basedir = fn
+        self.tar_fn = None
+        self.fn = fn
+        self.product_id = meta['product_id']
+        self._l2sp = '_l2sp_' in fn.lower()
+
+        self.crs = CRS.from_wkt(meta['crs'])
+        self.transform = Affine(*meta['transform'])
+        self.width = meta['width']
+        self.height = meta['height']
+
+        # (row_off, col_off, height, width) of the windows in the grid
+        self.window_offsets = [tuple(w) for w in meta['windows']]
+        self.windows = [LandSatScene(_join(fn, 'windows', 'w%i' % i)) for i in range(len(self.window_offsets))]
+        self._d = {'.xml': self.windows[0]['.xml']}
+
+        self.bqa = np.concatenate([w.bqa.reshape((1, -1, 16)) for w in self.windows], axis=1)
+
+        self._template = None
+        self._template_file = None
+
+    @property
+    def bands(self):
+        return self.windows[0].bands
+
+    def close(self):
+        for w in self.windows:
+            w.close()
+
+        if self._template is not None:
+            self._template.close()
+            self._template_file.close()
+            self._template = self._template_file = None
+
+    def pack(self, arrays):
+        """
+        packs arrays of the windows (in window order) into a (1, n) array
+        """
+        if any(isinstance(a, np.ma.core.MaskedArray) for a in arrays):
+            return np.ma.concatenate([a.reshape((1, -1)) for a in arrays], axis=1)
+        return np.concatenate([np.reshape(a, (1, -1)) for a in arrays], axis=1)
+
+    def unpack(self, data):
+        """
+        splits a packed array (..., 1, n) into arrays (..., height, width) of the windows
+        """
+        arrays = []
+        i = 0
+        for row_off, col_off, height, width in self.window_offsets:
+            arrays.append(data[..., i:i + height * width].reshape(data.shape[:-2] + (height, width)))
+            i += height * width
+        return arrays
+
+    def _read_band(self, measure):
+        return self.pack([w._read_band(measure) for w in self.windows])
+
+    @property
+    def cellsize(self):
+        px_x = self.transform.a
+        px_y = -self.transform.e
+
+        assert px_x == px_y
+        return px_x
+
+    @property
+    def grid_signature(self):
+        return self.crs.to_wkt(), tuple(self.transform)[:6], self.width, self.height, tuple(self.window_offsets)
+
+    @property
+    def bounds(self):
+        left, bottom, right, top = array_bounds(self.height, self.width, self.transform)
+        return [left, bottom, right, top]
+
+    @property
+    def proj4(self):
+        return self.crs.to_proj4()
+
+    @property
+    def wgs_bounds(self):
+        return transform_bounds(self.crs, 'EPSG:4326', *self.bounds)
+
+    @property
+    def template_ds(self):
+        """
+        template rasterio.Dataset of the full grid. It is held in memory
+        and sparse, its tiles read as nodata
+        """
+        if self._template is None:
+            profile = self.windows[0][self.default_key].profile
+            profile.update(driver='GTiff', height=self.height, width=self.width, transform=self.transform,
+                           tiled=True, blockxsize=512, blockysize=512, sparse_ok=True)
+            self._template_file = MemoryFile()
+            self._template = self._template_file.open(**profile)
+        return self._template
+
+    def _dump_windows(self, data, dst_fn, profile):
+        """
+        writes a packed (count, 1, n) array to a sparse GeoTIFF of the full grid
+        """
+        profile.update(driver='GTiff', height=self.height, width=self.width, transform=self.transform,
+                       tiled=True, blockxsize=512, blockysize=512, sparse_ok=True)
+
+        with atomic_output(dst_fn) as tmp_fn:
+            with rasterio.open(tmp_fn, 'w', **profile) as dst:
+                for (row_off, col_off, height, width), _data in zip(self.window_offsets, self.unpack(data)):
+                    dst.write(_data, window=Window(col_off, row_off, width, height))
+
+    def dump(self, data, dst_fn, nodata=-9999, dtype=rasterio.float32):
+        assert _exists(_split(dst_fn)[0])
+
+        if isinstance(data, np.ma.core.MaskedArray):
+            data.fill_value = nodata
+            _data = data.filled()
+        else:
+            _data = data
+
+        profile = self.windows[0][self.default_key].profile
+        profile.update(dtype=dtype, count=1, nodata=nodata, interleave="pixel", compress="PACKBITS")
+        self._dump_windows(np.reshape(_data.astype(dtype), (1,) + _data.shape), dst_fn, profile)
+
+    def dump_rgb(self, dst_fn, gamma=None):
+        rgb = self.rgb
+        if gamma is not None:
+            rgb = np.power(rgb, 1.0/gamma)
+
+        rgb = np.array(rgb * 255, dtype=np.uint8)
+
+        profile = self.windows[0][self.default_key].profile
+        profile.update(dtype=rasterio.ubyte, count=3, compress='lzw')
+        self._dump_windows(rgb, dst_fn, profile)
+
+    def dump_band(self, measure, dst_fn):
+        """
+        writes a band of the windows to a sparse GeoTIFF of the full grid
+        """
+        src = self.windows[0][measure]
+        profile = src.profile
+        profile.update(compress='lzw')
+
+        data = np.concatenate([w[measure].read().reshape((src.count, 1, -1)) for w in self.windows], axis=2)
+        self._dump_windows(data, dst_fn, profile)
+
+    def _grid_window(self, bounds):
+        """
+        window of the full grid containing the wgs bounds
+        """
+        _bounds = transform_bounds('epsg:4326', self.crs, *bounds)
+        window = from_bounds(*_bounds, transform=self.transform)
+        window = window.intersection(Window(0, 0, self.width, self.height))
+        return window.round_offsets(op='floor').round_lengths(op='ceil')
+
+    def _write_grid_window(self, measure, window, dst_fn):
+        """
+        writes a window of the full grid of a band. Pixels outside of the
+        windows of the scene are nodata (0 without nodata)
+        """
+        src = self.windows[0][measure]
+        row_off, col_off = int(window.row_off), int(window.col_off)
+        height, width = int(window.height), int(window.width)
+
+        data = np.full((src.count, height, width), 0 if src.nodata is None else src.nodata, dtype=src.dtypes[0])
+        for (_row_off, _col_off, _height, _width), scn in zip(self.window_offsets, self.windows):
+            row0, row1 = max(row_off, _row_off), min(row_off + height, _row_off + _height)
+            col0, col1 = max(col_off, _col_off), min(col_off + width, _col_off + _width)
+            if row1 <= row0 or col1 <= col0:
+                continue
+
+            data[:, row0 - row_off:row1 - row_off, col0 - col_off:col1 - col_off] = \
+                scn[measure].read(window=Window(col0 - _col_off, row0 - _row_off, col1 - col0, row1 - row0))
+
+        profile = src.profile
+        profile.update(
+            driver='GTiff',
+            height=height,
+            width=width,
+            transform=window_transform(window, self.transform),
+            compress='lzw')
+
+        with atomic_output(dst_fn) as tmp_fn:
+            with rasterio.open(tmp_fn, 'w', **profile) as out:
+                out.write(data)
+
+    def clip(self, bounds, outdir, bands=None):
+        """
+        crops the scene to a single grid. The pixels outside of the
+        windows are nodata
+        """
+        assert outdir is not None
+        outdir = _join(outdir, self.product_id)
+        assert os.path.abspath(outdir) != os.path.abspath(self.basedir)
+
+        bands = self._clip_bands(bands)
+        os.makedirs(outdir, exist_ok=True)
+
+        # the directory may have been clipped to windows before
+        if _exists(_join(outdir, _windows_fn)):
+            os.remove(_join(outdir, _windows_fn))
+
+        window = self._grid_window(bounds)
+        self._write_xml(outdir)
+        for measure in bands:
+            self._write_grid_window(measure, window, _join(outdir, '%s_%s.tif' % (self.product_id, measure)))
+
+        return LandSatScene(outdir)
+
+    def clip_windows(self, bounds, windows_bounds, outdir, bands=None, pad=1):
+        """
+        crops the scene to windows of the grid clip(bounds) produces (see
+        LandSatScene.clip_windows)
+        """
+        assert outdir is not None
+        full = self._grid_window(bounds)
+
+        windows = grid_windows(full, [from_bounds(*transform_bounds('epsg:4326', self.crs, *_bounds),
+                                                  transform=self.transform)
+                                      for _bounds in windows_bounds], pad=pad)
+        if len(windows) == 0:
+            return self.clip(bounds, outdir, bands=bands)
+
+        bands = self._clip_bands(bands)
+        outdir = _join(outdir, self.product_id)
+        assert os.path.abspath(outdir) != os.path.abspath(self.basedir)
+
+        for i, (row0, col0, row1, col1) in enumerate(windows):
+            window_dir = _join(outdir, 'windows', 'w%i' % i)
+            os.makedirs(window_dir, exist_ok=True)
+            self._write_xml(window_dir)
+
+            window = Window(full.col_off + col0, full.row_off + row0, col1 - col0, row1 - row0)
+            for measure in bands:
+                self._write_grid_window(measure, window, _join(window_dir, '%s_%s.tif' % (self.product_id, measure)))
+
+        self._write_xml(outdir)
+        meta = dict(product_id=self.product_id, crs=self.crs.to_wkt(),
+                    transform=tuple(window_transform(full, self.transform))[:6],
+                    width=int(full.width), height=int(full.height),
+                    windows=[(row0, col0, row1 - row0, col1 - col0) for row0, col0, row1, col1 in windows])
+        with atomic_output(_join(outdir, _windows_fn)) as tmp_fn:
+            with open(tmp_fn, 'w') as fp:
+                json.dump(meta, fp, indent=2)
+
+        return LandSatScene(outdir)
+
+    def sample(self, points, indices, window=1, crs='EPSG:4326'):
+        """
+        samples indices at points (see LandSatScene.sample). Every point is
+        sampled from the window containing it, the values of the points
+        outside of the windows are None
+        """
+        assert window in (1, 3, 5), window
+
+        xs = [float(x) for x, y in points]
+        ys = [float(y) for x, y in points]
+        if crs is not None:
+            xs, ys = transform(crs, self.crs, xs, ys)
+
+        rows, cols = rowcol(self.transform, xs, ys)
+
+        table = []
+        for (x, y), row, col in zip(points, rows, cols):
+            d = dict(x=x, y=y, row=int(row), col=int(col))
+            d.update((indexname, None) for indexname in indices)
+            table.append(d)
+
+        for (row_off, col_off, height, width), scn in zip(self.window_offsets, self.windows):
+            inside = [i for i, d in enumerate(table)
+                      if row_off <= d['row'] < row_off + height and col_off <= d['col'] < col_off + width]
+            if len(inside) == 0:
+                continue
+
+            samples = scn.sample([(xs[i], ys[i]) for i in inside], indices, window=window, crs=None)
+            for i, sample in zip(inside, samples):
+                table[i].update((indexname, sample[indexname]) for indexname in indices)
+
+        return table
@@ -0,0 +1,239 @@
+"""
+Mosaicking of same-date scenes from overlapping WRS paths/rows.
+
+Archives acquired on the same date by the same sensor (e.g. 042028 and
+043028) that intersect the site are processed as one scene. Every archive
+is clipped to the site and the clipped scenes are merged onto the grid of
+the primary scene (the one with the most clear pixels over the site).
+For every pixel the first scene in priority order (the primary, then by
+number of clear pixels) that is clear wins. Pixels that are not clear in
+any scene are taken from the first scene that is not fill, so the qa
+masks of the mosaic still exclude them.
+
+The mosaic is written to <out_dir>/<product_id of the primary> with the
+bands and qa of the merged scenes and a mosaic.json listing the members.
+"""
+
+import os
+import json
+import shutil
+import tarfile
+
+from os.path import join as _join
+from os.path import split as _split
+
+import numpy as np
+import rasterio
+from rasterio.transform import Affine
+from rasterio.warp import reproject, transform_bounds, Resampling
+
+from biomass.landsat import LandSatScene, get_gz_scene_bounds
+from biomass.checkpoint import atomic_output
+from database.manifest import archive_name
+from all_your_base import bounds_intersect
+
+
+def same_date_key(fn):
+    """
+    returns (sensor, acquisition date) of an archive, e.g. ('LC08', '20200601')
+    for LC08_L2SP_042028_20200601_20200610_02_T1.tar
+    """
+    name = archive_name(fn)
+    if '_' in name:
+        tokens = name.split('_')
+        return tokens[0], tokens[3]
+
+    # pre-collection ESPA names, e.g. LC080420282020082701T1-SC20201117120000
+    return name[:4], name[10:18]
+
+
+def group_same_date(fns, bbox=None):
+    """
+    groups the archives of fns that were acquired on the same date by the
+    same sensor. If bbox is specified archives that do not intersect it
+    are left ungrouped (they are skipped when they are processed)
+
+    :return: list of archives (str) and same-date groups (tuple of archives)
+             in the order of fns
+    """
+    groups = {}
+    keys = []
+    for fn in fns:
+        if bbox is not None and not bounds_intersect(bbox, get_gz_scene_bounds(fn)):
+            keys.append(fn)
+            continue
+
+        key = same_date_key(fn)
+        if key not in groups:
+            groups[key] = []
+            keys.append(key)
+        groups[key].append(fn)
+
+    items = []
+    for key in keys:
+        if isinstance(key, str):
+            items.append(key)
+        elif len(groups[key]) == 1:
+            items.append(groups[key][0])
+        else:
+            items.append(tuple(sorted(groups[key])))
+    return items
+
+
+def _target_grid(scenes, primary):
+    """
+    grid in the crs of the primary scene, aligned to its pixels, that
+    covers the clipped extents of all of the scenes
+    """
+    src = primary[primary.default_key]
+    crs = src.crs
+    t = src.transform
+
+    lefts, bottoms, rights, tops = [], [], [], []
+    for ls in scenes:
+        _src = ls[ls.default_key]
+        left, bottom, right, top = transform_bounds(_src.crs, crs, *_src.bounds)
+        lefts.append(left)
+        bottoms.append(bottom)
+        rights.append(right)
+        tops.append(top)
+
+    col0 = int(np.floor(round((min(lefts) - t.c) / t.a, 6)))
+    col1 = int(np.ceil(round((max(rights) - t.c) / t.a, 6)))
+    row0 = int(np.floor(round((max(tops) - t.f) / t.e, 6)))
+    row1 = int(np.ceil(round((min(bottoms) - t.f) / t.e, 6)))
+
+    transform = t * Affine.translation(col0, row0)
+    return crs, transform, col1 - col0, row1 - row0
+
+
+def _warp(data, src, dst_crs, dst_transform, shape, fill=0):
+    """
+    nearest neighbour resampling of a band of src onto the target grid
+    """
+    if src.crs == dst_crs and src.transform == dst_transform and data.shape == shape:
+        return data
+
+    dst = np.full(shape, fill, dtype=data.dtype)
+    reproject(source=data, destination=dst,
+              src_transform=src.transform, src_crs=src.crs,
+              dst_transform=dst_transform, dst_crs=dst_crs,
+              src_nodata=None, dst_nodata=None, init_dest_nodata=False,
+              resampling=Resampling.nearest)
+    return dst
+
+
+def mosaic_scenes(scn_dirs, out_dir):
+    """
+    merges clipped scenes of the same date into out_dir/<primary product_id>
+
+    :param scn_dirs: directories of the clipped scenes
+    :return: (LandSatScene of the mosaic, summary dict)
+    """
+    scenes = [LandSatScene(scn_dir) for scn_dir in scn_dirs]
+    clear = [int(np.sum(ls.qa_clear)) for ls in scenes]
+
+    # scenes in priority order, ties are broken by product_id
+    order = sorted(range(len(scenes)), key=lambda i: (-clear[i], scenes[i].product_id))
+    scenes = [scenes[i] for i in order]
+    clear = [clear[i] for i in order]
+    primary = scenes[0]
+
+    crs, transform, width, height = _target_grid(scenes, primary)
+    shape = (height, width)
+
+    def _grid(ls, data):
+        return _warp(np.array(data, dtype=np.uint8), ls[ls.default_key], crs, transform, shape)
+
+    # the scene every pixel of the mosaic is taken from (-1 where no scene
+    # has data)
+    choice = np.full(shape, -1, dtype=np.int16)
+    valid = []
+    for i, ls in enumerate(scenes):
+        covered = _grid(ls, np.ones(ls.qa_fill.shape))
+        valid.append((covered == 1) & (_grid(ls, ls.qa_fill) == 0))
+
+        indx = (choice == -1) & valid[i] & (_grid(ls, ls.qa_clear) == 1)
+        choice[indx] = i
+
+    for i in range(len(scenes)):
+        choice[(choice == -1) & valid[i]] = i
+
+    product_id = primary.product_id
+    dst_dir = _join(out_dir, product_id)
+    os.makedirs(dst_dir, exist_ok=True)
+
+    # bands present in every scene
+    bands = [k for k in primary.bands if all(k in ls.bands for ls in scenes)]
+    for measure in bands:
+        src = primary[measure]
+        profile = src.profile
+        profile.update(driver='GTiff', height=height, width=width, transform=transform, compress='lzw')
+
+        nodata = src.nodata
+        if nodata is None:
+            nodata = 0
+
+        data = np.full((src.count, height, width), nodata, dtype=src.dtypes[0])
+        for i, ls in enumerate(scenes):
+            _src = ls[measure]
+            indx = choice == i
+            if not np.any(indx):
+                continue
+
+            for b in range(_src.count):
+                data[b][indx] = _warp(_src.read(b + 1), _src, crs, transform, shape, fill=nodata)[indx]
+
+        dst_fn = _join(dst_dir, '%s_%s.tif' % (product_id, measure))
+        with atomic_output(dst_fn) as tmp_fn:
+            with rasterio.open(tmp_fn, 'w', **profile) as dst:
+                dst.write(data)
+
+    dst_fn = _join(dst_dir, '%s.xml' % product_id)
+    with atomic_output(dst_fn) as tmp_fn:
+        with open(tmp_fn, 'w') as fp:
+            fp.write(primary['.xml'])
+
+    summary = dict(product_id=product_id,
+                   members=[ls.product_id for ls in scenes],
+                   clear_px=clear,
+                   mosaic_px=[int(np.sum(choice == i)) for i in range(len(scenes))],
+                   nodata_px=int(np.sum(choice == -1)))
+
+    with atomic_output(_join(dst_dir, 'mosaic.json')) as tmp_fn:
+        with open(tmp_fn, 'w') as fp:
+            json.dump(summary, fp, indent=2)
+
+    scenes = primary = None
+    return LandSatScene(dst_dir), summary
+
+
+def mosaic_archives(scn_fns, bbox, out_dir, scratch):
+    """
+    extracts and clips the archives of a same-date group one at a time and
+    merges them into out_dir. The clipped scenes are kept in
+    <out_dir>/.mosaic until the mosaic is written
+
+    :param scratch: ScratchManager the archives are extracted with
+    :return: (LandSatScene of the mosaic, summary dict)
+    """
+    tmp_dir = _join(out_dir, '.mosaic', archive_name(scn_fns[0]))
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    try:
+        scn_dirs = []
+        for scn_fn in scn_fns:
+            with scratch.reserve(scn_fn) as scn_path:
+                print('extracting', scn_fn)
+                with tarfile.open(scn_fn) as tar:
+                    tar.extractall(path=scn_path)
+
+                _ls = LandSatScene(scn_path)
+                print('clip', _ls.product_id)
+                scn_dirs.append(_ls.clip(bbox, tmp_dir).basedir)
+                _ls = None
+
+        print('mosaicking', ', '.join(_split(d)[-1] for d in scn_dirs))
+        return mosaic_scenes(scn_dirs, out_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
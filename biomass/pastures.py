@@ -0,0 +1,237 @@
+"""
+Incremental updates of the pasture stats when the pasture shapefile of a
+site changes.
+
+Every pasture is fingerprinted by its key and geometry. The fingerprints
+the stats were computed with are kept in <out_dir>/pasture_fingerprints.json.
+When the shapefile is edited only the pastures that were added or whose
+geometry changed are analyzed again, from the clipped scenes already in
+out_dir (nothing is extracted) with the masks of just those pastures
+rasterized once per grid. The rows of removed pastures are deleted.
+The rows of the other pastures, in the database and the csvs, are left
+as they are. The fingerprints are recorded when the stats of the first
+scene of a site are written (see SiteConfig.record_pasture_fingerprints).
+
+If the biomass grids of a scene are up to date with the config, its
+pasture_stats checkpoint and fingerprint are advanced to the new
+shapefile so the planner (biomass.planner) does not list it as stale.
+"""
+
+import os
+import csv
+import json
+import traceback
+
+from os.path import join as _join
+from os.path import exists as _exists
+
+import fiona
+from rasterio.warp import transform_bounds
+
+from biomass.landsat import LandSatScene, MultiWindowScene
+from biomass.rangesat_biomass import BiomassModel
+from biomass.checkpoint import StageCheckpoints, atomic_output, input_hash
+from biomass.ingest import pasture_stats_rows, _pasture_stats_fieldnames, config_fingerprint, stage_hashes, \
+    scene_name, scene_members, write_fingerprint
+from biomass.planner import product_scenes
+from database.pasturestats_db import update_scene_pastures, touch_cache_stamp
+
+
+_fingerprints_fn = 'pasture_fingerprints.json'
+
+
+def _geometry(geometry):
+    if geometry['type'] == 'GeometryCollection':
+        return dict(type=geometry['type'], geometries=[_geometry(g) for g in geometry['geometries']])
+    return dict(type=geometry['type'], coordinates=geometry['coordinates'])
+
+
+def pasture_fingerprints(sf, sf_feature_properties_key):
+    """
+    returns a dict of key -> sha1 of the key, geometry and crs of every
+    pasture of an opened shapefile
+    """
+    fingerprints = {}
+    for feature in sf:
+        key = feature['properties'][sf_feature_properties_key]
+        fingerprints[key] = input_hash(key, sf.crs_wkt, _geometry(feature['geometry']))
+    return fingerprints
+
+
+def fingerprints_recorded(out_dir):
+    return _exists(_join(out_dir, _fingerprints_fn))
+
+
+def load_fingerprints(out_dir):
+    """
+    fingerprints the pasture stats of out_dir were computed with or None
+    """
+    fn = _join(out_dir, _fingerprints_fn)
+    if not _exists(fn):
+        return None
+
+    with open(fn) as fp:
+        return json.load(fp)['pastures']
+
+
+def save_fingerprints(out_dir, fingerprints, sf_fn=None):
+    with atomic_output(_join(out_dir, _fingerprints_fn)) as tmp_fn:
+        with open(tmp_fn, 'w') as fp:
+            json.dump(dict(sf_fn=sf_fn, pastures=fingerprints), fp, indent=2, sort_keys=True)
+
+
+def diff_fingerprints(previous, current):
+    """
+    :return: (added, modified, removed) sorted lists of keys
+    """
+    added = sorted(k for k in current if k not in previous)
+    modified = sorted(k for k in current if k in previous and current[k] != previous[k])
+    removed = sorted(k for k in previous if k not in current)
+    return added, modified, removed
+
+
+def update_stats_csv(stats_fn, rows, keys):
+    """
+    replaces the rows of keys in a pasture stats csv with rows
+
+    :param rows: dicts with the _pasture_stats_fieldnames
+    """
+    with open(stats_fn, newline='') as fp:
+        reader = csv.reader(fp)
+        header = next(reader)
+        kept = [row for row in reader if row[1] not in keys]
+
+    with atomic_output(stats_fn) as tmp_fn:
+        with open(tmp_fn, 'w', newline='') as fp:
+            writer = csv.writer(fp)
+            writer.writerow(header)
+            writer.writerows(kept)
+
+            writer = csv.DictWriter(fp, fieldnames=_pasture_stats_fieldnames)
+            for row in rows:
+                writer.writerow(row)
+
+
+def pasture_bounds(sf, sf_feature_properties_key, keys):
+    """
+    returns a dict of key -> bounds of the pastures with keys
+    """
+    return {feature['properties'][sf_feature_properties_key]: fiona.bounds(feature) for feature in sf
+            if feature['properties'][sf_feature_properties_key] in keys}
+
+
+def outside_pastures(ls, sf_crs, bounds):
+    """
+    returns the keys of the pastures that are not within the clipped grid
+    (or one of the windows) of a scene. They can only be analyzed once the
+    scene is clipped again
+    """
+    grids = ls.windows if isinstance(ls, MultiWindowScene) else [ls]
+
+    outside = []
+    for key, _bounds in sorted(bounds.items()):
+        left, bottom, right, top = transform_bounds(sf_crs, ls.proj4, *_bounds)
+        if not any(left >= g.bounds[0] and bottom >= g.bounds[1] and right <= g.bounds[2] and top <= g.bounds[3]
+                   for g in grids):
+            outside.append(key)
+    return outside
+
+
+def _stats_fn(cfg, archives):
+    # the csv of a mosaic is named after its first archive
+    for archive in archives:
+        fn = _join(cfg.out_dir, '%s_pasture_stats.csv' % archive)
+        if _exists(fn):
+            return fn
+    return None
+
+
+def _stats_checkpoint(cfg, scn_fn):
+    """
+    returns (checkpoints, fingerprint, hashes) of a scene whose biomass
+    grids are up to date with cfg or None
+    """
+    if scn_fn is None or not all(_exists(fn) for fn in scene_members(scn_fn)):
+        return None
+
+    checkpoints = StageCheckpoints.for_archive(cfg.out_dir, scene_name(scn_fn))
+    fingerprint = config_fingerprint(scn_fn, cfg)
+    hashes = stage_hashes(scn_fn, cfg, fingerprint)
+    if not checkpoints.is_done('biomass', hashes['biomass']):
+        return None
+    return checkpoints, fingerprint, hashes
+
+
+def update_pastures(cfg, manifest, added, modified, removed, processes=None):
+    """
+    updates the pasture stats of the scenes processed for a site after its
+    shapefile changed
+
+    :param cfg: SiteConfig (with the new shapefile)
+    :param manifest: ProcessingManifest of cfg.out_dir
+    :param processes: worker processes for the pasture analysis
+    :return: list of dict(product_id, status, rows, error)
+    """
+    changed = set(added) | set(modified)
+    keys = changed | set(removed)
+
+    products = {product_id: archives for product_id, archives in manifest.done().items()
+                if _exists(_join(cfg.out_dir, product_id))}
+    scenes = product_scenes(manifest)
+
+    def _update(product_id, results):
+        rows = list(pasture_stats_rows(results))
+        checkpoint = _stats_checkpoint(cfg, scenes.get(product_id))
+        if cfg.update_db:
+            update_scene_pastures(cfg.out_dir, product_id, [[row.get(k) for k in _pasture_stats_fieldnames]
+                                                            for row in rows], keys,
+                                  key_delimiter=cfg.sf_feature_properties_delimiter,
+                                  reverse_key=cfg.reverse_key,
+                                  config_hash=None if checkpoint is None else checkpoint[2]['pasture_stats'])
+
+        stats_fn = _stats_fn(cfg, products[product_id])
+        if stats_fn is not None:
+            update_stats_csv(stats_fn, rows, keys)
+
+        if checkpoint is not None:
+            checkpoints, fingerprint, hashes = checkpoint
+            checkpoints.mark_done('pasture_stats', hashes['pasture_stats'], [stats_fn] if stats_fn else [],
+                                  config=fingerprint)
+            write_fingerprint(_join(cfg.out_dir, product_id), fingerprint, hashes)
+
+        return dict(product_id=product_id, status='updated', rows=len(rows), error=None)
+
+    summary = []
+    if len(changed) == 0:
+        for product_id in sorted(products):
+            summary.append(_update(product_id, []))
+    else:
+        bounds = pasture_bounds(cfg.sf, cfg.sf_feature_properties_key, changed)
+
+        scn_dirs = []
+        for product_id in sorted(products):
+            outside = outside_pastures(LandSatScene(_join(cfg.out_dir, product_id)), cfg.sf.crs_wkt, bounds)
+            if len(outside) > 0:
+                summary.append(dict(product_id=product_id, status='failed', rows=0,
+                                    error='%s extend beyond the clipped scene, it needs to be processed again'
+                                          % ', '.join(outside)))
+            else:
+                scn_dirs.append(_join(cfg.out_dir, product_id))
+
+        for res in BiomassModel.analyze_many(scn_dirs, cfg.models, cfg.sf, cfg.sf_feature_properties_key,
+                                             cfg.sf_feature_properties_delimiter, processes=processes,
+                                             keys=changed):
+            product_id = os.path.basename(res['scn_dir'])
+            if 'error' in res:
+                summary.append(dict(product_id=product_id, status='failed', rows=0, error=res['error']))
+                continue
+
+            try:
+                summary.append(_update(product_id, [res]))
+            except Exception:
+                summary.append(dict(product_id=product_id, status='failed', rows=0, error=traceback.format_exc()))
+
+    if len(summary) > 0:
+        touch_cache_stamp(cfg.out_dir)
+
+    return summary
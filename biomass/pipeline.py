@@ -0,0 +1,294 @@
+"""
+Pipelined scene ingestion.
+
+process_scene runs the steps of a scene strictly in sequence. The
+ScenePipeline splits them into three stages connected by bounded queues
+so the stages of different scenes overlap:
+
+    extract   extract the archive to SCRATCH, clip and dump the rgb (I/O)
+    model     biomass models, pasture analysis and summary (CPU)
+    write     export the grids, reproject and write the pasture stats (I/O)
+
+Every stage has its own number of worker threads. When a downstream stage
+falls behind its queue fills up and the upstream workers block
+(back-pressure), so at most extract workers scenes are in SCRATCH and at
+most queue_size clipped scenes wait in memory between stages.
+
+A status line with the utilization of each stage is printed every
+status_interval seconds: a stage that is near 100% busy is the bottleneck,
+a stage that spends its time blocked on a full queue can have fewer
+workers.
+
+The model stage threads share the GIL. numpy releases it in the array
+operations but the per-pasture loops of BiomassModel.analyze_pastures
+run one at a time, and every model worker holds the arrays of a scene
+in memory. More than DEFAULT_MODEL_WORKERS model workers rarely helps,
+the pipeline overlaps I/O with modelling rather than using every core.
+For CPU bound batches the ScenePool runs a process per scene.
+
+Unlike the ScenePool the stages run in threads of a single process, a
+fatal error (e.g. a GDAL segfault) stops the pipeline. Scenes that were in
+flight are left as processing in the manifest and are claimed again once
+they are stale.
+"""
+
+import queue
+import threading
+import traceback
+from time import time
+
+from biomass.ingest import extract_and_clip, model_scene, write_scene, claim_scene, record_result, fail_scene
+
+
+_STOP = object()
+
+# model stage threads (see the GIL note above)
+DEFAULT_MODEL_WORKERS = 2
+
+
+class PipelineStage(object):
+    """
+    a pool of worker threads running func on the items of inbox
+
+    :param func: func(ctx) returns the ctx for the next stage or a result
+                 dict (with 'status') when the scene is finished
+    """
+    def __init__(self, name, func, workers, inbox, outbox):
+        assert workers > 0, workers
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.inbox = inbox
+        self.outbox = outbox
+
+        self.processed = 0
+        self.busy = 0.0     # seconds spent running func
+        self.blocked = 0.0  # seconds spent waiting on a full outbox
+        self._running = {}  # thread ident -> start time
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self, pipeline):
+        # the utilization is reported per run
+        self.processed = 0
+        self.busy = 0.0
+        self.blocked = 0.0
+
+        for i in range(self.workers):
+            t = threading.Thread(target=self._work, args=(pipeline,),
+                                 name='%s-%i' % (self.name, i), daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self):
+        for _ in self._threads:
+            self.inbox.put(_STOP)
+
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def _work(self, pipeline):
+        ident = threading.get_ident()
+        while True:
+            ctx = self.inbox.get()
+            if ctx is _STOP:
+                return
+
+            t0 = time()
+            with self._lock:
+                self._running[ident] = t0
+
+            try:
+                ctx = self.func(ctx)
+            except Exception:
+                ctx = self._fail(pipeline, ctx, traceback.format_exc())
+
+            t1 = time()
+            with self._lock:
+                del self._running[ident]
+                self.busy += t1 - t0
+                self.processed += 1
+
+            if 'status' in ctx:
+                self._finish(pipeline, ctx)
+            else:
+                self.outbox.put(ctx)
+                with self._lock:
+                    self.blocked += time() - t1
+
+    @staticmethod
+    def _fail(pipeline, ctx, error):
+        # the scene is failed even if the failure can't be recorded in the
+        # manifest, run() waits for a result of every scene
+        try:
+            return pipeline.fail(ctx, error)
+        except Exception:
+            return dict(scn_fn=ctx['scn_fn'], t0=ctx['t0'], status='failed',
+                        error=error + '\nrecording the failure failed:\n' + traceback.format_exc())
+
+    @staticmethod
+    def _finish(pipeline, res):
+        try:
+            pipeline.finish(res)
+        except Exception:
+            pipeline._results.put(dict(scn_fn=res.get('scn_fn'), t0=res.get('t0', time()), status='failed',
+                                       error=traceback.format_exc()))
+
+    def stats(self, elapsed):
+        """
+        returns dict(active, queued, processed, busy_pct, blocked_pct)
+        """
+        now = time()
+        with self._lock:
+            active = len(self._running)
+            busy = self.busy + sum(now - t0 for t0 in self._running.values())
+            blocked = self.blocked
+            processed = self.processed
+
+        capacity = max(elapsed * self.workers, 1e-9)
+        return dict(active=active, queued=self.inbox.qsize(), processed=processed,
+                    busy_pct=100.0 * busy / capacity, blocked_pct=100.0 * blocked / capacity)
+
+
+class ScenePipeline(object):
+    """
+    :param cfg: SiteConfig
+    :param manifest: ProcessingManifest of cfg.out_dir
+    :param extract_workers: concurrent extract/clip (limited by SCRATCH space)
+    :param model_workers: concurrent modelling/pasture analysis threads
+    :param write_workers: concurrent grid export/reprojection
+    :param queue_size: clipped/modelled scenes that can wait between stages
+    :param status_interval: seconds between status lines (None to disable)
+    :param retry_failed: claim scenes that failed previously
+    """
+    def __init__(self, cfg, manifest, extract_workers=2, model_workers=DEFAULT_MODEL_WORKERS, write_workers=2,
+                 queue_size=2, status_interval=60, retry_failed=True):
+        self.cfg = cfg
+        self.manifest = manifest
+        self.status_interval = status_interval
+        self.retry_failed = retry_failed
+
+        # the extract queue only holds archive names, it is bounded so
+        # scenes are claimed as they are needed
+        to_extract = queue.Queue(maxsize=extract_workers)
+        to_model = queue.Queue(maxsize=queue_size)
+        to_write = queue.Queue(maxsize=queue_size)
+
+        self.stages = [
+            PipelineStage('extract', self._extract, extract_workers, to_extract, to_model),
+            PipelineStage('model', self._model, model_workers, to_model, to_write),
+            PipelineStage('write', self._write, write_workers, to_write, None)]
+
+        self._results = queue.Queue()
+        self._closing = threading.Event()
+        self._t0 = None
+
+    def _extract(self, ctx):
+        scn_fn = claim_scene(ctx['scn_fn'], self.cfg, self.manifest, retry_failed=self.retry_failed)
+        if scn_fn is None:
+            return dict(ctx, status='claimed')
+        ctx['scn_fn'] = scn_fn
+
+        clipped = extract_and_clip(scn_fn, self.cfg)
+        if clipped['status'] in ('no-overlap', 'low-coverage'):
+            res = dict(clipped, t0=ctx['t0'], product_id=None, outputs=[])
+            record_result(scn_fn, res, self.manifest)
+            return res
+
+        # the next stage needs the ctx without a status
+        del clipped['status']
+        ctx.update(clipped)
+        return ctx
+
+    def _model(self, ctx):
+        return model_scene(ctx, self.cfg)
+
+    def _write(self, ctx):
+        res = write_scene(ctx, self.cfg)
+        record_result(ctx['scn_fn'], res, self.manifest)
+        return dict(res, scn_fn=ctx['scn_fn'], t0=ctx['t0'])
+
+    def fail(self, ctx, error):
+        fail_scene(ctx['scn_fn'], error, self.manifest)
+        return dict(scn_fn=ctx['scn_fn'], t0=ctx['t0'], status='failed', error=error)
+
+    def finish(self, res):
+        self._results.put(res)
+
+    def status(self):
+        """
+        one line summary of the stages, e.g.
+        [pipeline 600s] extract 2/2 busy 91% blocked 5% q=2 done=12 | model ...
+        """
+        elapsed = time() - self._t0
+        stages = []
+        for stage in self.stages:
+            s = stage.stats(elapsed)
+            stages.append('{} {}/{} busy {:.0f}% blocked {:.0f}% q={} done={}'
+                          .format(stage.name, s['active'], stage.workers, s['busy_pct'],
+                                  s['blocked_pct'], s['queued'], s['processed']))
+        return '[pipeline {:.0f}s] {}'.format(elapsed, ' | '.join(stages))
+
+    def _report(self, done):
+        while not done.wait(self.status_interval):
+            print(self.status())
+
+    def _feed(self, fns):
+        inbox = self.stages[0].inbox
+        for scn_fn in fns:
+            ctx = dict(scn_fn=scn_fn, t0=time())
+            while not self._closing.is_set():
+                try:
+                    inbox.put(ctx, timeout=1.0)
+                    break
+                except queue.Full:
+                    pass
+
+            if self._closing.is_set():
+                return
+
+    def run(self, fns):
+        """
+        processes the archives in fns and yields a result dict for every
+        archive as it finishes (see ingest.run_scene)
+        """
+        fns = list(fns)
+        self._t0 = time()
+        self._closing.clear()
+        self._results = queue.Queue()
+
+        for stage in self.stages:
+            stage.start(self)
+
+        feeder = threading.Thread(target=self._feed, args=(fns,), name='feeder', daemon=True)
+        feeder.start()
+
+        done = threading.Event()
+        if self.status_interval:
+            reporter = threading.Thread(target=self._report, args=(done,), name='reporter', daemon=True)
+            reporter.start()
+
+        try:
+            for _ in range(len(fns)):
+                res = self._results.get()
+                res['elapsed'] = time() - res.pop('t0')
+                yield res
+        finally:
+            # if the generator is closed early the scenes that were not
+            # claimed yet are dropped and the scenes in flight finish
+            done.set()
+            self._closing.set()
+            feeder.join()
+
+            inbox = self.stages[0].inbox
+            while True:
+                try:
+                    inbox.get_nowait()
+                except queue.Empty:
+                    break
+
+            for stage in self.stages:
+                stage.stop()
+
+            print(self.status())
@@ -0,0 +1,109 @@
+"""
+Plans the reprocessing of a site after its config changed.
+
+The outputs of every scene are stamped with the config_fingerprint they
+were made with (see biomass.ingest): the hashes of the clip bounds, the
+model parameters for the satellite of the scene, the processing version,
+the shapefile and the pasture keys. They are stored with the stage
+checkpoints and in <scn_dir>/fingerprint.json, and the pasture_stats rows
+of the location database carry the hash of their stage.
+
+plan_site compares the checkpoints of the processed scenes with the
+current config and lists the stale stages of each scene and why. Editing
+the Landsat 5 parameters of a model only makes the Landsat 5 scenes stale,
+editing the shapefile only the pasture stats. The stale scenes are put
+back in the manifest (requeue) and processed again, the up to date stages
+are skipped by their checkpoints.
+"""
+
+from os.path import exists as _exists
+
+from biomass.ingest import config_fingerprint, stage_hashes, scene_name, scene_members, pasture_stats_done, \
+    STAGE_FINGERPRINT
+from biomass.checkpoint import StageCheckpoints
+
+_stages = ('clip', 'rgb', 'biomass', 'pasture_stats', 'reproject')
+
+
+def product_scenes(manifest):
+    """
+    returns a dict of product_id -> scene (archive path or tuple of the
+    archive paths of a same-date mosaic) of the processed scenes. The
+    scene is None if the path of an archive is not in the manifest (e.g.
+    scenes seeded from an out_dir)
+    """
+    scenes = {}
+    for product_id, archives in manifest.done().items():
+        paths = [(manifest.get(archive) or {}).get('path') for archive in archives]
+        if any(path is None for path in paths):
+            scenes[product_id] = None
+        elif len(paths) == 1:
+            scenes[product_id] = paths[0]
+        else:
+            scenes[product_id] = tuple(paths)
+    return scenes
+
+
+def _reason(d, stage, _hash, fingerprint):
+    """
+    why a checkpointed stage is stale or None if it is up to date
+    """
+    if d is None:
+        return 'not checkpointed'
+
+    if d['input_hash'] == _hash:
+        if all(_exists(fn) for fn in d['outputs']):
+            return None
+        return 'outputs missing'
+
+    previous = d.get('config')
+    if previous is None:
+        return 'config unknown'
+
+    changed = [part for part in STAGE_FINGERPRINT[stage] if previous.get(part) != fingerprint[part]]
+    if len(changed) == 0:
+        return 'inputs changed'
+    return '%s changed' % ', '.join(changed)
+
+
+def plan_scene(scn_fn, cfg):
+    """
+    :return: dict of stage -> reason of the stale stages of a scene
+    """
+    checkpoints = StageCheckpoints.for_archive(cfg.out_dir, scene_name(scn_fn))
+    fingerprint = config_fingerprint(scn_fn, cfg)
+    hashes = stage_hashes(scn_fn, cfg, fingerprint)
+
+    stale = {}
+    for stage in _stages:
+        reason = _reason(checkpoints.stages.get(stage), stage, hashes[stage], fingerprint)
+        if reason is None and stage == 'pasture_stats':
+            product_id = checkpoints.stages.get('clip', {}).get('product_id')
+            if not pasture_stats_done(checkpoints, hashes, product_id, cfg):
+                reason = 'rows missing'
+        if reason is not None:
+            stale[stage] = reason
+    return stale
+
+
+def plan_site(cfg, manifest):
+    """
+    lists the processed scenes of a site whose outputs are stale
+
+    :param cfg: SiteConfig
+    :param manifest: ProcessingManifest of cfg.out_dir
+    :return: list of dict(product_id, scn_fn, stale) sorted by product_id.
+             stale is a dict of stage -> reason, the scenes whose
+             archives can't be found have stale=None
+    """
+    plan = []
+    for product_id, scn_fn in sorted(product_scenes(manifest).items()):
+        if scn_fn is None or not all(_exists(fn) for fn in scene_members(scn_fn)):
+            plan.append(dict(product_id=product_id, scn_fn=scn_fn, stale=None))
+            continue
+
+        stale = plan_scene(scn_fn, cfg)
+        if len(stale) > 0:
+            plan.append(dict(product_id=product_id, scn_fn=scn_fn, stale=stale))
+
+    return plan
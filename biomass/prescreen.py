@@ -0,0 +1,108 @@
+"""
+Clear-sky screening of scene archives before they are processed.
+
+Only the window of the qa band over the site is read, straight from the
+archive through GDAL's /vsitar/ filesystem, so nothing is extracted. The
+expected pasture coverage is computed the way analyze_pastures computes
+it (pixels that are not snow or water, optionally also not cloudy) and
+averaged over the pastures like the coverage in scenemeta_coverage.
+Scenes below the prescreen_coverage of the site config are not
+extracted and are recorded as skipped-low-coverage in the manifest.
+"""
+
+import os
+import tarfile
+from time import time
+
+import numpy as np
+import rasterio
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window
+
+from biomass.landsat import unpack_qa, qa_flag
+
+
+_qa_suffixes = ('_qa_pixel.tif', '_pixel_qa.tif')
+
+
+def qa_member(tar_fn):
+    """
+    returns the name of the qa band member of an archive
+    """
+    with tarfile.open(tar_fn) as tar:
+        for member in tar:
+            if member.name.lower().endswith(_qa_suffixes):
+                return member.name
+    raise Exception('%s has no qa band' % tar_fn)
+
+
+def read_qa_window(tar_fn, bbox):
+    """
+    reads the window of the qa band over bbox (wgs) from an archive. The
+    window is the one LandSatScene.clip uses
+
+    :return: (qa array, crs, transform of the window)
+    """
+    member = qa_member(tar_fn)
+    path = '/vsitar/%s/%s' % (os.path.abspath(tar_fn), member)
+
+    with rasterio.open(path) as src:
+        _bounds = transform_bounds('epsg:4326', src.crs, *bbox)
+        window = src.window(*_bounds).intersection(Window(0, 0, src.width, src.height))
+        window = window.round_lengths(op='ceil')
+        qa = src.read(1, window=window, out_shape=(int(window.height), int(window.width)))
+        return qa, src.crs, src.window_transform(window)
+
+
+def pasture_coverage(qa, l2sp, pasture_masks, delimiter, include_clouds=False):
+    """
+    mean of the pasture coverages (valid_px / total_px) of a qa window
+
+    :return: (coverage, dict of pasture key -> coverage)
+    """
+    bqa = unpack_qa(qa, l2sp)
+    qa_mask = (qa_flag(bqa, 'snow', l2sp) + qa_flag(bqa, 'water', l2sp)) > 0
+    if include_clouds:
+        qa_mask |= qa_flag(bqa, 'clear', l2sp) == 0
+
+    pastures = {}
+    for key, pasture_mask in pasture_masks:
+        not_pasture_mask = np.logical_not(pasture_mask)
+        total_px = np.sum(not_pasture_mask)
+        valid_px = np.sum(not_pasture_mask & np.logical_not(qa_mask))
+
+        if not total_px > 0:
+            coverage = 0.0
+        else:
+            coverage = float(valid_px) / float(total_px)
+
+        # analyze_pastures reports full coverage for these pastures
+        pasture, ranch = key.split(delimiter)
+        if pasture in 'ABCDEFGHIJKLMNO':
+            coverage = 1.0
+
+        pastures[key] = coverage
+
+    if len(pastures) == 0:
+        return 0.0, pastures
+
+    return sum(pastures.values()) / len(pastures), pastures
+
+
+def prescreen_scene(scn_fn, cfg):
+    """
+    expected pasture coverage of an archive for a site
+
+    :param cfg: SiteConfig
+    :return: dict(coverage, pastures, elapsed)
+    """
+    t0 = time()
+    qa, crs, transform = read_qa_window(scn_fn, cfg.bbox)
+    height, width = qa.shape
+
+    pasture_masks = cfg.grid_pasture_masks(crs, transform, width, height)
+    coverage, pastures = pasture_coverage(qa, '_l2sp_' in scn_fn.lower(), pasture_masks,
+                                          cfg.sf_feature_properties_delimiter,
+                                          include_clouds=cfg.prescreen_clouds)
+
+    return dict(coverage=coverage, pastures=pastures, elapsed=time() - t0)
@@ -4,21 +4,25 @@
 # License:   BSD-3 Clause
 
 import os
+import sys
+import traceback
 from math import sqrt
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 
 from os.path import join as _join
 from os.path import exists as _exists
 import warnings
 
 import rasterio
-from rasterio.mask import raster_geometry_mask
+from rasterio.features import geometry_mask
 
 from fiona.transform import transform_geom
 
 from pprint import pprint
 
 import numpy as np
-from .landsat import LandSatScene
+from .landsat import LandSatScene, MultiWindowScene
 
 
 def isfloat(x):
@@ -39,6 +43,158 @@ def _quantile(a, q):
     return np.quantile(a, q)
 
 
+def _is_mappable_of_floats(x):
+    try:
+        float(x[0])
+        return True
+    except:
+        return False
+
+
+def _coords_3d_to_2d(coords):
+    _coords = []
+    for coord in coords:
+        if _is_mappable_of_floats(coord):
+            _coords.append((coord[0], coord[1]))
+        else:
+            _coords.append(_coords_3d_to_2d(coord))
+    return _coords
+
+
+def build_pasture_masks(sf, ls, sf_feature_properties_key, keys=None):
+    """
+    Rasterize each pasture of sf onto the grid of the landsat scene
+
+    :param keys: only rasterize the pastures with these keys
+    :return: list of (key, pasture_mask) tuples. pasture_mask is True
+             outside of the pasture (rasterio.mask convention)
+    """
+    if isinstance(ls, MultiWindowScene):
+        # masks of the windows packed like the bands of the scene
+        masks = [build_pasture_masks(sf, w, sf_feature_properties_key, keys=keys) for w in ls.windows]
+        return [(key, ls.pack([m[i][1] for m in masks])) for i, (key, _) in enumerate(masks[0])]
+
+    src = ls.template_ds
+    return build_grid_pasture_masks(sf, ls.proj4, src.transform, src.width, src.height,
+                                    sf_feature_properties_key, keys=keys)
+
+
+def build_grid_pasture_masks(sf, crs, transform, width, height, sf_feature_properties_key, keys=None):
+    """
+    Rasterize each pasture of sf onto a grid (e.g. a window of a band that
+    is read without loading the scene)
+
+    :param keys: only rasterize the pastures with these keys
+    :return: list of (key, pasture_mask) tuples. pasture_mask is True
+             outside of the pasture (rasterio.mask convention)
+    """
+    pasture_masks = []
+    for feature in sf:
+        key = feature['properties'][sf_feature_properties_key]
+        if keys is not None and key not in keys:
+            continue
+
+        features = [transform_geom(sf.crs_wkt, crs, feature['geometry'])]
+
+        features = [
+            {
+                "type": g["type"],
+                "coordinates": _coords_3d_to_2d(g["coordinates"]),
+            }
+            for g in features
+        ]
+
+        pasture_mask = geometry_mask(features, out_shape=(height, width), transform=transform)
+        pasture_masks.append((key, pasture_mask))
+
+    return pasture_masks
+
+
+#
+# analyze_many worker state
+#
+# set by _init_analyze_many so that the pasture masks are only
+# sent to each worker process once per grid group
+_am_models = None
+_am_pasture_masks = None
+_am_delimiter = None
+_am_export_dtype = None
+
+
+def _init_analyze_many(models, pasture_masks, sf_feature_properties_delimiter, export_dtype):
+    global _am_models, _am_pasture_masks, _am_delimiter, _am_export_dtype
+    _am_models = models
+    _am_pasture_masks = pasture_masks
+    _am_delimiter = sf_feature_properties_delimiter
+    _am_export_dtype = export_dtype
+
+
+def _analyze_one(scn_dir):
+    try:
+        ls = LandSatScene(scn_dir)
+        bio_model = BiomassModel(ls, _am_models, verbose=False)
+
+        if _am_export_dtype is not None:
+            bio_model.export_grids(biomass_dir=_join(ls.basedir, 'biomass'), dtype=_am_export_dtype)
+
+        res = bio_model.analyze_pastures(None, None, _am_delimiter, pasture_masks=_am_pasture_masks)
+        return dict(res=res, ls_summary=ls.summary_dict(), scn_dir=scn_dir)
+    except Exception:
+        return _analyze_error(scn_dir, traceback.format_exc())
+
+
+def _analyze_error(scn_dir, error):
+    return dict(res=None, ls_summary=None, scn_dir=scn_dir, error=error)
+
+
+def _imap_analyze_one(scn_dirs, processes, initargs, max_retries=1):
+    """
+    yields _analyze_one(scn_dir) from a pool of processes as scenes finish.
+    When a worker dies (e.g. GDAL segfault or out of memory) the pool is
+    restarted and the scenes in flight are retried up to max_retries times
+    """
+    queue = list(scn_dirs)[::-1]
+    attempts = {}
+    in_flight = {}
+
+    executor = ProcessPoolExecutor(max_workers=processes, initializer=_init_analyze_many, initargs=initargs)
+    try:
+        while len(queue) > 0 or len(in_flight) > 0:
+            while len(queue) > 0 and len(in_flight) < processes:
+                scn_dir = queue.pop()
+                attempts[scn_dir] = attempts.get(scn_dir, 0) + 1
+                in_flight[executor.submit(_analyze_one, scn_dir)] = scn_dir
+
+            done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+
+            broken = False
+            for future in done:
+                scn_dir = in_flight.pop(future)
+                try:
+                    result = future.result()
+                except BrokenProcessPool:
+                    broken = True
+                    in_flight[future] = scn_dir
+                    continue
+                except Exception:
+                    result = _analyze_error(scn_dir, traceback.format_exc())
+                yield result
+
+            if broken:
+                print('worker died, restarting pool', file=sys.stderr)
+                for scn_dir in in_flight.values():
+                    if attempts[scn_dir] > max_retries:
+                        yield _analyze_error(scn_dir, 'worker died while analyzing scene')
+                    else:
+                        queue.append(scn_dir)
+                in_flight = {}
+                executor.shutdown(wait=False)
+                executor = ProcessPoolExecutor(max_workers=processes, initializer=_init_analyze_many,
+                                               initargs=initargs)
+    finally:
+        executor.shutdown(wait=False)
+
+
 class SatModelPars(object):
     def __init__(self, satellite, discriminate_threshold, summer_int,
                  summer_slp, fall_int, fall_slp, required_coverage, minimum_area_ha,
@@ -207,6 +363,53 @@ class BiomassModel(object):
         self.nbr = np.ma.array(ls.nbr, mask=qa_mask)
         self.nbr2 = np.ma.array(ls.nbr2, mask=qa_mask)
 
+    @staticmethod
+    def analyze_many(scenes, models, sf, sf_feature_properties_key, sf_feature_properties_delimiter='+',
+                     processes=None, export_dtype=None, keys=None):
+        """
+        Analyze the pastures of many clipped scenes.
+
+        Scenes are grouped by grid signature and the pasture masks are
+        rasterized once per group. Results are yielded as each scene
+        finishes (not necessarily in the order of scenes) as
+        dict(res=..., ls_summary=..., scn_dir=...) like process_scene.
+        Scenes that fail (including scenes that can't be opened and scenes
+        whose worker died twice) are yielded with the traceback in 'error'.
+
+        :param scenes: clipped scene directories
+        :param processes: number of worker processes. None evaluates the scenes
+                          in this process
+        :param export_dtype: if not None the biomass grids are also exported
+                             to the biomass subdirectory of each scene
+        :param keys: only analyze the pastures with these keys
+        """
+        groups = {}
+        for scn_dir in scenes:
+            try:
+                with LandSatScene(scn_dir) as ls:
+                    groups.setdefault(ls.grid_signature, []).append(scn_dir)
+            except Exception:
+                yield _analyze_error(scn_dir, traceback.format_exc())
+
+        for signature, scn_dirs in groups.items():
+            try:
+                with LandSatScene(scn_dirs[0]) as ls:
+                    pasture_masks = build_pasture_masks(sf, ls, sf_feature_properties_key, keys=keys)
+            except Exception:
+                error = traceback.format_exc()
+                for scn_dir in scn_dirs:
+                    yield _analyze_error(scn_dir, error)
+                continue
+
+            initargs = (models, pasture_masks, sf_feature_properties_delimiter, export_dtype)
+
+            if processes is None:
+                _init_analyze_many(*initargs)
+                for scn_dir in scn_dirs:
+                    yield _analyze_one(scn_dir)
+            else:
+                yield from _imap_analyze_one(scn_dirs, processes, initargs)
+
     def export_grids(self, biomass_dir, dtype=rasterio.float32):
         """
         Export the grids to a "biomass" subdirectory of the cropped landsat scene.
@@ -239,30 +442,17 @@ class BiomassModel(object):
         ls.dump(data, _join(ls_dir, '%s_ndvi.tif' % ls.product_id), dtype=dtype)
 
 
-    def analyze_pastures(self, sf, sf_feature_properties_key, sf_feature_properties_delimiter='+'):
+    def analyze_pastures(self, sf, sf_feature_properties_key, sf_feature_properties_delimiter='+',
+                         pasture_masks=None):
         """
         Iterate over each pasture and determine the biomass, etc. for each model
 
         :param sf:
+        :param pasture_masks: optional list of (key, pasture_mask) from build_pasture_masks.
+                              Scenes with the same grid_signature can share them.
         :return:
         """
 
-        def is_mappable_of_floats(x):
-            try:
-                float(x[0])
-                return True
-            except:
-                return False
-
-        def coords_3d_to_2d(coords):
-            _coords = []
-            for coord in coords:
-                if is_mappable_of_floats(coord):
-                    _coords.append((coord[0], coord[1]))
-                else:
-                    _coords.append(coords_3d_to_2d(coord))
-            return _coords 
-
         ls = self.ls
         sat = self.ls.satellite
         cellsize = ls.cellsize
@@ -276,22 +466,12 @@ class BiomassModel(object):
         fall_vi = self.fall_vi
         summer_mask = self.summer_mask
 
+        if pasture_masks is None:
+            pasture_masks = build_pasture_masks(sf, ls, sf_feature_properties_key)
+
         res = []  # becomes a list of dictionary objects for each pasture
         valid_pastures_cnt = 0
-        for feature in sf:
-            key = feature['properties'][sf_feature_properties_key]
-            features = [transform_geom(sf.crs_wkt, ls.proj4, feature['geometry'])]
-
-            features = [
-		    {
-			"type": g["type"],
-			"coordinates": coords_3d_to_2d(g["coordinates"]),
-		    }
-		    for g in features
-		]
-
-
-            pasture_mask, _, _ = raster_geometry_mask(ls.template_ds, features)
+        for key, pasture_mask in pasture_masks:
             not_pasture_mask = np.logical_not(pasture_mask)
 
             if np.sum(not_pasture_mask) == 0:
@@ -0,0 +1,328 @@
+"""
+In-process reprojection of rasters to WGS84 (.wgs.tif).
+
+Replaces running gdalwarp -of vrt followed by gdal_translate for every
+file. The destination grid is computed the same way as gdalwarp
+(GDALSuggestedWarpOutput2 via calculate_default_transform) and the data
+is warped with nearest neighbour resampling. The output keeps the source
+dtype, nodata and band color interpretation and is written as an LZW
+compressed striped GTiff like gdal_translate.
+
+The destination grid is computed once per source grid so all of the
+rasters of a scene share it. Every scene of a path/row clipped to a site
+has the same grid, so the resampling geometry is also precomputed as an
+index map (the source pixel of every destination pixel) that is cached in
+memory and on disk (RANGESAT_WARP_INDEX_DIR) keyed by the source and
+destination grids. Reprojecting a raster is then a NumPy gather.
+
+The in-memory cache keeps the RANGESAT_WARP_INDEX_CACHE most recently used
+maps. The maps on disk that have not been used for
+RANGESAT_WARP_INDEX_MAX_AGE days are removed when a new map is written.
+"""
+
+import os
+import hashlib
+import tempfile
+import threading
+from time import time
+from glob import glob
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from os.path import join as _join
+from os.path import exists as _exists
+
+import numpy as np
+import rasterio
+from rasterio.transform import array_bounds
+from rasterio.warp import calculate_default_transform, reproject, transform as transform_xy, Resampling
+
+from biomass.checkpoint import atomic_output
+
+
+WGS84 = 'EPSG:4326'
+
+_grid_cache = {}
+_grid_cache_lock = threading.Lock()
+
+_index_map_dir = os.environ.get('RANGESAT_WARP_INDEX_DIR',
+                                _join(tempfile.gettempdir(), 'rangesat_warp_index'))
+_index_maps = OrderedDict()
+_index_maps_lock = threading.Lock()
+
+# index maps kept in memory (least recently used are evicted)
+_index_maps_max = int(os.environ.get('RANGESAT_WARP_INDEX_CACHE', 8))
+
+# seconds after which an unused index map is removed from _index_map_dir
+_index_map_max_age = float(os.environ.get('RANGESAT_WARP_INDEX_MAX_AGE', 30)) * 86400.0
+
+
+def grid_key(crs, transform, width, height):
+    return crs.to_wkt(), tuple(transform)[:6], width, height
+
+
+def wgs_grid(crs, transform, width, height, dst_crs=WGS84):
+    """
+    returns (dst_transform, dst_width, dst_height) of the WGS84 grid for
+    a source grid. Cached by source grid
+    """
+    key = grid_key(crs, transform, width, height) + (dst_crs,)
+
+    with _grid_cache_lock:
+        if key in _grid_cache:
+            return _grid_cache[key]
+
+    left, bottom, right, top = array_bounds(height, width, transform)
+    grid = calculate_default_transform(crs, dst_crs, width, height, left, bottom, right, top)
+
+    with _grid_cache_lock:
+        _grid_cache[key] = grid
+
+    return grid
+
+
+def _nearest_index_map(crs, transform, width, height, dst_crs, dst_transform, dst_width, dst_height):
+    """
+    warps the flat indices of the source pixels with GDAL so the map
+    selects exactly the pixels gdalwarp -r near would. -1 is outside of
+    the source
+    """
+    assert width * height < 2**31
+    src_index = np.arange(width * height, dtype=np.int32).reshape(height, width)
+    index = np.full((dst_height, dst_width), -1, dtype=np.int32)
+    reproject(src_index, index,
+              src_transform=transform, src_crs=crs, src_nodata=-1,
+              dst_transform=dst_transform, dst_crs=dst_crs, dst_nodata=-1,
+              resampling=Resampling.nearest)
+    return dict(index=index)
+
+
+def _bilinear_index_map(crs, transform, width, height, dst_crs, dst_transform, dst_width, dst_height):
+    """
+    the 4 source pixels surrounding the center of every destination pixel
+    and their bilinear weights
+    """
+    cols, rows = np.meshgrid(np.arange(dst_width) + 0.5, np.arange(dst_height) + 0.5)
+    xs, ys = dst_transform * (cols.ravel(), rows.ravel())
+    xs, ys = transform_xy(dst_crs, crs, xs, ys)
+    src_cols, src_rows = ~transform * (np.array(xs), np.array(ys))
+
+    # pixel centers are at .5
+    src_cols = src_cols - 0.5
+    src_rows = src_rows - 0.5
+    c0 = np.floor(src_cols).astype(np.int64)
+    r0 = np.floor(src_rows).astype(np.int64)
+    fc = src_cols - c0
+    fr = src_rows - r0
+
+    index = np.empty((4, dst_height * dst_width), dtype=np.int32)
+    weights = np.empty((4, dst_height * dst_width), dtype=np.float32)
+    for i, (dr, dc, w) in enumerate([(0, 0, (1 - fr) * (1 - fc)), (0, 1, (1 - fr) * fc),
+                                     (1, 0, fr * (1 - fc)), (1, 1, fr * fc)]):
+        r, c = r0 + dr, c0 + dc
+        inside = (r >= 0) & (r < height) & (c >= 0) & (c < width)
+        index[i] = np.where(inside, r * width + c, -1)
+        weights[i] = np.where(inside, w, 0.0)
+
+    return dict(index=index.reshape(4, dst_height, dst_width),
+                weights=weights.reshape(4, dst_height, dst_width))
+
+
+def warp_index_map(crs, transform, width, height, dst_crs=WGS84, resampling='nearest'):
+    """
+    returns (dst_transform, dst_width, dst_height, index_map) for a source
+    grid. index_map is a dict with 'index' (and 'weights' for bilinear)
+    """
+    assert resampling in ('nearest', 'bilinear'), resampling
+
+    dst_transform, dst_width, dst_height = wgs_grid(crs, transform, width, height, dst_crs)
+    key = grid_key(crs, transform, width, height) + \
+          (dst_crs, tuple(dst_transform)[:6], dst_width, dst_height, resampling)
+
+    with _index_maps_lock:
+        if key in _index_maps:
+            _index_maps.move_to_end(key)
+            return (dst_transform, dst_width, dst_height, _index_maps[key])
+
+    fn = _join(_index_map_dir, hashlib.sha1(repr(key).encode()).hexdigest() + '.npz')
+    if _exists(fn):
+        with np.load(fn) as npz:
+            index_map = {k: npz[k] for k in npz.files}
+
+        # marks the map as used for prune_index_maps
+        try:
+            os.utime(fn)
+        except OSError:
+            pass
+    else:
+        if resampling == 'nearest':
+            index_map = _nearest_index_map(crs, transform, width, height,
+                                           dst_crs, dst_transform, dst_width, dst_height)
+        else:
+            index_map = _bilinear_index_map(crs, transform, width, height,
+                                            dst_crs, dst_transform, dst_width, dst_height)
+
+        # write to a temporary file and rename so concurrent workers never
+        # load a partial map
+        os.makedirs(_index_map_dir, exist_ok=True)
+        tmp_fn = '%s.%i.%i.tmp' % (fn, os.getpid(), threading.get_ident())
+        with open(tmp_fn, 'wb') as fp:
+            np.savez(fp, **index_map)
+        os.replace(tmp_fn, fn)
+
+        prune_index_maps()
+
+    with _index_maps_lock:
+        _index_maps[key] = index_map
+        _index_maps.move_to_end(key)
+        while len(_index_maps) > _index_maps_max:
+            _index_maps.popitem(last=False)
+
+    return dst_transform, dst_width, dst_height, index_map
+
+
+def prune_index_maps(max_age=None):
+    """
+    removes the index maps in _index_map_dir that have not been used for
+    max_age seconds (default _index_map_max_age) and temporary files
+    left by killed workers
+
+    :return: number of files removed
+    """
+    if max_age is None:
+        max_age = _index_map_max_age
+
+    now = time()
+    n = 0
+    for fn in glob(_join(_index_map_dir, '*.npz')) + glob(_join(_index_map_dir, '*.tmp')):
+        try:
+            if now - os.stat(fn).st_mtime > max_age:
+                os.remove(fn)
+                n += 1
+        except OSError:
+            pass
+    return n
+
+
+def apply_index_map(src_data, index_map, nodata=None):
+    """
+    reprojects src_data (bands, rows, cols) with an index map
+    """
+    fill = nodata if nodata is not None else 0
+    count = src_data.shape[0]
+    src_flat = src_data.reshape(count, -1)
+    index = index_map['index']
+
+    if 'weights' not in index_map:
+        data = src_flat[:, np.where(index < 0, 0, index)]
+        data[:, index < 0] = fill
+        return data
+
+    values = src_flat[:, np.where(index < 0, 0, index)].astype(np.float64)
+    weights = np.broadcast_to(index_map['weights'], values.shape).astype(np.float64)
+    if nodata is not None:
+        weights = np.where(values == nodata, 0.0, weights)
+
+    total = weights.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        data = (weights * values).sum(axis=1) / total
+
+    if np.issubdtype(src_data.dtype, np.integer):
+        info = np.iinfo(src_data.dtype)
+        data = np.clip(np.round(data), info.min, info.max)
+
+    data[total <= 0] = fill
+    return data.astype(src_data.dtype)
+
+
+def _scale_int16(data, nodata, scale):
+    """
+    linear scaling to Int16 like gdal_translate -ot Int16 -scale
+    src_min src_max dst_min dst_max
+    """
+    src_min, src_max, dst_min, dst_max = [float(v) for v in scale]
+    ratio = (dst_max - dst_min) / (src_max - src_min)
+    scaled = (data.astype(np.float64) - src_min) * ratio + dst_min
+    scaled = np.clip(np.round(scaled), -32768, 32767).astype(np.int16)
+
+    if nodata is not None:
+        scaled[data == nodata] = np.clip(np.round(nodata), -32768, 32767)
+
+    return scaled
+
+
+def reproject_raster(src, dst=None, scale=None, dst_crs=WGS84, resampling='nearest'):
+    """
+    reprojects src to WGS84. dst defaults to <src>.wgs.tif
+
+    :param scale: optional (src_min, src_max, dst_min, dst_max) to scale
+                  the output to Int16 (see gdal_translate -scale)
+    :param resampling: 'nearest' (matches gdalwarp) or 'bilinear'
+    """
+    if dst is None:
+        dst = src[:-4] + '.wgs.tif'
+
+    with rasterio.open(src) as ds:
+        dst_transform, dst_width, dst_height, index_map = \
+            warp_index_map(ds.crs, ds.transform, ds.width, ds.height, dst_crs, resampling)
+        src_data = ds.read()
+        nodata = ds.nodata
+        colorinterp = ds.colorinterp
+
+        # like gdalwarp the output is nodata (0 without nodata) outside
+        # of the source
+        data = apply_index_map(src_data, index_map, nodata)
+
+        profile = dict(driver='GTiff', count=ds.count, dtype=data.dtype, nodata=nodata,
+                       crs=dst_crs, transform=dst_transform, width=dst_width, height=dst_height,
+                       compress='lzw')
+
+    if scale is not None:
+        data = _scale_int16(data, nodata, scale)
+        profile['dtype'] = data.dtype
+
+    # replaced atomically so an interrupted reprojection never leaves a
+    # partial .wgs.tif
+    with atomic_output(dst) as tmp_fn:
+        with rasterio.open(tmp_fn, 'w', **profile) as out:
+            out.write(data)
+            if scale is None:
+                out.colorinterp = colorinterp
+
+    assert _exists(dst)
+    return dst
+
+
+def reproject_rasters(fns, threads=None, **kwargs):
+    """
+    reprojects several rasters. GDAL releases the GIL while warping so
+    threads run concurrently
+    """
+    if threads is None or threads < 2:
+        return [reproject_raster(fn, **kwargs) for fn in fns]
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return list(executor.map(lambda fn: reproject_raster(fn, **kwargs), fns))
+
+
+def _contains_any(target, matches):
+    for match in matches:
+        if match in target:
+            return True
+
+    return False
+
+
+def scene_rasters(scn_dir):
+    """
+    rasters of an analyzed scene that are served in WGS84 (rgb, ndvi and
+    the biomass grids)
+    """
+    fns = glob(_join(scn_dir, '*.tif'))
+    fns = [fn for fn in fns if _contains_any(fn, ['rgb', 'ndvi'])]
+    fns.extend(glob(_join(scn_dir, '*/*.tif')))
+    return [fn for fn in fns if not fn.endswith('.wgs.tif')]
+
+
+def reproject_scene(scn_dir, threads=None):
+    return reproject_rasters(scene_rasters(scn_dir), threads=threads)
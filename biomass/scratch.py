@@ -0,0 +1,256 @@
+"""
+Scratch space for extracting scene archives.
+
+Archives are extracted to SCRATCH (/media/ramdisk). The ScratchManager
+estimates the extracted size of an archive from its tar headers and only
+admits an extraction while the reservations of all of the workers on the
+host fit within the budget. Workers that do not fit wait for space.
+
+Reservations are files in <scratch>/.scratch_reservations named after the
+scene and the pid of the worker and are updated under an flock so
+processes (and threads) share the budget. Directories of scenes without a
+live reservation are left over from crashed workers and are removed on
+start-up.
+
+When SCRATCH is not available, an archive is larger than the budget or no
+space frees up within wait_timeout the archive is extracted to the disk
+backed fallback directory instead and a warning is issued.
+"""
+
+import os
+import re
+import json
+import fcntl
+import shutil
+import socket
+import tarfile
+import tempfile
+import threading
+import warnings
+from contextlib import contextmanager
+from time import time, sleep
+
+from os.path import join as _join
+from os.path import exists as _exists
+from os.path import split as _split
+
+from all_your_base import SCRATCH
+
+
+# directories of extracted Landsat archives, e.g. LC08_L2SP_042028_20200601_20200610_02_T1
+_scene_dir_re = re.compile(r'^L[CTEMO]0\d_\w+$')
+
+_block = 4096
+
+
+def archive_scene_name(tar_fn):
+    return _split(tar_fn)[-1].replace('.tar.gz', '').replace('.tar', '')
+
+
+def extracted_size(tar_fn):
+    """
+    estimate of the bytes an archive takes once extracted, from the sizes
+    in its tar headers rounded up to filesystem blocks
+    """
+    total = 0
+    with tarfile.open(tar_fn) as tar:
+        for member in tar:
+            total += _block
+            if member.isfile():
+                total += -(-member.size // _block) * _block
+    return total
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class ScratchManager(object):
+    """
+    :param root: scratch directory (defaults to SCRATCH)
+    :param budget: bytes that can be reserved in root. Defaults to 90% of
+                   the size of the root filesystem
+    :param fallback: disk backed directory used when root is not available
+                     or full. Defaults to the system temp directory
+    :param wait_timeout: seconds to wait for space before falling back
+    :param cleanup: remove stale scene directories and reservations. Only
+                    one process (the driver) should do this, see
+                    cleanup_stale
+    """
+    def __init__(self, root=SCRATCH, budget=None, fallback=None, wait_timeout=600, poll_interval=5,
+                 cleanup=False):
+        if fallback is None:
+            fallback = _join(tempfile.gettempdir(), 'rangesat_scratch')
+
+        available = root is not None and os.path.isdir(root) and os.access(root, os.W_OK)
+        if not available:
+            warnings.warn('scratch directory %s is not available, extracting to %s' % (root, fallback))
+
+        if available and budget is None:
+            st = os.statvfs(root)
+            budget = int(st.f_blocks * st.f_frsize * 0.9)
+
+        self.root = root
+        self.available = available
+        self.budget = budget
+        self.fallback = fallback
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.reservations_dir = _join(root, '.scratch_reservations') if available else None
+        self.lock_fn = _join(root, '.scratch.lock') if available else None
+
+        if available:
+            os.makedirs(self.reservations_dir, exist_ok=True)
+            if cleanup:
+                self.cleanup_stale()
+
+    @contextmanager
+    def _locked(self):
+        with open(self.lock_fn, 'a') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def _reservations(self):
+        """
+        returns a list of (fn, reservation dict, alive). Must hold the lock
+        """
+        host = socket.gethostname()
+        reservations = []
+        for fn in os.listdir(self.reservations_dir):
+            fn = _join(self.reservations_dir, fn)
+            try:
+                with open(fn) as fp:
+                    d = json.load(fp)
+            except (OSError, ValueError):
+                continue
+
+            alive = d['host'] != host or _pid_alive(d['pid'])
+            reservations.append((fn, d, alive))
+        return reservations
+
+    def reserved(self):
+        """
+        bytes reserved by live workers
+        """
+        if not self.available:
+            return 0
+
+        with self._locked():
+            return sum(d['bytes'] for fn, d, alive in self._reservations() if alive)
+
+    def cleanup_stale(self, min_age=6 * 3600):
+        """
+        removes the reservations of dead workers and scene directories in
+        root without a live reservation that have not been modified for
+        min_age seconds. Tools that extract without a reservation (e.g.
+        recalc_pasture_stats.py) may be using the recent ones
+
+        Run it once from the driver at start-up, not from the workers
+        """
+        removed = []
+        now = time()
+        with self._locked():
+            live = set()
+            for fn, d, alive in self._reservations():
+                if alive:
+                    live.add(d['path'])
+                else:
+                    os.remove(fn)
+
+            for name in os.listdir(self.root):
+                path = _join(self.root, name)
+                if _scene_dir_re.match(name) and os.path.isdir(path) and path not in live:
+                    try:
+                        if now - os.stat(path).st_mtime < min_age:
+                            continue
+                    except OSError:
+                        continue
+                    shutil.rmtree(path, ignore_errors=True)
+                    removed.append(path)
+
+        if len(removed) > 0:
+            print('removed %i stale scratch directories' % len(removed))
+        return removed
+
+    def _try_reserve(self, path, nbytes):
+        """
+        writes a reservation if nbytes fit within the budget and the free
+        space of root. Returns the reservation file or None
+        """
+        with self._locked():
+            reservations = self._reservations()
+            if any(d['path'] == path for fn, d, alive in reservations if alive):
+                raise Exception('%s is already being extracted' % path)
+
+            reserved = sum(d['bytes'] for fn, d, alive in reservations if alive)
+            st = os.statvfs(self.root)
+            free = st.f_bavail * st.f_frsize
+
+            if reserved + nbytes > self.budget or nbytes > free:
+                return None
+
+            reservation_fn = _join(self.reservations_dir, '%s.%i.%i' %
+                                   (_split(path)[-1], os.getpid(), threading.get_ident()))
+            with open(reservation_fn, 'w') as fp:
+                json.dump(dict(path=path, bytes=nbytes, host=socket.gethostname(),
+                               pid=os.getpid(), created=time()), fp)
+            return reservation_fn
+
+    def _release(self, reservation_fn):
+        with self._locked():
+            if _exists(reservation_fn):
+                os.remove(reservation_fn)
+
+    def _fallback_path(self, tar_fn):
+        os.makedirs(self.fallback, exist_ok=True)
+        return _join(self.fallback, archive_scene_name(tar_fn))
+
+    @contextmanager
+    def reserve(self, tar_fn):
+        """
+        context manager that yields the directory to extract tar_fn into.
+        Waits until the extracted archive fits in the budget. The directory
+        and the reservation are removed on exit
+        """
+        reservation_fn = None
+        path = None
+
+        if self.available:
+            nbytes = extracted_size(tar_fn)
+            path = _join(self.root, archive_scene_name(tar_fn))
+
+            if nbytes > self.budget:
+                warnings.warn('%s needs %i bytes, more than the scratch budget of %i bytes. extracting to %s' %
+                              (tar_fn, nbytes, self.budget, self.fallback))
+            else:
+                t0 = time()
+                reservation_fn = self._try_reserve(path, nbytes)
+                while reservation_fn is None and time() - t0 < self.wait_timeout:
+                    print('waiting for %i bytes of scratch space for %s' % (nbytes, tar_fn))
+                    sleep(self.poll_interval)
+                    reservation_fn = self._try_reserve(path, nbytes)
+
+                if reservation_fn is None:
+                    warnings.warn('no scratch space for %s after %i seconds. extracting to %s' %
+                                  (tar_fn, self.wait_timeout, self.fallback))
+
+        if reservation_fn is None:
+            path = self._fallback_path(tar_fn)
+
+        try:
+            yield path
+        finally:
+            if _exists(path):
+                shutil.rmtree(path)
+
+            if reservation_fn is not None:
+                self._release(reservation_fn)
@@ -0,0 +1,64 @@
+"""
+Searches index combinations, discriminate thresholds and log/linear forms
+for the biomass model that best fits a table of field plots and writes
+the winners as a models section that can be pasted into a site config.
+
+The plot table needs a biomass column (g/m^2) and the index values of
+each plot, e.g. compiled.csv or the output of extract_plots.py joined
+with the field measurements.
+
+Example usage:
+    > python3 calibrate_models.py /var/www/rangesat-biomass/sites/SageSteppe/compiled.csv \
+          --biomass_field biomass_gpm --out_fn rcr_models.yaml
+"""
+
+import sys
+import os
+import argparse
+from time import time
+
+from os.path import join as _join
+
+import yaml
+
+_this_dir = os.path.dirname(__file__)
+sys.path.append(os.path.abspath(_join(_this_dir, '../../')))
+
+from biomass.calibration import load_plot_table, search, to_models
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calibrate biomass models against field plots.")
+    parser.add_argument("plot_table", type=str, help="csv or parquet plot table.")
+    parser.add_argument("--biomass_field", type=str, required=True, help="Measured biomass column (g/m^2).")
+    parser.add_argument("--indices", type=str, nargs='+', default=None, help="Summer/fall index candidates.")
+    parser.add_argument("--discriminate_indices", type=str, nargs='+', default=None,
+                        help="Discriminate index candidates ('none' for no discriminate index).")
+    parser.add_argument("--n_thresholds", type=int, default=19, help="Thresholds per discriminate index.")
+    parser.add_argument("--folds", type=int, default=5, help="Cross-validation folds.")
+    parser.add_argument("--n_best", type=int, default=5, help="Number of models to write.")
+    parser.add_argument("--name", type=str, default='Herbaceous', help="Model name.")
+    parser.add_argument("--out_fn", type=str, default=None, help="yaml file to write the models to.")
+    args = parser.parse_args()
+
+    rows = load_plot_table(args.plot_table)
+
+    t0 = time()
+    candidates = search(rows, args.biomass_field, indices=args.indices,
+                        discriminate_indices=args.discriminate_indices,
+                        n_thresholds=args.n_thresholds, folds=args.folds, n_best=args.n_best)
+    print('search completed in %f seconds' % (time() - t0))
+
+    for i, c in enumerate(candidates):
+        print('{:>2} cv_rmse={:.2f} n={} log={} discriminate={}>{} summer={} fall={}'
+              .format(i + 1, c['cv_rmse'], c['n'], c['log_transformed_estimate'],
+                      c['discriminate_index'], c['discriminate_threshold'],
+                      c['summer_index'], c['fall_index']))
+
+    yaml_txt = yaml.safe_dump(dict(models=to_models(candidates, name=args.name)), sort_keys=False)
+
+    if args.out_fn is None:
+        print(yaml_txt)
+    else:
+        with open(args.out_fn, 'w') as fp:
+            fp.write(yaml_txt)
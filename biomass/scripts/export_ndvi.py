@@ -3,30 +3,12 @@ import os
 from os.path import join as _join
 from os.path import exists as _exists
 import sys
-from subprocess import Popen
 
 sys.path.append(os.path.abspath('../../'))
 sys.path.insert(0, '/Users/roger/rangesat-biomass')
 
 from biomass.landsat import LandSatScene
-
-def reproject_raster(src):
-    dst = src[:-4] + '.wgs.vrt'
-    dst2 = src[:-4] + '.wgs.tif'
-
-    if _exists(dst):
-        os.remove(dst)
-    if _exists(dst2):
-        os.remove(dst2)
-
-    cmd = ['gdalwarp', '-t_srs', 'EPSG:4326', '-of', 'vrt', src, dst]
-    p = Popen(cmd)
-    p.wait()
-
-    cmd = ['gdal_translate', '-co', 'COMPRESS=LZW', '-of', 'GTiff', dst, dst2]
-    p = Popen(cmd)
-    p.wait()
-    assert _exists(dst)
+from biomass.reproject import reproject_raster
 
 scenes = glob('/geodata/nas/rangesat/Zumwalt2/analyzed_rasters/L*')
 
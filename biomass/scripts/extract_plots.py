@@ -0,0 +1,177 @@
+"""
+Extracts index values at field plots from every analyzed scene of one or
+more locations to build a calibration table.
+
+Scenes are processed in a process pool. Only the plot pixels are read
+(see LandSatScene.sample) and scenes that do not contain any plots are
+skipped based on their bounds. The output is partitioned by location and
+year with one parquet file per scene:
+
+    <out_dir>/location=<location>/year=<year>/<product_id>.parquet
+
+Scenes that already have a partition file are skipped so an interrupted
+run resumes where it stopped. Requires pandas and pyarrow.
+
+Example usage:
+    > python3 extract_plots.py /space/rangesat/RangeSAT_SageSteppewPlotBiomass/RangeSAT_SageSteppewPlotBiomass.shp \
+          SageSteppe RCR --id_field SiteID --out_dir /space/rangesat/plot_extraction
+"""
+
+import sys
+import os
+import argparse
+import multiprocessing
+from glob import glob
+from time import time
+
+from os.path import join as _join
+from os.path import exists as _exists
+from os.path import split as _split
+from os.path import isdir
+
+import fiona
+import rasterio
+from rasterio.warp import transform, transform_bounds
+import pandas as pd
+
+_this_dir = os.path.dirname(__file__)
+sys.path.append(os.path.abspath(_join(_this_dir, '../../')))
+
+from biomass.landsat import LandSatScene
+from all_your_base import RANGESAT_DIRS
+
+
+_metrics = ('ndvi', 'nbr', 'nbr2', 'evi', 'tcg', 'tcb', 'tcw', 'savi',
+            'msavi', 'ndmi', 'sr', 'rdvi', 'mtvii', 'psri', 'ci', 'nci',
+            'ndci', 'satvi', 'sf', 'ndii7', 'ndwi', 'sti',
+            'swir1', 'swir2', 'swir_ratio', 'aerosol')
+
+
+def load_plots(sf_fn, id_field):
+    """
+    returns a list of dicts with the plot id and the plot coordinates in
+    the crs of the shapefile and in WGS84
+    """
+    sf = fiona.open(sf_fn, 'r')
+
+    plots = []
+    for feature in sf:
+        x, y = feature['geometry']['coordinates'][:2]
+        plots.append(dict(site_id=feature['properties'][id_field], x=x, y=y))
+
+    lngs, lats = transform(sf.crs_wkt, 'EPSG:4326',
+                           [plot['x'] for plot in plots],
+                           [plot['y'] for plot in plots])
+    for plot, lng, lat in zip(plots, lngs, lats):
+        plot['lng'] = lng
+        plot['lat'] = lat
+
+    sf.close()
+    return plots
+
+
+def find_scenes(location):
+    scn_dirs = []
+    for rangesat_dir in RANGESAT_DIRS:
+        _scn_dirs = glob(_join(rangesat_dir, location, 'analyzed_rasters', '*'))
+        _scn_dirs = [fn for fn in _scn_dirs if isdir(fn)]
+        _scn_dirs = [fn for fn in _scn_dirs if len(glob(_join(fn, '*ndvi.tif'))) > 0]
+        scn_dirs.extend(_scn_dirs)
+    return sorted(scn_dirs)
+
+
+def partition_fn(out_dir, location, product_id):
+    year = product_id.split('_')[3][:4]
+    return _join(out_dir, 'location=%s' % location, 'year=%s' % year, '%s.parquet' % product_id)
+
+
+def _plots_in_scene(scn_dir, plots):
+    """
+    bbox pre-check. Uses the bounds of the ndvi raster so the scene does
+    not need to be opened as a LandSatScene
+    """
+    fn = [fn for fn in glob(_join(scn_dir, '*ndvi.tif')) if not fn.endswith('.wgs.tif')][0]
+    with rasterio.open(fn) as ds:
+        w, s, e, n = transform_bounds(ds.crs, 'EPSG:4326', *ds.bounds)
+
+    return [plot for plot in plots if w <= plot['lng'] <= e and s <= plot['lat'] <= n]
+
+
+def extract_scene(args):
+    location, scn_dir, plots, indices, window = args
+
+    _plots = _plots_in_scene(scn_dir, plots)
+    if len(_plots) == 0:
+        return location, _split(scn_dir)[-1], []
+
+    ls = LandSatScene(scn_dir)
+    samples = ls.sample([(plot['lng'], plot['lat']) for plot in _plots], indices, window=window)
+
+    rows = []
+    for plot, sample in zip(_plots, samples):
+        row = dict(site_id=plot['site_id'], lng=plot['lng'], lat=plot['lat'],
+                   product_id=ls.product_id, satellite=ls.satellite,
+                   acquisition_date=str(ls.acquisition_date),
+                   row=sample['row'], col=sample['col'])
+        for indexname in indices:
+            row[indexname] = sample[indexname]
+        rows.append(row)
+
+    return location, ls.product_id, rows
+
+
+def write_partition(dst_fn, rows, columns, dtypes):
+    head, tail = _split(dst_fn)
+    if not _exists(head):
+        os.makedirs(head, exist_ok=True)
+
+    # cast explicitly so empty partitions and all-masked columns share
+    # the schema of the rest of the dataset
+    df = pd.DataFrame(rows, columns=columns).astype(dtypes)
+
+    # write to a temporary file and rename so a partially written
+    # partition is never mistaken for a completed scene
+    tmp_fn = _join(head, '.%s.tmp' % tail)
+    df.to_parquet(tmp_fn, index=False)
+    os.replace(tmp_fn, dst_fn)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract index values at field plots from analyzed scenes.")
+    parser.add_argument("sf_fn", type=str, help="Point shapefile of field plots.")
+    parser.add_argument("locations", type=str, nargs='+', help="Locations to extract from.")
+    parser.add_argument("--id_field", type=str, default='SiteID', help="Plot id attribute.")
+    parser.add_argument("--out_dir", type=str, required=True, help="Root of the partitioned output.")
+    parser.add_argument("--window", type=int, default=1, choices=[1, 3, 5], help="Sample window size.")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count(),
+                        help="Number of worker processes.")
+    args = parser.parse_args()
+
+    indices = list(_metrics)
+    # location and year are encoded in the partition path
+    columns = ['site_id', 'lng', 'lat', 'product_id', 'satellite',
+               'acquisition_date', 'row', 'col'] + indices
+    dtypes = dict(site_id=str, lng=float, lat=float, product_id=str, satellite='int64',
+                  acquisition_date=str, row='int64', col='int64')
+    dtypes.update({indexname: float for indexname in indices})
+
+    plots = load_plots(os.path.abspath(args.sf_fn), args.id_field)
+
+    tasks = []
+    for location in args.locations:
+        for scn_dir in find_scenes(location):
+            if _exists(partition_fn(args.out_dir, location, _split(scn_dir)[-1])):
+                continue
+            tasks.append((location, scn_dir, plots, indices, args.window))
+
+    print('%i plots, %i scenes to extract' % (len(plots), len(tasks)))
+
+    t0 = time()
+    pool = multiprocessing.Pool(args.processes)
+    for i, (location, product_id, rows) in enumerate(pool.imap_unordered(extract_scene, tasks)):
+        write_partition(partition_fn(args.out_dir, location, product_id), rows, columns, dtypes)
+        print('{}\t{}\t{} of {}\t{} plots'.format(location, product_id, i + 1, len(tasks), len(rows)))
+
+    pool.close()
+    pool.join()
+    print('extracted %i scenes in %f seconds' % (len(tasks), time() - t0))
@@ -0,0 +1,77 @@
+"""
+Watches scene directories and ingests new archives as they are downloaded
+(see biomass.daemon). Run it from systemd, tmux or byobu.
+
+The queue depth and scene latencies are in <out_dir>/ingest_status.json
+
+Example usage:
+    > python3 ingest_daemon.py zumwalt4_config.yaml /geodata/nas/landsat/zumwalt/2024 --poll_interval 300
+"""
+
+import sys
+import os
+import signal
+import argparse
+
+from os.path import join as _join
+from os.path import exists as _exists
+
+_this_dir = os.path.dirname(__file__)
+sys.path.append(os.path.abspath(_join(_this_dir, '../../')))
+
+from biomass.ingest import SiteConfig
+from biomass.daemon import IngestDaemon
+from biomass.pipeline import DEFAULT_MODEL_WORKERS
+from database.manifest import open_manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Ingest the scene archives that appear in scene directories.")
+    parser.add_argument("cfg_fn", type=str, help="Path to the configuration file (.yaml).")
+    parser.add_argument("landsat_scene_directories", type=str, nargs='*',
+                        help="Directories to watch (default: landsat_scene_directory of the config).")
+    parser.add_argument("--poll_interval", type=int, default=60, help="Seconds between polls when idle.")
+    parser.add_argument("--settle", type=int, default=120,
+                        help="Seconds an archive must be unmodified before it is ingested.")
+    parser.add_argument("--batch_size", type=int, default=4, help="Scenes processed between polls.")
+    parser.add_argument("--no_validate", action='store_true', help="Do not validate the archives.")
+    parser.add_argument("--retry_failed", action='store_true', help="Retry scenes that failed previously.")
+    parser.add_argument("--extract_workers", type=int, default=2, help="Pipeline extract/clip workers.")
+    parser.add_argument("--model_workers", type=int, default=DEFAULT_MODEL_WORKERS,
+                        help="Pipeline modelling threads, they share the GIL (see biomass.pipeline).")
+    parser.add_argument("--write_workers", type=int, default=2, help="Pipeline export/reproject workers.")
+    parser.add_argument("--status_interval", type=int, default=None, help="Seconds between pipeline status lines.")
+    args = parser.parse_args()
+
+    assert args.cfg_fn.endswith('.yaml'), f"Is {args.cfg_fn} a config file?"
+
+    cfg = SiteConfig(args.cfg_fn)
+
+    scene_dirs = args.landsat_scene_directories
+    if len(scene_dirs) == 0:
+        assert cfg.landsat_scene_directory is not None, 'no landsat_scene_directory to watch'
+        scene_dirs = [cfg.landsat_scene_directory]
+
+    for scene_dir in scene_dirs:
+        assert _exists(scene_dir), f"landsat_scene_directory={scene_dir} directory does not exist"
+
+    if not _exists(cfg.out_dir):
+        os.makedirs(cfg.out_dir)
+
+    manifest = open_manifest(cfg.out_dir)
+    cfg.cleanup_scratch()
+
+    pipeline_kwargs = dict(extract_workers=args.extract_workers,
+                           model_workers=args.model_workers,
+                           write_workers=args.write_workers, status_interval=args.status_interval)
+
+    daemon = IngestDaemon(cfg, manifest, scene_dirs, poll_interval=args.poll_interval, settle=args.settle,
+                          batch_size=args.batch_size, validate=not args.no_validate,
+                          retry_failed=args.retry_failed, pipeline_kwargs=pipeline_kwargs)
+
+    # finish the current batch and exit
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: daemon.stop())
+
+    daemon.run()
+    cfg.close()
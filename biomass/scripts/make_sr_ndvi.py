@@ -7,34 +7,13 @@ from glob import glob
 import sys
 import os
 
-from subprocess import Popen
-
 import numpy as np
 
 
 sys.path.append('/var/www/rangesat-biomass/')
 
 from biomass.landsat import LandSatScene
-
-
-def reproject_raster(src):
-    dst = src[:-4] + '.wgs.vrt'
-    dst2 = src[:-4] + '.wgs.tif'
-
-    if _exists(dst):
-        os.remove(dst)
-    if _exists(dst2):
-        os.remove(dst2)
-
-    cmd = ['gdalwarp', '-t_srs', 'EPSG:4326', '-of', 'vrt', src, dst]
-    p = Popen(cmd)
-    p.wait()
-
-    cmd = ['gdal_translate', '-co', 'COMPRESS=LZW', '-of', 'GTiff', dst, dst2]
-    p = Popen(cmd)
-    p.wait()
-    assert _exists(dst)
-
+from biomass.reproject import reproject_raster
 
 
 def make_sr_ndvi(scene):
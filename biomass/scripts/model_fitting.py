@@ -15,7 +15,6 @@ sys.path.insert(0, '/var/www/rangesat-biomass')
 from database import Location
 
 from biomass.landsat import LandSatScene
-from all_your_base.locationinfo import RasterDatasetInterpolator
 
 from all_your_base import SCRATCH, RANGESAT_DIRS
 
@@ -74,22 +73,23 @@ if __name__ == "__main__":
         for fn in ls_fns:
             print('    ', fn)
 
-            rdi = RasterDatasetInterpolator(glob(_join(fn, '*ndvi.tif'))[0])
             ls = LandSatScene(fn)
 
-            for site in sites[location]:
+            # only the plot pixels are read and the plots are
+            # transformed to the scene crs once
+            points = [(site['lng'], site['lat']) for site in sites[location]]
+            samples = ls.sample(points, _metrics, window=1)
+
+            for site, sample in zip(sites[location], samples):
                 site_id = site['site_id']
                 lng = site['lng']
                 lat = site['lat']
                 d = {'location': location, 'site_id': site_id,
-                     'lng': lat, 'lat': lat, 'product_id': ls.product_id,
+                     'lng': lng, 'lat': lat, 'product_id': ls.product_id,
                      'acquisition_date': ls.acquisition_date}
 
-                py, px = rdi.get_px_coord_from_geo(lng, lat)
-
                 for indexname in _metrics:
-                    _metric = ls.get_index(indexname)[px, py]
-                    d[indexname] = _metric
+                    d[indexname] = sample[indexname]
 
                 if not header_written:
                     csv_wtr.writeheader()
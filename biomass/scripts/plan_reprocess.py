@@ -0,0 +1,89 @@
+"""
+Lists the processed scenes of a site whose outputs are stale after its
+config changed (model parameters, shapefile, bounds or the processing
+version) and the stages that need to run again (see biomass.planner).
+
+With --run the stale scenes are put back in the manifest and processed.
+Only their stale stages are redone, e.g. editing the Landsat 8 parameters
+of a model recomputes the biomass, pasture stats and reprojection of the
+Landsat 8 scenes from their clipped scenes.
+
+Example usage:
+    > python3 plan_reprocess.py zumwalt4_config.yaml
+    > python3 plan_reprocess.py zumwalt4_config.yaml --run --pipeline
+"""
+
+import sys
+import os
+import argparse
+from time import time
+
+from os.path import join as _join
+from os.path import exists as _exists
+
+_this_dir = os.path.dirname(__file__)
+sys.path.append(os.path.abspath(_join(_this_dir, '../../')))
+
+from biomass.ingest import SiteConfig, ScenePool, scene_members, default_workers
+from biomass.pipeline import ScenePipeline, DEFAULT_MODEL_WORKERS
+from biomass.planner import plan_site
+from database.manifest import open_manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="List and reprocess the scenes made stale by a config change.")
+    parser.add_argument("cfg_fn", type=str, help="Path to the configuration file (.yaml).")
+    parser.add_argument("--run", action='store_true', help="Reprocess the stale scenes.")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of worker processes (default: limited by cpus and SCRATCH space).")
+    parser.add_argument("--pipeline", action='store_true', help="Reprocess with the staged ScenePipeline.")
+    parser.add_argument("--model_workers", type=int, default=DEFAULT_MODEL_WORKERS,
+                        help="Pipeline modelling threads, they share the GIL (see biomass.pipeline).")
+    parser.add_argument("--write_workers", type=int, default=2, help="Pipeline export/reproject workers.")
+    args = parser.parse_args()
+
+    assert args.cfg_fn.endswith('.yaml'), f"Is {args.cfg_fn} a config file?"
+
+    t0 = time()
+    cfg = SiteConfig(args.cfg_fn)
+    assert _exists(cfg.out_dir), f"out_dir={cfg.out_dir} does not exist"
+
+    manifest = open_manifest(cfg.out_dir)
+    plan = plan_site(cfg, manifest)
+
+    fns = []
+    for scene in plan:
+        if scene['stale'] is None:
+            print('{}\tarchive not found'.format(scene['product_id']))
+            continue
+
+        print('{}\t{}'.format(scene['product_id'],
+                              '; '.join('{}: {}'.format(stage, reason) for stage, reason in scene['stale'].items())))
+        fns.append(scene['scn_fn'])
+
+    print('%i stale scenes' % len(fns))
+
+    if not args.run or len(fns) == 0:
+        cfg.close()
+        sys.exit()
+
+    manifest.requeue([fn for scn_fn in fns for fn in scene_members(scn_fn)])
+    cfg.cleanup_scratch()
+
+    if args.pipeline:
+        pool = ScenePipeline(cfg, manifest, extract_workers=default_workers(fns), model_workers=args.model_workers,
+                             write_workers=args.write_workers)
+        results = pool.run(fns)
+    else:
+        workers = args.workers or cfg.workers or default_workers(fns)
+        pool = ScenePool(args.cfg_fn, workers, manifest)
+        results = pool.imap(fns)
+
+    n = len(fns)
+    for i, _res in enumerate(results):
+        print('{}\t{} of {}\t{}\t{}'.format(_res['scn_fn'], i + 1, n, _res['status'], _res['elapsed']))
+        if _res['status'] == 'failed':
+            print(_res['error'])
+
+    cfg.close()
+    print('reprocessed %i scenes in %f seconds' % (n, time() - t0))
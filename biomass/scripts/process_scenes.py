@@ -1,69 +1,49 @@
 import sys
-import yaml
 import os
-import shutil
 import argparse
 import multiprocessing
-import csv
-import random
-import tarfile
 
-from glob import glob
 from time import time
 
-import os
 from os.path import join as _join
 from os.path import exists as _exists
-from os.path import split as _split
-
-import fiona
-import rasterio
 
 _this_dir = os.path.dirname(__file__)
-sys.path.append(os.path.abspath(_join(_this_dir , '../../')))
-
-from biomass.landsat import LandSatScene
-from biomass.rangesat_biomass import ModelPars, SatModelPars, BiomassModel
-from all_your_base import get_sf_wgs_bounds, GEODATA_DIRS, SCRATCH
-import subprocess
-
-from time import time
-
-
-GEODATA = GEODATA_DIRS[0]
-
-
-def process_scene(scn_fn):
-    p = subprocess.Popen(['python3', 'process_scene.py', cfg_fn, scn_fn],
-                         stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-    ret = p.communicate()
-    print(ret)
-
-    scn_path = scn_fn.replace('.tar.gz', '')
-    if _exists(SCRATCH):
-        scn_path = _join(SCRATCH, _split(scn_path)[-1])
-    if _exists(scn_path):
-        shutil.rmtree(scn_path)
-
-
-def is_processed(fn):
-    global out_dir
-    _fn = _split(fn)[-1].split('-')[0]
-#    res = glob(_join(out_dir, '{}_*_{}_{}_*_{}_{}'
-#               .format(_fn[:4], _fn[4:10], _fn[10:18], _fn[18:20], _fn[20:22])))
-    res = glob(_join(out_dir, fn.replace('.tar.gz', '') + '*.csv'))
-    return len(res) > 0 or _exists(_join(out_dir, '.{}'.format(_split(fn.replace('.tar.gz', ''))[-1])))
+sys.path.append(os.path.abspath(_join(_this_dir, '../../')))
 
-#
-# INITIALIZE GLOBAL VARIABLES
-#
-# This variables need to be in the global scope so that they
-# work with multiprocessing.
+from biomass.ingest import SiteConfig, ScenePool, find_scenes, default_workers
+from biomass.mosaic import group_same_date
+from biomass.pipeline import ScenePipeline, DEFAULT_MODEL_WORKERS
+from biomass.work_queue import LeaseQueue, lease_worker, open_locked_manifest
+from database.manifest import open_manifest
 
 
 parser = argparse.ArgumentParser(description="Process a configuration file and a Landsat scene directory.")
 parser.add_argument("cfg_fn", type=str, help="Path to the configuration file (must be a .yaml file).")
 parser.add_argument("landsat_scene_directory", type=str, help="Path to the Landsat scene directory.")
+parser.add_argument("--workers", type=int, default=None,
+                    help="Number of worker processes (default: limited by cpus and SCRATCH space).")
+parser.add_argument("--retry_failed", action='store_true', help="Retry scenes that failed previously.")
+parser.add_argument("--rescreen", action='store_true',
+                    help="Screen the scenes skipped for low pasture coverage again (e.g. with a new prescreen_coverage).")
+parser.add_argument("--pipeline", action='store_true',
+                    help="Overlap the extract, model and write stages of the scenes in one process.")
+parser.add_argument("--extract_workers", type=int, default=None,
+                    help="Pipeline extract/clip workers (default: limited by SCRATCH space).")
+parser.add_argument("--model_workers", type=int, default=DEFAULT_MODEL_WORKERS,
+                    help="Pipeline modelling threads, they share the GIL (see biomass.pipeline).")
+parser.add_argument("--write_workers", type=int, default=2, help="Pipeline export/reproject workers.")
+parser.add_argument("--queue_size", type=int, default=2, help="Scenes that can wait between pipeline stages.")
+parser.add_argument("--status_interval", type=int, default=60, help="Seconds between pipeline status lines.")
+parser.add_argument("--distributed", action='store_true',
+                    help="Claim scenes from a lease file queue shared with workers on other hosts.")
+parser.add_argument("--queue_dir", type=str, default=None,
+                    help="Queue directory on the shared filesystem (default: <out_dir>/queue).")
+parser.add_argument("--lease_timeout", type=int, default=900, help="Seconds without a heartbeat before a lease expires.")
+parser.add_argument("--heartbeat_interval", type=int, default=60, help="Seconds between lease heartbeats.")
+parser.add_argument("--poll_interval", type=int, default=None,
+                    help="Keep polling scenes leased by other workers to take over expired leases "
+                         "(default: sweep them once more before exiting).")
 
 args = parser.parse_args()
 
@@ -80,98 +60,78 @@ landsat_scene_directory = args.landsat_scene_directory
 print("Configuration file:", cfg_fn)
 print("Landsat scene directory:", landsat_scene_directory)
 
-with open(cfg_fn) as fp:
-    yaml_txt = fp.read()
-    yaml_txt = yaml_txt.replace('{GEODATA}', GEODATA)
-    _d = yaml.safe_load(yaml_txt)
-
-_models = _d['models']
-models = []
-for _m in _models:
-    _satellite_pars = {}
-    for pars in _m['satellite_pars']:
-        _satellite_pars[pars['satellite']] = SatModelPars(**pars)
-    models.append(ModelPars(_m['name'], _satellite_pars))
-
-# open shape file and determine the bounds
-sf_fn = _d['sf_fn']
-sf_fn = os.path.abspath(sf_fn)
-sf = fiona.open(sf_fn, 'r')
-bbox = get_sf_wgs_bounds(sf_fn)
-
-#landsat_scene_directory = '/geodata/nas/landsat/zumwalt/2020'
-#landsat_scene_directory = _join(_d['landsat_scene_directory'], 'collection2')
-#landsat_scene_directory = _d['landsat_scene_directory']
-
-wrs_blacklist = _d.get('wrs_blacklist', None)
-wrs_whitelist = _d.get('wrs_whitelist', None)
-years = _d.get('years', None)
-if years is not None:
-    years = [int(yr) for yr in years]
-
-sf_feature_properties_key = _d.get('sf_feature_properties_key', 'key')
-
-out_dir = _d['out_dir']
 
 if __name__ == '__main__':
     t0 = time()
-    use_multiprocessing = False
-#    if _exists(out_dir):
-#        shutil.rmtree(out_dir)
+
+    cfg = SiteConfig(cfg_fn)
+    out_dir = cfg.out_dir
+    cfg.cleanup_scratch()
 
     if not _exists(out_dir):
         os.makedirs(out_dir)
 
-    # find all the scenes
-#    fns = glob(_join(landsat_scene_directory, '*202*-*.tar.gz'))
-    fns = glob(_join(landsat_scene_directory, '**', '*.tar'), recursive=True)
-#    print(landsat_scene_directory, fns)
-
-    """
-    if wrs_blacklist:
-        _fns = []
-        for fn in fns:
-            if _split(fn)[-1][4:10] in wrs_blacklist:
-                continue
-            _fns.append(fn)
-
-        fns = _fns
-
-    if wrs_whitelist:
-        _fns = []
-        for fn in fns:
-            if _split(fn)[-1][4:10] in wrs_whitelist:
-                _fns.append(fn)
-
-        fns = _fns
-     """
-
-    fns = [fn for fn in fns if not is_processed(fn)]
-
-#    fns = [fn for fn in fns if not _exists(_join(out_dir, '.' +  _split(fn)[-1].replace('.tar.gz', '')))]
-#    random.shuffle(fns)
-
-#    if years:
-#        _fns = []
-#        for fn in fns:
-#            if int(_split(fn)[-1][10:14]) in years:
-#                _fns.append(fn)
-#
-#        fns = _fns
-
-    if use_multiprocessing:
-        # run the model
-        pool = multiprocessing.Pool(multiprocessing.cpu_count())
-        _results = pool.map(process_scene, fns)
+    queue = None
+    if args.distributed:
+        # the manifest is shared with the workers of other hosts
+        queue = LeaseQueue(args.queue_dir or _join(out_dir, 'queue'), lease_timeout=args.lease_timeout,
+                           heartbeat_interval=args.heartbeat_interval, config_hash=cfg.config_hash)
+        manifest = open_locked_manifest(out_dir, queue.db_lock)
     else:
-        _results = []
-        n = len(fns)
-        for i, fn in enumerate(fns):
-            t0 = time()
-            print('{}\t{} of {}...'.format(fn, i+1, n), end='')
-            _results.append(process_scene(fn))
-            print(time()-t0)
-
-    sf.close()
-    print('processed %i scenes in %f seconds' % (len(fns), time() - t0))
+        manifest = open_manifest(out_dir)
+
+    # find all the scenes that have not been processed
+    fns = find_scenes(landsat_scene_directory, manifest, retry_failed=args.retry_failed, rescreen=args.rescreen)
+
+    # same-date archives of overlapping paths/rows are processed as one mosaic
+    if cfg.mosaic_same_date:
+        fns = group_same_date(fns, cfg.bbox)
+        print('%i same-date mosaics' % sum(1 for fn in fns if not isinstance(fn, str)))
+
+    if args.distributed:
+        # the queue markers of earlier runs are cleared for the scenes the
+        # manifest lists as unprocessed (requeued, rescreened or retried)
+        queue.requeue(fns, retry_failed=args.retry_failed)
+
+        workers = args.workers or cfg.workers or default_workers(fns)
+        print('processing %i scenes from %s with %i local workers' % (len(fns), queue.queue_dir, workers))
+
+        queue_kwargs = dict(lease_timeout=args.lease_timeout, heartbeat_interval=args.heartbeat_interval)
+        procs = [multiprocessing.Process(target=lease_worker, args=(cfg_fn, fns, queue.queue_dir),
+                                         kwargs=dict(queue_kwargs, poll_interval=args.poll_interval))
+                 for _ in range(workers)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+
+        print(queue.status(fns))
+        queue.close()
+        cfg.close()
+        print('processed %i scenes in %f seconds' % (len(fns), time() - t0))
+        sys.exit()
+
+    if args.pipeline:
+        extract_workers = args.extract_workers or default_workers(fns)
+        print('processing %i scenes with %i extract, %i model and %i write workers' %
+              (len(fns), extract_workers, args.model_workers, args.write_workers))
+
+        pool = ScenePipeline(cfg, manifest, extract_workers=extract_workers, model_workers=args.model_workers,
+                             write_workers=args.write_workers, queue_size=args.queue_size,
+                             status_interval=args.status_interval, retry_failed=args.retry_failed)
+        results = pool.run(fns)
+    else:
+        workers = args.workers or cfg.workers or default_workers(fns)
+        print('processing %i scenes with %i workers' % (len(fns), workers))
 
+        pool = ScenePool(cfg_fn, workers, manifest)
+        results = pool.imap(fns)
+
+    n = len(fns)
+    for i, _res in enumerate(results):
+        print('{}\t{} of {}\t{}\t{}'.format(_res['scn_fn'], i + 1, n, _res['status'], _res['elapsed']))
+        if _res['status'] == 'failed':
+            print(_res['error'])
+
+    cfg.close()
+    print('processed %i scenes in %f seconds' % (len(fns), time() - t0))
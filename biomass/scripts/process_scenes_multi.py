@@ -0,0 +1,77 @@
+"""
+Processes the scene archives of a directory for several site configs in
+one pass. Every archive is extracted once and clipped, modelled and
+analyzed for each site it overlaps (see biomass.fanout).
+
+Example usage:
+    > python3 process_scenes_multi.py zumwalt2_config.yaml zumwalt3_config.yaml zumwalt4_config.yaml \
+          zumwalt5_config.yaml --landsat_scene_directory /geodata/nas/landsat/zumwalt/2024
+"""
+
+import sys
+import os
+import argparse
+from time import time
+
+from os.path import join as _join
+from os.path import exists as _exists
+
+_this_dir = os.path.dirname(__file__)
+sys.path.append(os.path.abspath(_join(_this_dir, '../../')))
+
+from biomass.ingest import SiteConfig, find_scenes, default_workers
+from biomass.fanout import FanOutPool
+from database.manifest import open_manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Process a Landsat scene directory for several configuration files.")
+    parser.add_argument("cfg_fns", type=str, nargs='+', help="Paths to the configuration files (.yaml).")
+    parser.add_argument("--landsat_scene_directory", type=str, required=True, help="Path to the Landsat scene directory.")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of worker processes (default: limited by cpus and SCRATCH space).")
+    parser.add_argument("--retry_failed", action='store_true', help="Retry scenes that failed previously.")
+    args = parser.parse_args()
+
+    for cfg_fn in args.cfg_fns:
+        assert cfg_fn.endswith('.yaml'), f"Is {cfg_fn} a config file?"
+
+    assert _exists(args.landsat_scene_directory), \
+        f"landsat_scene_directory={args.landsat_scene_directory} directory does not exist"
+
+    t0 = time()
+
+    # archives that still need to be processed for any of the sites
+    fns = set()
+    manifests = []
+    for cfg_fn in args.cfg_fns:
+        cfg = SiteConfig(cfg_fn)
+        if not _exists(cfg.out_dir):
+            os.makedirs(cfg.out_dir)
+
+        if cfg.mosaic_same_date:
+            print('warning: %s mosaics same-date scenes, the archives are processed individually' % cfg_fn)
+
+        # the sites share SCRATCH, it is cleaned up once
+        if cfg_fn == args.cfg_fns[0]:
+            cfg.cleanup_scratch()
+
+        manifest = open_manifest(cfg.out_dir)
+        manifests.append(manifest)
+        fns.update(find_scenes(args.landsat_scene_directory, manifest, retry_failed=args.retry_failed))
+        cfg.close()
+    fns = sorted(fns)
+
+    workers = args.workers or default_workers(fns)
+    print('processing %i scenes for %i sites with %i workers' % (len(fns), len(args.cfg_fns), workers))
+
+    n = len(fns)
+    pool = FanOutPool(args.cfg_fns, workers, manifests, retry_failed=args.retry_failed)
+    for i, results in enumerate(pool.imap(fns)):
+        for _res in results:
+            print('{}\t{} of {}\t{}\t{}\t{}'.format(_res['scn_fn'], i + 1, n, _res['cfg_fn'],
+                                                    _res['status'], _res['elapsed']))
+            if _res['status'] == 'failed':
+                print(_res['error'])
+
+    print('processed %i scenes in %f seconds' % (len(fns), time() - t0))
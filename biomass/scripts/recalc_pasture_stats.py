@@ -2,7 +2,6 @@ import sys
 import yaml
 import os
 import shutil
-from subprocess import Popen
 import multiprocessing
 import csv
 import random
@@ -26,6 +25,7 @@ sys.path.insert(0, '/Users/roger/rangesat-biomass')
 
 from biomass.landsat import LandSatScene, get_gz_scene_bounds
 from biomass.rangesat_biomass import ModelPars, SatModelPars, BiomassModel
+from biomass.reproject import reproject_scene
 from all_your_base import get_sf_wgs_bounds, bounds_intersect, bounds_contain, SCRATCH
 
 
@@ -117,42 +117,6 @@ def recalc_pasturestats(scn_path):
     return dict(res=res, ls_summary=ls_summary)
 
 
-def _contains_any(target, matches):
-    for match in matches:
-        if match in target:
-            return True
-
-    return False
-
-
-def reproject_scene(scn_dir):
-    fns = glob(_join(scn_dir, '*.tif'))
-    fns = [fn for fn in fns if _contains_any(fn, ['rgb', 'ndvi'])]
-    fns.extend(glob(_join(scn_dir, '*/*.tif')))
-    fns = [fn for fn in fns if not fn.endswith('.wgs.tif')]
-    for fn in fns:
-        reproject_raster(fn)
-
-
-def reproject_raster(src):
-    dst = src[:-4] + '.wgs.vrt'
-    dst2 = src[:-4] + '.wgs.tif'
-
-    if _exists(dst):
-        os.remove(dst)
-    if _exists(dst2):
-        os.remove(dst2)
-
-    cmd = ['gdalwarp', '-t_srs', 'EPSG:4326', '-of', 'vrt', src, dst]
-    p = Popen(cmd)
-    p.wait()
-
-    cmd = ['gdal_translate', '-co', 'COMPRESS=LZW', '-of', 'GTiff', dst, dst2]
-    p = Popen(cmd)
-    p.wait()
-    assert _exists(dst)
-
-
 def dump_pasture_stats(results, dst_fn):
     with open(dst_fn, 'w', newline='') as _fp:
         fieldnames = ['product_id', 'key', 'total_px', 'snow_px', 'water_px',
@@ -236,6 +200,7 @@ if __name__ == '__main__':
 
     dirs = glob(_join(out_dir, '*/'))
 
+    _dirs = []
     for _dir in dirs:
         p = Path(_dir)
         sat, prod, wrs, acq, processed, collection, p2 = p.stem.split('_')
@@ -245,13 +210,22 @@ if __name__ == '__main__':
         
         if len(fns) == 0:
             print(prefix, len(fns) > 0)
-            prefix = f'{sat}{wrs}{acq}{collection}{p2}-pasture_stats.csv'
-
-            try:        
-                res = recalc_pasturestats(_dir)
-                dump_pasture_stats([res], _join(out_dir, prefix))
-            except:
-                'ERROR: Recalculation Failed'
+            _dirs.append(_dir)
+
+    # scenes sharing a grid share the rasterized pastures and the
+    # results are written as soon as each scene finishes
+    results = BiomassModel.analyze_many(_dirs, models, sf, sf_feature_properties_key,
+                                        sf_feature_properties_delimiter,
+                                        processes=multiprocessing.cpu_count())
+    for res in results:
+        if 'error' in res:
+            print('ERROR: Recalculation Failed', res['scn_dir'])
+            print(res['error'])
+            continue
+
+        sat, prod, wrs, acq, processed, collection, p2 = res['ls_summary']['product_id'].split('_')
+        prefix = f'{sat}{wrs}{acq}{collection}{p2}-pasture_stats.csv'
+        dump_pasture_stats([res], _join(out_dir, prefix))
 
 
 #    for root, dirs, files in os.walk(out_dir, topdown=False):
@@ -2,7 +2,6 @@ import sys
 import yaml
 import os
 import shutil
-from subprocess import Popen
 import multiprocessing
 import csv
 import random
@@ -25,6 +24,7 @@ sys.path.insert(0, '/Users/roger/rangesat-biomass')
 
 from biomass.landsat import LandSatScene, get_gz_scene_bounds
 from biomass.rangesat_biomass import ModelPars, SatModelPars, BiomassModel
+from biomass.reproject import reproject_scene
 from all_your_base import get_sf_wgs_bounds, bounds_intersect, SCRATCH
 
 
@@ -63,42 +63,6 @@ def reprocess_scene(scn_fn, verbose=True):
     return dict(res=res, ls_summary=ls_summary)
 
 
-def _contains_any(target, matches):
-    for match in matches:
-        if match in target:
-            return True
-
-    return False
-
-
-def reproject_scene(scn_dir):
-    fns = glob(_join(scn_dir, '*.tif'))
-    fns = [fn for fn in fns if _contains_any(fn, ['rgb', 'ndvi'])]
-    fns.extend(glob(_join(scn_dir, '*/*.tif')))
-    fns = [fn for fn in fns if not fn.endswith('.wgs.tif')]
-    for fn in fns:
-        reproject_raster(fn)
-
-
-def reproject_raster(src):
-    dst = src[:-4] + '.wgs.vrt'
-    dst2 = src[:-4] + '.wgs.tif'
-
-    if _exists(dst):
-        os.remove(dst)
-    if _exists(dst2):
-        os.remove(dst2)
-
-    cmd = ['gdalwarp', '-t_srs', 'EPSG:4326', '-of', 'vrt', src, dst]
-    p = Popen(cmd)
-    p.wait()
-
-    cmd = ['gdal_translate', '-co', 'COMPRESS=LZW', '-of', 'GTiff', dst, dst2]
-    p = Popen(cmd)
-    p.wait()
-    assert _exists(dst)
-
-
 def dump_pasture_stats(results, dst_fn):
     with open(dst_fn, 'w', newline='') as _fp:
         fieldnames = ['product_id', 'key', 'total_px', 'snow_px', 'water_px',
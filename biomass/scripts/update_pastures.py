@@ -0,0 +1,96 @@
+"""
+Updates the pasture stats of the processed scenes of a site after its
+pasture shapefile was edited. Only the added and modified pastures are
+analyzed again and the stats of removed pastures are deleted (see
+biomass.pastures).
+
+The fingerprints of the pastures are recorded when the stats of the
+first scene of a site are written. Sites processed before the
+fingerprints were recorded need the shapefile the stats were computed
+with as --baseline (the current shapefile if it has not been edited).
+
+Example usage:
+    > python3 update_pastures.py zumwalt4_config.yaml --baseline /geodata/rangesat/Zumwalt4/Zumwalt2022.shp
+"""
+
+import sys
+import os
+import argparse
+import multiprocessing
+from time import time
+
+import fiona
+
+from os.path import join as _join
+from os.path import exists as _exists
+
+_this_dir = os.path.dirname(__file__)
+sys.path.append(os.path.abspath(_join(_this_dir, '../../')))
+
+from biomass.ingest import SiteConfig
+from biomass.pastures import pasture_fingerprints, load_fingerprints, save_fingerprints, diff_fingerprints, \
+    update_pastures
+from database.manifest import open_manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Update the pasture stats of a site after its shapefile changed.")
+    parser.add_argument("cfg_fn", type=str, help="Path to the configuration file (.yaml).")
+    parser.add_argument("--baseline", type=str, default=None,
+                        help="Shapefile the stats were computed with (default: the recorded fingerprints).")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count(),
+                        help="Scenes analyzed concurrently.")
+    parser.add_argument("--dry_run", action='store_true', help="Only list the changed pastures.")
+    args = parser.parse_args()
+
+    assert args.cfg_fn.endswith('.yaml'), f"Is {args.cfg_fn} a config file?"
+
+    t0 = time()
+    cfg = SiteConfig(args.cfg_fn)
+    assert _exists(cfg.out_dir), f"out_dir={cfg.out_dir} does not exist"
+
+    current = pasture_fingerprints(cfg.sf, cfg.sf_feature_properties_key)
+
+    if args.baseline is not None:
+        with fiona.open(args.baseline) as sf:
+            previous = pasture_fingerprints(sf, cfg.sf_feature_properties_key)
+    else:
+        previous = load_fingerprints(cfg.out_dir)
+
+    if previous is None:
+        # recording the current pastures would absorb an edit made since
+        # the stats were computed
+        cfg.close()
+        sys.exit('%s has no pasture fingerprints, pass the shapefile the stats were computed with as --baseline'
+                 % cfg.out_dir)
+
+    added, modified, removed = diff_fingerprints(previous, current)
+    print('added:', ', '.join(added) or '-')
+    print('modified:', ', '.join(modified) or '-')
+    print('removed:', ', '.join(removed) or '-')
+
+    if args.dry_run:
+        sys.exit()
+
+    if len(added) + len(modified) + len(removed) == 0:
+        save_fingerprints(cfg.out_dir, current, sf_fn=cfg.sf_fn)
+        print('the pastures have not changed')
+        sys.exit()
+
+    manifest = open_manifest(cfg.out_dir)
+    summary = update_pastures(cfg, manifest, added, modified, removed, processes=args.processes)
+
+    failed = 0
+    for res in summary:
+        print('{}\t{}\t{}'.format(res['product_id'], res['status'], res['rows']))
+        if res['status'] == 'failed':
+            print(res['error'])
+            failed += 1
+
+    # the fingerprints are only advanced once every scene is updated so a
+    # rerun picks up the scenes that failed
+    if failed == 0:
+        save_fingerprints(cfg.out_dir, current, sf_fn=cfg.sf_fn)
+
+    cfg.close()
+    print('updated %i scenes (%i failed) in %f seconds' % (len(summary), failed, time() - t0))
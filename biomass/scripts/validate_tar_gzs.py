@@ -1,42 +1,67 @@
-import tarfile
-from glob import glob
+"""
+Validates the scene archives of a directory without extracting them and
+records the results in the processing manifests of the sites.
+
+Invalid archives are marked invalid in the manifests (so they are not
+processed) and listed in --not_valid. They are not deleted.
+
+Example usage:
+    > python3 validate_tar_gzs.py /geodata/torch-landsat --out_dirs /var/www/rangesat-biomass/sites/Zumwalt4/analyzed_rasters
+"""
+
+import sys
 import os
+import argparse
+import multiprocessing
+from glob import glob
 from os.path import join as _join
-from os.path import split as _split
-import shutil
-
-SCRATCH = '/media/ramdisk'
-
-def tar_gz_is_valid(tar_fn):
-    
-    scn_path = _join(SCRATCH, _split(tar_fn)[-1].replace('.tar.gz', ''))
-    is_valid = False
-    try:
-        tar = tarfile.open(tar_fn)
-        tar.extractall(path=scn_path)
-        tar.close()
-        is_valid = True
-    except:
-        pass
-
-    try:
-        shutil.rmtree(scn_path)
-    except:
-        pass
-
-    return is_valid
-        
+from os.path import getmtime
+
+_this_dir = os.path.dirname(__file__)
+sys.path.append(os.path.abspath(_join(_this_dir, '../../')))
+
+from biomass.validation import validate_archive
+from database.manifest import ProcessingManifest, archive_name
+
+
 if __name__ == "__main__":
-    fp = open('not_valid.txt', 'w')
-
-    tar_fns = glob('/geodata/torch-landsat/*.tar.gz')
-    for fn in tar_fns:
-        print(fn)
-        is_valid = tar_gz_is_valid(fn)
-        print(is_valid)
-        if not is_valid:
-            fp.write(fn + '\n')
-            os.remove(fn)
-
-    fp.close()
-       
+    parser = argparse.ArgumentParser(description="Validate scene archives.")
+    parser.add_argument("landsat_scene_directory", type=str, help="Directory with .tar/.tar.gz archives.")
+    parser.add_argument("--out_dirs", type=str, nargs='*', default=[],
+                        help="Site out_dirs whose manifests record the results.")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count(),
+                        help="Archives validated concurrently.")
+    parser.add_argument("--revalidate", action='store_true',
+                        help="Validate archives that have not changed since they were last validated.")
+    parser.add_argument("--not_valid", type=str, default='not_valid.txt', help="File listing the invalid archives.")
+    args = parser.parse_args()
+
+    tar_fns = glob(_join(args.landsat_scene_directory, '**', '*.tar.gz'), recursive=True) + \
+              glob(_join(args.landsat_scene_directory, '**', '*.tar'), recursive=True)
+    tar_fns = sorted(tar_fns)
+
+    manifests = [ProcessingManifest.for_out_dir(out_dir) for out_dir in args.out_dirs]
+
+    if not args.revalidate and len(manifests) > 0:
+        # archives that have not been modified since every manifest validated them
+        validated = [m.validated() for m in manifests]
+        tar_fns = [fn for fn in tar_fns
+                   if not all(d.get(archive_name(fn), 0.0) > getmtime(fn) for d in validated)]
+
+    print('validating %i archives with %i processes' % (len(tar_fns), args.processes))
+
+    n_invalid = 0
+    with open(args.not_valid, 'w') as fp, multiprocessing.Pool(args.processes) as pool:
+        for i, res in enumerate(pool.imap_unordered(validate_archive, tar_fns)):
+            fn = res['tar_fn']
+            print('{}\t{} of {}\t{}\t{:.1f}s\t{}'.format(fn, i + 1, len(tar_fns), res['valid'],
+                                                      res['elapsed'], res['error'] or ''))
+
+            for manifest in manifests:
+                manifest.record_validation(fn, res['valid'], checksum=res['md5'], error=res['error'])
+
+            if not res['valid']:
+                n_invalid += 1
+                fp.write(fn + '\n')
+
+    print('%i of %i archives are not valid' % (n_invalid, len(tar_fns)))
@@ -0,0 +1,178 @@
+"""
+Streaming integrity validation of scene archives.
+
+An archive is read once from start to end. The tar headers are checked as
+the archive is streamed, every member is read to verify its size, the
+GeoTIFF members are checked for a TIFF header and the MD5 (and SHA
+checksums when an ESPA checksum file is next to the archive) are computed
+from the same stream. The members the biomass models need (the MTL xml,
+the qa band and the surface reflectance bands) must be present.
+
+Nothing is extracted to disk.
+"""
+
+import re
+import hashlib
+import tarfile
+from time import time
+
+from os.path import exists as _exists
+from os.path import split as _split
+
+
+_blocksize = 2**20
+
+_tiff_magic = (b'II*\x00', b'MM\x00*', b'II+\x00', b'MM\x00+')
+
+_checksum_exts = (('.md5', 'md5'), ('.sha256', 'sha256'), ('.sha1', 'sha1'))
+
+
+class _HashingReader(object):
+    """
+    file object wrapper that updates hashes with the bytes that are read
+    """
+    def __init__(self, fp, algorithms):
+        self.fp = fp
+        self.hashes = {alg: hashlib.new(alg) for alg in algorithms}
+        self.nbytes = 0
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        for h in self.hashes.values():
+            h.update(data)
+        self.nbytes += len(data)
+        return data
+
+    def drain(self):
+        while len(self.read(_blocksize)) > 0:
+            pass
+
+
+def archive_stem(tar_fn):
+    return tar_fn.replace('.tar.gz', '').replace('.tar', '')
+
+
+def read_checksum_file(tar_fn):
+    """
+    returns (algorithm, hex digest) from an ESPA checksum file next to the
+    archive (<scene>.md5 or <archive>.md5, .sha256, .sha1) or None
+    """
+    name = _split(tar_fn)[-1]
+    for ext, alg in _checksum_exts:
+        for fn in (archive_stem(tar_fn) + ext, tar_fn + ext):
+            if not _exists(fn):
+                continue
+
+            with open(fn) as fp:
+                lines = [line.split() for line in fp.read().splitlines() if line.strip() != '']
+
+            # "<digest>  <filename>" lines or a bare digest
+            for line in lines:
+                if len(line) == 1 or line[-1].lstrip('*') == name:
+                    return alg, line[0].lower()
+
+    return None
+
+
+def expected_members(product_id):
+    """
+    suffixes of the members a scene needs
+    """
+    satellite = int(product_id.split('_')[0][2:])
+
+    if '_L2SP_' in product_id.upper():
+        if satellite in (8, 9):
+            bands = ['sr_b2', 'sr_b3', 'sr_b4', 'sr_b5', 'sr_b6', 'sr_b7']
+        else:
+            bands = ['sr_b1', 'sr_b2', 'sr_b3', 'sr_b4', 'sr_b5', 'sr_b7']
+        return ['.xml', 'qa_pixel.tif'] + ['%s.tif' % b for b in bands]
+
+    if satellite == 8:
+        bands = ['sr_band2', 'sr_band3', 'sr_band4', 'sr_band5', 'sr_band6', 'sr_band7']
+    else:
+        bands = ['sr_band1', 'sr_band2', 'sr_band3', 'sr_band4', 'sr_band5', 'sr_band7']
+    return ['.xml', 'pixel_qa.tif'] + ['%s.tif' % b for b in bands]
+
+
+_product_id_re = re.compile(r'(L[CTEMO]0\d_\w+?_\d{6}_\d{8}_\d{8}_\d{2}_\w{2})')
+
+
+def validate_archive(tar_fn):
+    """
+    streams an archive once and validates it
+
+    :return: dict(tar_fn, valid, error, md5, checksum_verified, members, nbytes, elapsed)
+             checksum_verified is None when there is no checksum file
+    """
+    t0 = time()
+    expected = read_checksum_file(tar_fn)
+    algorithms = ['md5']
+    if expected is not None and expected[0] not in algorithms:
+        algorithms.append(expected[0])
+
+    res = dict(tar_fn=tar_fn, valid=False, error=None, md5=None, checksum_verified=None,
+               members=0, nbytes=0)
+
+    names = []
+    try:
+        with open(tar_fn, 'rb') as fp:
+            reader = _HashingReader(fp, algorithms)
+
+            # streaming mode reads the archive sequentially and raises on
+            # corrupt headers and truncated members
+            with tarfile.open(fileobj=reader, mode='r|*') as tar:
+                for member in tar:
+                    names.append(member.name)
+                    if not member.isfile():
+                        continue
+
+                    src = tar.extractfile(member)
+                    head = src.read(4)
+                    size = len(head)
+                    while True:
+                        block = src.read(_blocksize)
+                        if len(block) == 0:
+                            break
+                        size += len(block)
+
+                    if size != member.size:
+                        raise Exception('%s is truncated (%i of %i bytes)' % (member.name, size, member.size))
+
+                    if member.name.lower().endswith('.tif') and head not in _tiff_magic:
+                        raise Exception('%s is not a tiff' % member.name)
+
+            # the end of archive blocks are part of the checksum
+            reader.drain()
+
+        res['members'] = len(names)
+        res['nbytes'] = reader.nbytes
+        res['md5'] = reader.hashes['md5'].hexdigest()
+
+        if expected is not None:
+            alg, digest = expected
+            res['checksum_verified'] = reader.hashes[alg].hexdigest() == digest
+            if not res['checksum_verified']:
+                raise Exception('%s checksum does not match %s' % (alg, digest))
+
+        match = None
+        for name in names:
+            match = _product_id_re.search(_split(name)[-1])
+            if match is not None:
+                break
+
+        if match is None:
+            raise Exception('no scene members')
+
+        product_id = match.group(1)
+        basenames = [_split(name)[-1].lower() for name in names]
+        missing = [suffix for suffix in expected_members(product_id)
+                   if not any(b.endswith(suffix) for b in basenames)]
+        if len(missing) > 0:
+            raise Exception('missing members: %s' % ', '.join(missing))
+
+        res['valid'] = True
+    except Exception as e:
+        res['error'] = '%s: %s' % (type(e).__name__, e)
+
+    res['elapsed'] = time() - t0
+    return res
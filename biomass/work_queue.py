@@ -0,0 +1,480 @@
+"""
+Work queue on a shared filesystem for processing scenes on several hosts.
+
+Workers on any number of hosts point at the same queue directory on the
+NAS and scan the same list of archives. A worker processes an archive
+only while it holds its lease file:
+
+    <queue_dir>/leases/<archive>.lease   created with O_CREAT | O_EXCL
+    <queue_dir>/done/<archive>.json      result of a completed archive
+    <queue_dir>/failed/<archive>.json    attempts and the last error
+    <queue_dir>/db.lock                  held while using the databases
+
+The done and failed markers carry a ticket, the hash of the identity
+(name, size and mtime) of the archives and the site config. A marker
+written for another download of an archive or with another config is
+ignored. The driver (process_scenes.py --distributed) clears the markers
+of the archives the manifest lists as unprocessed (requeued by the
+planner, rescreened or failed with --retry_failed) before the workers
+start.
+
+The holder of a lease touches it every heartbeat_interval seconds. A lease
+that has not been touched for lease_timeout seconds belongs to a dead or
+hung worker and is broken (renamed away, so only one worker can break it)
+by the next worker that wants the archive. Lease ages are measured against
+the clock of the file server so the clocks of the hosts do not need to
+agree.
+
+SQLite locking is not reliable over NFS so the queue only relies on
+exclusive creates and renames. The workers of every host read and write
+the manifest and the location database of out_dir while holding the db
+lock of the queue (SharedLock), so only one of them uses the databases
+at a time. The outputs of a scene are written atomically, the pasture
+stats are upserted and the manifest transitions are idempotent, so a
+scene that is processed again after its lease expired commits the same
+results.
+
+Without a poll_interval a worker scans the archives once and sweeps the
+ones leased elsewhere once more before it exits, taking over the leases
+that expired meanwhile. A lease of a worker that dies after the sweep
+of the last worker is only taken over by the next run (or by workers
+that poll).
+"""
+
+import os
+import json
+import random
+import socket
+import threading
+import traceback
+from time import time, sleep
+
+from os.path import join as _join
+from os.path import exists as _exists
+
+from biomass.checkpoint import atomic_output, file_identity, input_hash
+from database.manifest import archive_name
+
+
+class SharedLock(object):
+    """
+    lock shared by the workers of all hosts, a file in the queue directory
+    created with O_CREAT | O_EXCL. A lock file older than the lease
+    timeout of the queue was left by a dead worker and is broken
+    """
+    def __init__(self, queue, name, poll_interval=0.2):
+        self.queue = queue
+        self.lock_fn = _join(queue.queue_dir, '%s.lock' % name)
+        self.poll_interval = poll_interval
+
+    def acquire(self):
+        while True:
+            try:
+                fd = os.open(self.lock_fn, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self.queue._break_expired(self.lock_fn):
+                    sleep(self.poll_interval * (1.0 + random.random()))
+                continue
+
+            with os.fdopen(fd, 'w') as fp:
+                fp.write(self.queue.worker_id)
+            return
+
+    def release(self):
+        # the lock may have been broken if it was held past the timeout
+        try:
+            with open(self.lock_fn) as fp:
+                if fp.read() == self.queue.worker_id:
+                    os.remove(self.lock_fn)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.release()
+
+
+class LockedManifest(object):
+    """
+    ProcessingManifest whose methods are called holding a SharedLock
+    """
+    def __init__(self, manifest, lock):
+        self._manifest = manifest
+        self._lock = lock
+
+    def __getattr__(self, name):
+        attr = getattr(self._manifest, name)
+        if not callable(attr):
+            return attr
+
+        def _locked(*args, **kwargs):
+            with self._lock:
+                return attr(*args, **kwargs)
+        return _locked
+
+
+def open_locked_manifest(out_dir, lock):
+    """
+    opens (or seeds) the manifest of out_dir holding lock
+    """
+    from database.manifest import open_manifest
+
+    with lock:
+        manifest = open_manifest(out_dir)
+    return LockedManifest(manifest, lock)
+
+
+class LeaseQueue(object):
+    """
+    :param queue_dir: directory on the shared filesystem
+    :param lease_timeout: seconds without a heartbeat before a lease expires
+    :param heartbeat_interval: seconds between heartbeats
+    :param max_attempts: archives that failed this many times are skipped
+    :param config_hash: hash of the site config the markers are valid for
+    """
+    def __init__(self, queue_dir, lease_timeout=900, heartbeat_interval=60, max_attempts=2, worker_id=None,
+                 config_hash=None):
+        assert heartbeat_interval < lease_timeout
+
+        if worker_id is None:
+            worker_id = '%s.%i' % (socket.gethostname(), os.getpid())
+
+        self.queue_dir = queue_dir
+        self.lease_timeout = lease_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.max_attempts = max_attempts
+        self.worker_id = worker_id
+        self.config_hash = config_hash
+
+        self.leases_dir = _join(queue_dir, 'leases')
+        self.done_dir = _join(queue_dir, 'done')
+        self.failed_dir = _join(queue_dir, 'failed')
+        for d in (self.leases_dir, self.done_dir, self.failed_dir):
+            os.makedirs(d, exist_ok=True)
+
+        self._held = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+        # serializes the use of the SQLite databases in out_dir
+        self.db_lock = SharedLock(self, 'db')
+
+    @staticmethod
+    def _name(fn):
+        # same-date scenes are leased under their first archive
+        if not isinstance(fn, str):
+            fn = fn[0]
+        return archive_name(fn)
+
+    def _lease_fn(self, fn):
+        return _join(self.leases_dir, '%s.lease' % self._name(fn))
+
+    def _done_fn(self, fn):
+        return _join(self.done_dir, '%s.json' % self._name(fn))
+
+    def _failed_fn(self, fn):
+        return _join(self.failed_dir, '%s.json' % self._name(fn))
+
+    @property
+    def _clock_fn(self):
+        return _join(self.queue_dir, '.clock.%s' % self.worker_id)
+
+    def _server_now(self):
+        """
+        current time of the file server (the mtime of a freshly touched file)
+        """
+        clock_fn = self._clock_fn
+        with open(clock_fn, 'a'):
+            pass
+        os.utime(clock_fn)
+        return os.stat(clock_fn).st_mtime
+
+    def _break_expired(self, lock_fn):
+        """
+        breaks a lease or lock file that has not been touched for
+        lease_timeout seconds. Returns True if the file is gone (broken
+        or released), False if it is held by a live worker
+        """
+        try:
+            age = self._server_now() - os.stat(lock_fn).st_mtime
+        except FileNotFoundError:
+            return True
+
+        if age < self.lease_timeout:
+            return False
+
+        # only one worker wins the rename
+        broken_fn = '%s.expired.%s' % (lock_fn, self.worker_id)
+        try:
+            os.rename(lock_fn, broken_fn)
+        except FileNotFoundError:
+            return True
+
+        # another worker may have broken the file and created a new one
+        # since it was checked. Put the fresh file back (link fails if it
+        # has been created again meanwhile)
+        if self._server_now() - os.stat(broken_fn).st_mtime < self.lease_timeout:
+            try:
+                os.link(broken_fn, lock_fn)
+            except FileExistsError:
+                pass
+            os.remove(broken_fn)
+            return False
+
+        os.remove(broken_fn)
+        print('broke expired %s (%i s old)' % (os.path.basename(lock_fn), age))
+        return True
+
+    def _ticket(self, fn):
+        """
+        hash of the identity of the archives of a scene and the site config
+        """
+        fns = [fn] if isinstance(fn, str) else list(fn)
+        try:
+            return input_hash(self.config_hash, [file_identity(_fn) for _fn in fns])
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _read_marker(marker_fn):
+        try:
+            with open(marker_fn) as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+    def _is_done(self, fn):
+        d = self._read_marker(self._done_fn(fn))
+        return d is not None and d.get('ticket') == self._ticket(fn)
+
+    def attempts(self, fn):
+        """
+        failed attempts of the current archives of fn with the current config
+        """
+        d = self._read_marker(self._failed_fn(fn))
+        if d is None or d.get('ticket') != self._ticket(fn):
+            return 0
+        return d['attempts']
+
+    def is_finished(self, fn):
+        return self._is_done(fn) or self.attempts(fn) >= self.max_attempts
+
+    def requeue(self, fns, retry_failed=False):
+        """
+        clears the done markers of fns (and their failed attempts with
+        retry_failed) so they are processed again. Called by the driver
+        with the archives the manifest lists as unprocessed
+        """
+        marker_fns = [self._done_fn(fn) for fn in fns]
+        if retry_failed:
+            marker_fns.extend(self._failed_fn(fn) for fn in fns)
+
+        n = 0
+        for marker_fn in marker_fns:
+            try:
+                os.remove(marker_fn)
+                n += 1
+            except FileNotFoundError:
+                pass
+        return n
+
+    def acquire(self, fn):
+        """
+        takes the lease of an archive. Returns False if the archive is
+        finished or leased by a live worker
+        """
+        if self.is_finished(fn):
+            return False
+
+        lease_fn = self._lease_fn(fn)
+        for _ in range(2):
+            try:
+                fd = os.open(lease_fn, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self._break_expired(lease_fn):
+                    return False
+                continue
+
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(dict(worker=self.worker_id, acquired=time()), fp)
+
+            # finished between the check and the create
+            if self.is_finished(fn):
+                os.remove(lease_fn)
+                return False
+
+            with self._lock:
+                self._held.add(fn)
+            return True
+
+        return False
+
+    def owns(self, fn):
+        """
+        True if the lease of fn is still held by this worker
+        """
+        try:
+            with open(self._lease_fn(fn)) as fp:
+                return json.load(fp)['worker'] == self.worker_id
+        except (OSError, ValueError):
+            return False
+
+    def release(self, fn):
+        with self._lock:
+            self._held.discard(fn)
+
+        if self.owns(fn):
+            os.remove(self._lease_fn(fn))
+
+    def complete(self, fn, result):
+        """
+        records the result of an archive and releases its lease
+        """
+        with atomic_output(self._done_fn(fn)) as tmp_fn:
+            with open(tmp_fn, 'w') as fp:
+                json.dump(dict(result, ticket=self._ticket(fn), worker=self.worker_id, finished=time()), fp,
+                          default=str)
+        self.release(fn)
+
+    def fail(self, fn, error):
+        """
+        records a failed attempt and releases the lease so the archive can
+        be retried (by any worker) until max_attempts is reached
+        """
+        attempts = self.attempts(fn) + 1
+        with atomic_output(self._failed_fn(fn)) as tmp_fn:
+            with open(tmp_fn, 'w') as fp:
+                json.dump(dict(attempts=attempts, error=error, ticket=self._ticket(fn), worker=self.worker_id,
+                               finished=time()), fp)
+
+        # a result of an earlier run is no longer valid
+        try:
+            os.remove(self._done_fn(fn))
+        except FileNotFoundError:
+            pass
+
+        self.release(fn)
+        return attempts
+
+    def _beat(self):
+        while not self._stop.wait(self.heartbeat_interval):
+            with self._lock:
+                held = list(self._held)
+
+            for fn in held:
+                if self.owns(fn):
+                    os.utime(self._lease_fn(fn))
+                else:
+                    print('lost the lease of %s' % self._name(fn))
+
+    def start_heartbeat(self):
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self._beat, name='heartbeat', daemon=True)
+        self._heartbeat.start()
+
+    def stop_heartbeat(self):
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+
+    def close(self):
+        """
+        stops the heartbeat and removes the clock file of the worker
+        """
+        self.stop_heartbeat()
+        try:
+            os.remove(self._clock_fn)
+        except FileNotFoundError:
+            pass
+
+    def iter_leases(self, fns, poll_interval=None):
+        """
+        yields the archives of fns as their leases are acquired. Archives
+        are scanned in a random order so workers rarely contend for the
+        same lease. With a poll_interval, archives leased by other workers
+        are polled until they finish (to take over expired leases),
+        without they are swept once more after the scan
+        """
+        pending = list(fns)
+        random.shuffle(pending)
+
+        swept = False
+        while len(pending) > 0:
+            leased_elsewhere = []
+            for fn in pending:
+                if self.acquire(fn):
+                    yield fn
+                elif not self.is_finished(fn):
+                    leased_elsewhere.append(fn)
+
+            pending = leased_elsewhere
+            if poll_interval is None:
+                if swept:
+                    return
+                swept = True
+            elif len(pending) > 0:
+                sleep(poll_interval)
+
+    def status(self, fns):
+        """
+        returns dict(done, failed, leased, pending) counts for fns
+        """
+        counts = dict(done=0, failed=0, leased=0, pending=0)
+        for fn in fns:
+            if self._is_done(fn):
+                counts['done'] += 1
+            elif self.attempts(fn) >= self.max_attempts:
+                counts['failed'] += 1
+            elif _exists(self._lease_fn(fn)):
+                counts['leased'] += 1
+            else:
+                counts['pending'] += 1
+        return counts
+
+
+def lease_worker(cfg_fn, scn_fns, queue_dir, poll_interval=None, **kwargs):
+    """
+    processes scenes while leases can be acquired. Every worker process
+    (on any host) runs one of these
+
+    :param kwargs: passed to LeaseQueue
+    :return: list of result dicts (see ingest.run_scene)
+    """
+    from biomass.ingest import SiteConfig, run_scene
+
+    cfg = SiteConfig(cfg_fn)
+    queue = LeaseQueue(queue_dir, config_hash=cfg.config_hash, **kwargs)
+
+    # the databases of out_dir are shared with the workers of other hosts
+    cfg.db_lock = queue.db_lock
+    manifest = open_locked_manifest(cfg.out_dir, queue.db_lock)
+    queue.start_heartbeat()
+
+    results = []
+    try:
+        for scn_fn in queue.iter_leases(scn_fns, poll_interval=poll_interval):
+            try:
+                # the lease guarantees exclusive access so a manifest row
+                # left processing by a dead worker is taken over
+                res = run_scene(scn_fn, cfg, manifest, takeover=True)
+            except Exception:
+                res = dict(scn_fn=scn_fn, status='failed', error=traceback.format_exc())
+
+            if res['status'] == 'failed':
+                attempts = queue.fail(scn_fn, res['error'])
+                print('{}\tfailed (attempt {})\n{}'.format(scn_fn, attempts, res['error']))
+            else:
+                queue.complete(scn_fn, res)
+                print('{}\t{}\t{}'.format(scn_fn, res['status'], res.get('elapsed')))
+
+            results.append(res)
+    finally:
+        queue.close()
+        cfg.close()
+
+    return results
@@ -0,0 +1,86 @@
+"""
+Read-only connections to the location databases for the API.
+
+The query functions (database.pasturestats, database.scenemeta) get their
+connection from connect(). Every thread of a process keeps one connection
+per database file, opened read-only (mode=ro) in autocommit mode so a
+query never holds a read transaction open between requests. The sqlite3
+statement cache of the connection is reused across requests, the queries
+are parameterized so a route hits the same prepared statements.
+
+build_sqlite_db.py replaces sqlite3.db with a new file. connect() stats the
+file on every call and reopens the connection when its inode changed, a
+connection to the removed file would keep serving the old rows. Writes in
+place (the ingest upserts) are seen by the next query without reopening.
+
+The connections only read, they work with rollback journal and WAL
+databases alike (mode=ro rather than immutable=1) and wait up to
+_timeout seconds for a writer to commit. They live as long as their
+thread, they are closed when the thread local state is collected.
+"""
+
+import os
+import sqlite3
+import threading
+
+from os.path import abspath
+from urllib.request import pathname2url
+
+
+# seconds a query waits for the lock of a writer
+_timeout = 30.0
+
+# prepared statements kept per connection
+_cached_statements = 256
+
+_local = threading.local()
+
+
+def _stamp(db_fn):
+    st = os.stat(db_fn)
+    return st.st_dev, st.st_ino
+
+
+def _open(db_fn):
+    uri = 'file:{}?mode=ro'.format(pathname2url(db_fn))
+    conn = sqlite3.connect(uri, uri=True, timeout=_timeout, isolation_level=None,
+                           cached_statements=_cached_statements)
+    conn.execute('PRAGMA query_only = 1')
+    return conn
+
+
+def connect(db_fn):
+    """
+    returns the read-only connection of the current thread to db_fn. The
+    connection is shared by the queries of the thread, don't close it
+
+    :raises sqlite3.OperationalError: if db_fn does not exist
+    """
+    db_fn = abspath(db_fn)
+
+    conns = getattr(_local, 'conns', None)
+    if conns is None or _local.pid != os.getpid():
+        # connections are not carried across a fork
+        conns = _local.conns = {}
+        _local.pid = os.getpid()
+
+    try:
+        stamp = _stamp(db_fn)
+    except FileNotFoundError:
+        stamp = None
+
+    if db_fn in conns:
+        conn, _stamp_ = conns[db_fn]
+        if _stamp_ == stamp:
+            return conn
+
+        # the file was replaced (or removed) by a rebuild
+        del conns[db_fn]
+        conn.close()
+
+    if stamp is None:
+        raise sqlite3.OperationalError('unable to open database file: %s' % db_fn)
+
+    conn = _open(db_fn)
+    conns[db_fn] = conn, stamp
+    return conn
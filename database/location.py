@@ -11,7 +11,6 @@ import yaml
 import pyproj
 import numpy as np
 import json
-from subprocess import Popen
 
 import rasterio
 from rasterio.mask import raster_geometry_mask
@@ -22,6 +21,7 @@ from osgeo import osr
 sys.path.insert(0, os.path.abspath('../'))
 
 from all_your_base import GEODATA_DIRS, rat_extract, is_mappable_of_floats, coords_3d_to_2d
+from biomass.reproject import reproject_raster
 
 
 def wkt_2_proj4(wkt):
@@ -418,7 +418,6 @@ class Location(object):
         try:
             head, tail = _split(dst_fn)
             utm_dst_fn = _join(head, tail.replace('.tif', '.utm.tif'))
-            dst_vrt_fn = _join(head, tail.replace('.tif', '.wgs.vrt'))
             dst_wgs_fn = _join(head, tail.replace('.tif', '.wgs.tif'))
 
 
@@ -439,37 +438,12 @@ class Location(object):
             raise
 
         try:
-
-            if _exists(dst_vrt_fn):
-                os.remove(dst_vrt_fn)
-
-            cmd = ['gdalwarp', '-t_srs', 'EPSG:4326', '-of', 'vrt', utm_dst_fn, dst_vrt_fn]
-            p = Popen(cmd)
-            p.wait()
-
-            assert _exists(dst_vrt_fn)
-        except:
-            if _exists(dst_vrt_fn):
-                os.remove(dst_vrt_fn)
-            raise
-
-        try:
-            if _exists(dst_fn):
-                os.remove(dst_fn)
-
-            cmd = ['gdal_translate', '-co', 'COMPRESS=LZW', '-of', 'GTiff', dst_vrt_fn, dst_wgs_fn]
-            p = Popen(cmd)
-            p.wait()
-
-            assert _exists(dst_wgs_fn)
+            reproject_raster(utm_dst_fn, dst_wgs_fn)
         except:
             if _exists(dst_wgs_fn):
                 os.remove(dst_wgs_fn)
             raise
 
-        if _exists(dst_vrt_fn):
-            os.remove(dst_vrt_fn)
-
 
         for OUTPUT_RASTER in (dst_wgs_fn, utm_dst_fn):
             # https://gdal.org/python/osgeo.gdal.RasterAttributeTable-class.html
@@ -540,7 +514,6 @@ class Location(object):
 
             head, tail = _split(dst_fn)
             utm_dst_fn = _join(head, tail.replace('.tif', '.utm.tif'))
-            dst_vrt_fn = _join(head, tail.replace('.tif', '.wgs.vrt'))
             dst_wgs_fn = _join(head, tail.replace('.tif', '.wgs.tif'))
 
 
@@ -561,37 +534,12 @@ class Location(object):
             raise
 
         try:
-
-            if _exists(dst_vrt_fn):
-                os.remove(dst_vrt_fn)
-
-            cmd = ['gdalwarp', '-t_srs', 'EPSG:4326', '-of', 'vrt', utm_dst_fn, dst_vrt_fn]
-            p = Popen(cmd)
-            p.wait()
-
-            assert _exists(dst_vrt_fn)
-        except:
-            if _exists(dst_vrt_fn):
-                os.remove(dst_vrt_fn)
-            raise
-
-        try:
-            if _exists(dst_fn):
-                os.remove(dst_fn)
-
-            cmd = ['gdal_translate', '-co', 'COMPRESS=LZW', '-of', 'GTiff', dst_vrt_fn, dst_wgs_fn]
-            p = Popen(cmd)
-            p.wait()
-
-            assert _exists(dst_wgs_fn)
+            reproject_raster(utm_dst_fn, dst_wgs_fn)
         except:
             if _exists(dst_wgs_fn):
                 os.remove(dst_wgs_fn)
             raise
 
-        if _exists(dst_vrt_fn):
-            os.remove(dst_vrt_fn)
-
     def mask_ranch_opt(self, raster_fn, ranch, dst_fn, nodata=-9999, crop=False):
 
         assert _exists(_split(dst_fn)[0])
@@ -746,32 +694,8 @@ class Location(object):
                 os.remove(utm_dst_fn)
             raise
 
-        dst_vrt_fn = ''
-        try:
-            dst_vrt_fn = dst_fn.replace('.tif', '.vrt')
-
-            if _exists(dst_vrt_fn):
-                os.remove(dst_vrt_fn)
-
-            cmd = ['gdalwarp', '-t_srs', 'EPSG:4326', '-of', 'vrt', utm_dst_fn, dst_vrt_fn]
-            p = Popen(cmd)
-            p.wait()
-
-            assert _exists(dst_vrt_fn)
-        except:
-            if _exists(dst_vrt_fn):
-                os.remove(dst_vrt_fn)
-            raise
-
         try:
-            if _exists(dst_fn):
-                os.remove(dst_fn)
-
-            cmd = ['gdal_translate', '-co', 'COMPRESS=LZW', '-of', 'GTiff', dst_vrt_fn, dst_fn]
-            p = Popen(cmd)
-            p.wait()
-
-            assert _exists(dst_fn)
+            reproject_raster(utm_dst_fn, dst_fn)
         except:
             if _exists(dst_fn):
                 os.remove(dst_fn)
@@ -780,9 +704,6 @@ class Location(object):
         if _exists(utm_dst_fn):
             os.remove(utm_dst_fn)
 
-        if _exists(dst_vrt_fn):
-            os.remove(dst_vrt_fn)
-
     def shape_inspection(self, ranch=None):
 
         if ranch is not None:
@@ -0,0 +1,410 @@
+"""
+Processing manifest for the scene archives of a location.
+
+The manifest is a sqlite database in the out_dir of a location
+(<out_dir>/manifest.db) with one row per archive recording its state,
+timestamps, the hash of the config it was processed with, the archive
+checksum and the files that were written. Workers update it concurrently;
+state transitions run in BEGIN IMMEDIATE transactions so only one worker
+can claim an archive.
+"""
+
+import os
+import json
+import hashlib
+import sqlite3
+from time import time
+
+from os.path import join as _join
+from os.path import exists as _exists
+from os.path import split as _split
+
+
+PENDING = 'pending'
+PROCESSING = 'processing'
+DONE = 'done'
+SKIPPED_NO_OVERLAP = 'skipped-no-overlap'
+SKIPPED_LOW_COVERAGE = 'skipped-low-coverage'
+FAILED = 'failed'
+INVALID = 'invalid'
+
+_states = (PENDING, PROCESSING, DONE, SKIPPED_NO_OVERLAP, SKIPPED_LOW_COVERAGE, FAILED, INVALID)
+
+_schema = """
+CREATE TABLE IF NOT EXISTS manifest (
+    archive TEXT PRIMARY KEY,
+    path TEXT,
+    product_id TEXT,
+    state TEXT NOT NULL,
+    config_hash TEXT,
+    checksum TEXT,
+    outputs TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created REAL,
+    started REAL,
+    finished REAL,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS manifest_state ON manifest (state);
+"""
+
+# columns added after the manifest was introduced (name, type)
+_added_columns = [
+    ('validated', 'REAL'),
+    ('validation_error', 'TEXT'),
+    ('prescreen_coverage', 'REAL'),
+    ('skip_reason', 'TEXT'),
+]
+
+
+def archive_name(fn):
+    """
+    returns the archive name (basename without .tar/.tar.gz)
+    """
+    return os.path.basename(os.path.normpath(fn)).replace('.tar.gz', '').replace('.tar', '')
+
+
+def archive_checksum(fn, blocksize=2**20):
+    """
+    md5 hex digest of an archive
+    """
+    md5 = hashlib.md5()
+    with open(fn, 'rb') as fp:
+        for block in iter(lambda: fp.read(blocksize), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+class ProcessingManifest(object):
+    """
+    :param db_fn: path to the manifest database
+    :param timeout: seconds to wait for locks held by other workers
+    :param stale_after: seconds after which an archive stuck in processing
+                        (e.g. the worker was killed) can be claimed again
+    """
+    def __init__(self, db_fn, timeout=60.0, stale_after=6 * 3600):
+        head = _split(db_fn)[0]
+        if head != '' and not _exists(head):
+            os.makedirs(head, exist_ok=True)
+
+        is_new = not _exists(db_fn)
+
+        self.db_fn = db_fn
+        self.timeout = timeout
+        self.stale_after = stale_after
+        self.is_new = is_new
+
+        conn = self._connect()
+        conn.executescript(_schema)
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(manifest)')]
+        for name, _type in _added_columns:
+            if name not in columns:
+                conn.execute('ALTER TABLE manifest ADD COLUMN {} {}'.format(name, _type))
+        conn.close()
+
+    @staticmethod
+    def for_out_dir(out_dir, **kwargs):
+        return ProcessingManifest(_join(out_dir, 'manifest.db'), **kwargs)
+
+    def _connect(self):
+        # autocommit mode, transactions are managed explicitly
+        return sqlite3.connect(self.db_fn, timeout=self.timeout, isolation_level=None)
+
+    def _transition(self, archive, state, path=None, allowed=None, **fields):
+        """
+        sets the state of an archive. If allowed is specified the update
+        only happens if the current state is in allowed (or the archive is
+        not in the manifest). Returns True if the state was updated
+        """
+        assert state in _states, state
+        now = time()
+
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT state, started FROM manifest WHERE archive = ?', (archive,)).fetchone()
+
+            if row is None:
+                conn.execute('INSERT INTO manifest (archive, path, state, created, updated) VALUES (?, ?, ?, ?, ?)',
+                             (archive, path, PENDING, now, now))
+                current = PENDING
+            else:
+                current, started = row
+                if current == PROCESSING and started is not None and now - started > self.stale_after:
+                    current = PENDING
+
+            if allowed is not None and current not in allowed:
+                conn.execute('ROLLBACK')
+                return False
+
+            fields['state'] = state
+            fields['updated'] = now
+            if path is not None:
+                fields['path'] = path
+
+            assignments = ', '.join('{} = ?'.format(k) for k in fields)
+            if state == PROCESSING:
+                assignments += ', attempts = attempts + 1'
+            conn.execute('UPDATE manifest SET {} WHERE archive = ?'.format(assignments),
+                         list(fields.values()) + [archive])
+            conn.execute('COMMIT')
+            return True
+        except:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def register(self, fns):
+        """
+        adds archives that are not in the manifest as pending
+        """
+        now = time()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany('INSERT OR IGNORE INTO manifest (archive, path, state, created, updated) '
+                             'VALUES (?, ?, ?, ?, ?)',
+                             [(archive_name(fn), fn, PENDING, now, now) for fn in fns])
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def claim(self, fn, config_hash=None, retry_failed=True, takeover=False):
+        """
+        marks an archive as processing. Returns False if another worker
+        is processing it or it has already been processed
+
+        :param takeover: also claim archives that are processing. Used when
+                         exclusive access is guaranteed by a lease (see
+                         biomass.work_queue) and the previous holder died
+        """
+        allowed = [PENDING, FAILED] if retry_failed else [PENDING]
+        if takeover:
+            allowed.append(PROCESSING)
+        return self._transition(archive_name(fn), PROCESSING, path=fn, allowed=allowed,
+                                config_hash=config_hash, started=time(), finished=None, error=None)
+
+    def mark_done(self, fn, product_id=None, outputs=None, checksum=None):
+        """
+        :param checksum: md5 of the archive. If None the checksum recorded
+                         when the archive was validated is kept
+        """
+        fields = dict(product_id=product_id, outputs=json.dumps(outputs), finished=time())
+        if checksum is not None:
+            fields['checksum'] = checksum
+        return self._transition(archive_name(fn), DONE, path=fn, **fields)
+
+    def mark_skipped(self, fn):
+        return self._transition(archive_name(fn), SKIPPED_NO_OVERLAP, path=fn, finished=time())
+
+    def mark_low_coverage(self, fn, coverage, reason=None):
+        """
+        records an archive that was not processed because the expected
+        pasture coverage from the qa prescreen is below the threshold
+        """
+        return self._transition(archive_name(fn), SKIPPED_LOW_COVERAGE, path=fn, prescreen_coverage=coverage,
+                                skip_reason=reason, finished=time())
+
+    def mark_failed(self, fn, error=None):
+        return self._transition(archive_name(fn), FAILED, path=fn, error=error, finished=time())
+
+    def record_validation(self, fn, valid, checksum=None, error=None):
+        """
+        records the result of validating an archive. Invalid archives that
+        have not been processed are marked invalid so they are not claimed,
+        an archive that validates again becomes pending
+        """
+        archive = archive_name(fn)
+        now = time()
+
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT state FROM manifest WHERE archive = ?', (archive,)).fetchone()
+            if row is None:
+                conn.execute('INSERT INTO manifest (archive, path, state, created, updated) VALUES (?, ?, ?, ?, ?)',
+                             (archive, fn, PENDING, now, now))
+                state = PENDING
+            else:
+                state = row[0]
+
+            if valid:
+                if state == INVALID:
+                    state = PENDING
+                conn.execute('UPDATE manifest SET state = ?, checksum = ?, validated = ?, validation_error = NULL, '
+                             'updated = ? WHERE archive = ?', (state, checksum, now, now, archive))
+            else:
+                if state in (PENDING, FAILED):
+                    state = INVALID
+                conn.execute('UPDATE manifest SET state = ?, validated = ?, validation_error = ?, '
+                             'updated = ? WHERE archive = ?', (state, now, error, now, archive))
+            conn.execute('COMMIT')
+        except:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+        return state
+
+    def validated(self):
+        """
+        returns a dict of archive -> time it was last validated
+        """
+        conn = self._connect()
+        try:
+            return dict(conn.execute('SELECT archive, validated FROM manifest WHERE validated IS NOT NULL').fetchall())
+        finally:
+            conn.close()
+
+    def get(self, fn):
+        """
+        returns the manifest row of an archive as a dict or None
+        """
+        conn = self._connect()
+        conn.row_factory = sqlite3.Row
+        try:
+            row = conn.execute('SELECT * FROM manifest WHERE archive = ?', (archive_name(fn),)).fetchone()
+        finally:
+            conn.close()
+
+        if row is None:
+            return None
+
+        row = dict(row)
+        if row['outputs'] is not None:
+            row['outputs'] = json.loads(row['outputs'])
+        return row
+
+    def state(self, fn):
+        row = self.get(fn)
+        if row is None:
+            return None
+        return row['state']
+
+    def states(self):
+        """
+        returns a dict of archive -> state for all of the archives
+        """
+        conn = self._connect()
+        try:
+            return dict(conn.execute('SELECT archive, state FROM manifest').fetchall())
+        finally:
+            conn.close()
+
+    def done(self):
+        """
+        returns a dict of product_id -> archives of the processed scenes
+        """
+        conn = self._connect()
+        try:
+            rows = conn.execute('SELECT archive, product_id FROM manifest WHERE state = ? AND product_id IS NOT NULL '
+                                'ORDER BY archive', (DONE,)).fetchall()
+        finally:
+            conn.close()
+
+        products = {}
+        for archive, product_id in rows:
+            products.setdefault(product_id, []).append(archive)
+        return products
+
+    def is_processed(self, fn, retry_failed=False):
+        state = self.state(fn)
+        if state in (DONE, SKIPPED_NO_OVERLAP, SKIPPED_LOW_COVERAGE, INVALID):
+            return True
+        if state == FAILED:
+            return not retry_failed
+        return False
+
+    def requeue_low_coverage(self, fns):
+        """
+        marks the archives of fns that were skipped by the prescreen as
+        pending so they are screened again (e.g. with a new threshold)
+        """
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany('UPDATE manifest SET state = ?, updated = ? WHERE archive = ? AND state = ?',
+                             [(PENDING, time(), archive_name(fn), SKIPPED_LOW_COVERAGE) for fn in fns])
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def requeue(self, fns):
+        """
+        marks the processed archives of fns as pending so they are
+        processed again (e.g. after the site config changed)
+        """
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany('UPDATE manifest SET state = ?, updated = ? WHERE archive = ? AND state = ?',
+                             [(PENDING, time(), archive_name(fn), DONE) for fn in fns])
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def unprocessed(self, fns, retry_failed=False):
+        """
+        returns the archives in fns that still need to be processed,
+        reading the states with a single query
+        """
+        now = time()
+        conn = self._connect()
+        try:
+            rows = conn.execute('SELECT archive, state, started FROM manifest').fetchall()
+        finally:
+            conn.close()
+
+        finished = set()
+        for archive, state, started in rows:
+            if state in (DONE, SKIPPED_NO_OVERLAP, SKIPPED_LOW_COVERAGE, INVALID):
+                finished.add(archive)
+            elif state == FAILED and not retry_failed:
+                finished.add(archive)
+            elif state == PROCESSING and started is not None and now - started <= self.stale_after:
+                finished.add(archive)
+
+        return [fn for fn in fns if archive_name(fn) not in finished]
+
+    def seed_from_out_dir(self, out_dir):
+        """
+        records the scenes already processed into out_dir before the
+        manifest existed (pasture stats csvs and .<product_id> dot-files)
+        """
+        now = time()
+        rows = []
+        for fn in os.listdir(out_dir):
+            if fn.endswith('_pasture_stats.csv'):
+                archive = fn.replace('_pasture_stats.csv', '')
+                rows.append((archive, archive, DONE, json.dumps([_join(out_dir, fn)]), now, now))
+            elif fn.startswith('.L'):
+                archive = archive_name(fn[1:])
+                rows.append((archive, None, SKIPPED_NO_OVERLAP, None, now, now))
+
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany('INSERT OR IGNORE INTO manifest (archive, product_id, state, outputs, created, updated) '
+                             'VALUES (?, ?, ?, ?, ?, ?)', rows)
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+        return len(rows)
+
+
+def open_manifest(out_dir, **kwargs):
+    """
+    opens the manifest of out_dir. A new manifest is seeded from the
+    outputs already in out_dir
+    """
+    manifest = ProcessingManifest.for_out_dir(out_dir, **kwargs)
+    if manifest.is_new:
+        n = manifest.seed_from_out_dir(out_dir)
+        print('seeded manifest with %i processed scenes' % n)
+    return manifest
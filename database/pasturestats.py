@@ -1,16 +1,11 @@
-import sqlite3
 from datetime import date
-from glob import glob
-import os
-import csv
-from os.path import join as _join
-from os.path import exists as _exists
-import shutil
-import ast
 import math
 
 import numpy as np
 
+from database.connections import connect
+from database.pasturestats_db import MEASURES, HAS_BIOMASS, VALID
+
 from datetime import datetime
 
 
@@ -28,18 +23,9 @@ _header = ('product_id', 'key', 'pasture', 'ranch', 'total_px', 'snow_px',
            'nbr2_mean', 'nbr2_sd', 'nbr2_10pct', 'nbr2_75pct', 'nbr2_90pct', 'nbr2_ci90',
            'satellite', 'acquisition_date')
 
-_measures = ('biomass_mean_gpm', 'biomass_ci90_gpm',
-             'biomass_10pct_gpm', 'biomass_75pct_gpm', 'biomass_90pct_gpm', 'biomass_total_kg',
-             'biomass_sd_gpm', 'summer_vi_mean_gpm', 'fall_vi_mean_gpm',
-             'ndvi_mean', 'ndvi_sd', 'ndvi_10pct', 'ndvi_75pct', 'ndvi_90pct', 'ndvi_ci90',
-             'nbr_mean', 'nbr_sd', 'nbr_10pct', 'nbr_75pct', 'nbr_90pct', 'nbr_ci90',
-             'nbr2_mean', 'nbr2_sd', 'nbr2_10pct', 'nbr2_75pct', 'nbr2_90pct', 'nbr2_ci90',
-             )
-
-
 def _aggregate(rows, agg_func):
     results = {}
-    for measure in _measures:
+    for measure in MEASURES:
         val = agg_func([row[measure] for row in rows if row[measure] is not None])
         if math.isnan(val):
             val = None
@@ -47,6 +33,159 @@ def _aggregate(rows, agg_func):
     return results
 
 
+# aggregations evaluated by sqlite. Other agg_funcs (np.median, np.std, ...)
+# are registered as an aggregate that calls them on the values of a group
+_sql_aggregates = {np.mean: 'AVG', np.sum: 'TOTAL', len: 'COUNT', np.max: 'MAX', np.min: 'MIN'}
+
+class _AggFunc(object):
+    """
+    sqlite aggregate applying agg_func to the non-null values of a group
+    """
+    agg_func = None
+
+    def __init__(self):
+        self.values = []
+
+    def step(self, value):
+        if value is not None:
+            self.values.append(value)
+
+    def finalize(self):
+        val = self.agg_func(self.values)
+        if isinstance(val, int):
+            return val
+        # nan is stored as null
+        return float(val)
+
+
+def _aggregate_groups(c, agg_func, group_by, **kwargs):
+    """
+    aggregates the MEASURES of the pasture_stats rows matching the _where
+    kwargs grouped by the group_by columns. Null values are ignored like
+    in _aggregate
+
+    :return: dict of group tuple -> dict of measure -> value
+    """
+    func = _sql_aggregates.get(agg_func)
+    if func is None:
+        func = 'agg_func'
+        c.connection.create_aggregate(func, 1, type('_AggFunc', (_AggFunc,), dict(agg_func=staticmethod(agg_func))))
+
+    where, params = _where(**kwargs)
+    group = ', '.join(group_by)
+    query = 'SELECT {group}, {measures} FROM pasture_stats{where} GROUP BY {group}'\
+            .format(group=group, where=where,
+                    measures=', '.join('{}({})'.format(func, measure) for measure in MEASURES))
+
+    c.execute(query, params)
+    n = len(group_by)
+    return {tuple(row[:n]): dict(zip(MEASURES, row[n:])) for row in c.fetchall()}
+
+
+def _distinct(c, columns, **kwargs):
+    """
+    distinct values of columns of the pasture_stats rows matching the
+    _where kwargs
+    """
+    where, params = _where(**kwargs)
+    c.execute('SELECT DISTINCT {} FROM pasture_stats{}'.format(', '.join(columns), where), params)
+    return c.fetchall()
+
+
+# the monthly summaries (see database.pasturestats_db.refresh_summaries)
+# answer these agg_funcs from the count, sum and sum of squares of the
+# measures
+_summary_aggregates = (np.mean, np.std, np.sum, len)
+
+# summary conditions equivalent to VALID and HAS_BIOMASS
+_summary_valid = 'status = 2'
+_summary_has_biomass = 'status >= 1'
+
+# leaves out Jan 1 and Dec 31, the default date windows are exclusive
+_summary_inner = 'year_end = 0'
+
+
+def _use_summaries(c, agg_func, start_date=None, end_date=None):
+    """
+    True if a query can be answered from the monthly summaries: agg_func
+    is one of _summary_aggregates, the date window is the whole year and
+    the database has the summaries. Custom windows use the pasture_stats
+    rows
+    """
+    if not any(agg_func is func for func in _summary_aggregates):
+        return False
+
+    if start_date is not None and _date(2000, start_date)[5:] != '01-01':
+        return False
+
+    if end_date is not None and _date(2000, end_date)[5:] != '12-31':
+        return False
+
+    c.execute("SELECT COUNT(*) FROM sqlite_master WHERE name IN ('pasture_month_summary', 'ranch_month_summary')")
+    return c.fetchone()[0] == 2
+
+
+def _summary_value(agg_func, n, total, sumsq=None):
+    if agg_func is len:
+        return n
+
+    if agg_func is np.sum:
+        return total
+
+    if n == 0:
+        return None
+
+    mean = total / n
+    if agg_func is np.mean:
+        return mean
+
+    # np.std (ddof=0)
+    return math.sqrt(max(sumsq / n - mean * mean, 0.0))
+
+
+def _summary_table(columns, pasture=None):
+    # the ranch summaries unless the pastures are needed
+    if pasture is None and 'pasture' not in columns:
+        return 'ranch_month_summary'
+    return 'pasture_month_summary JOIN pastures ON pastures.id = pasture_ref'
+
+
+def _summary_groups(c, agg_func, group_by, **kwargs):
+    """
+    like _aggregate_groups from the monthly summaries matching the _where
+    kwargs
+    """
+    # the sums of squares are only read for np.std
+    aggs = ('n', 'sum', 'sumsq') if agg_func is np.std else ('n', 'sum')
+    k = len(aggs)
+
+    where, params = _where(**kwargs)
+    group = ', '.join(group_by)
+    query = 'SELECT {group}, {columns} FROM {table}{where} GROUP BY {group}'\
+            .format(group=group, table=_summary_table(group_by, kwargs.get('pasture')), where=where,
+                    columns=', '.join('SUM({}_{})'.format(m, agg) for m in MEASURES for agg in aggs))
+
+    c.execute(query, params)
+    n = len(group_by)
+
+    groups = {}
+    for row in c.fetchall():
+        values = row[n:]
+        groups[tuple(row[:n])] = {measure: _summary_value(agg_func, *values[i * k: i * k + k])
+                                  for i, measure in enumerate(MEASURES)}
+    return groups
+
+
+def _summary_distinct(c, columns, **kwargs):
+    """
+    like _distinct from the monthly summaries
+    """
+    where, params = _where(**kwargs)
+    c.execute('SELECT DISTINCT {} FROM {}{}'.format(', '.join(columns), _summary_table(columns, kwargs.get('pasture')),
+                                                    where), params)
+    return c.fetchall()
+
+
 def _date_of_max(rows, measure='biomass_90pct_gpm'):
     indx = np.argmax([(row[measure], -99999.0)[row[measure] is None] for row in rows])
     return rows[indx]
@@ -68,11 +207,93 @@ def _sortkeypicker(keynames):
 
     return getit
 
+def _date(year, month_day):
+    """
+    acquisition date string (YYYY-MM-DD) of a year and a 'month-day'
+    """
+    return str(date(*map(int, '{}-{}'.format(year, month_day).split('-'))))
+
+
+def _where(ranch=None, pasture=None, acquisition_date=None, after=None, before=None, season=None,
+           years=None, conditions=()):
+    """
+    WHERE clause and parameters of a pasture_stats query. after and before
+    are exclusive bounds of the acquisition date. The pasture_stats view
+    range scans the (pasture_ref, acquisition_date) index for a ranch or
+    pasture and the (acquisition_date) index otherwise
+
+    :param season: exclusive ('MM-DD', 'MM-DD') bounds of the date within
+                   every year
+    :param years: inclusive (start_year, end_year)
+    :param conditions: additional conditions, e.g. VALID
+    """
+    conditions, params = list(conditions), []
+    if ranch is not None:
+        conditions.append('ranch = ?')
+        params.append(ranch.replace('_', ' '))
+
+    if pasture is not None:
+        conditions.append('pasture = ?')
+        params.append(pasture.replace('_', ' ').replace('Derrick Old', 'Derrick_Old'))
+
+    if acquisition_date is not None:
+        conditions.append('acquisition_date = ?')
+        params.append(acquisition_date)
+
+    if after is not None:
+        conditions.append('acquisition_date > ?')
+        params.append(after)
+
+    if before is not None:
+        conditions.append('acquisition_date < ?')
+        params.append(before)
+
+    if season is not None:
+        conditions.append('substr(acquisition_date, 6) > ? AND substr(acquisition_date, 6) < ?')
+        params.extend(season)
+
+    if years is not None:
+        conditions.append('year >= ? AND year <= ?')
+        params.extend(int(year) for year in years)
+
+    if len(conditions) == 0:
+        return '', params
+    return ' WHERE ' + ' AND '.join(conditions), params
+
+
+def _select(c, order_by=None, **kwargs):
+    """
+    selects the _header columns of the pasture_stats rows matching the
+    _where kwargs
+    """
+    where, params = _where(**kwargs)
+    query = 'SELECT ' + ', '.join(_header) + ' FROM pasture_stats' + where
+    if order_by is not None:
+        query += ' ORDER BY ' + order_by
+
+    c.execute(query, params)
+    return c.fetchall()
+
+
+def _pasture_keys(c, ranch=None, pasture=None):
+    """
+    (pasture, ranch) of the pastures with pasture stats
+    """
+    where, params = _where(ranch=ranch, pasture=pasture)
+    query = 'SELECT pasture, ranch FROM pastures' + \
+            (where + ' AND' if where else ' WHERE') + \
+            ' EXISTS (SELECT 1 FROM pasture_stats_data s WHERE s.pasture_ref = pastures.id)'
+
+    c.execute(query, params)
+    return c.fetchall()
+
+
 def query_scene_product_ids(db_fn):
-    conn = sqlite3.connect(db_fn)
+    conn = connect(db_fn)
     c = conn.cursor()
 
-    query = 'SELECT product_id FROM pasture_stats'
+    query = 'SELECT product_id FROM products ' \
+            'WHERE EXISTS (SELECT 1 FROM pasture_stats_data s WHERE s.product_ref = products.id)'
 
     c.execute(query)
     rows = c.fetchall()
@@ -80,7 +301,7 @@ def query_scene_product_ids(db_fn):
 
 
 def query_scenes_coverage(scn_cov_db_fn, product_ids):
-    conn = sqlite3.connect(scn_cov_db_fn)
+    conn = connect(scn_cov_db_fn)
     c = conn.cursor()
 
     query = 'SELECT * FROM scenemeta_coverage'
@@ -97,35 +318,10 @@ def query_scenes_coverage(scn_cov_db_fn, product_ids):
 
 
 def query_pasture_stats(db_fn, ranch=None, acquisition_date=None, pasture=None):
-    conn = sqlite3.connect(db_fn)
+    conn = connect(db_fn)
     c = conn.cursor()
 
-    query = 'SELECT ' + \
-            ', '.join(_header) + \
-            ' FROM pasture_stats'
-
-    i = 0
-    if ranch is not None or acquisition_date is not None or pasture is not None:
-        query += ' WHERE'
-
-    if ranch is not None:
-        query += ' ranch = "{ranch}"'.format(ranch=ranch.replace('_', ' '))
-        i += 1
-
-    if pasture is not None:
-        if i > 0:
-            query += ' AND'
-        query += ' pasture = "{pasture}"'.format(pasture=pasture.replace('_', ' ').replace('Derrick Old', 'Derrick_Old'))
-        i += 1
-
-    if acquisition_date is not None:
-        if i > 0:
-            query += ' AND'
-        query += ' acquisition_date = "{acquisition_date}"'.format(acquisition_date=acquisition_date)
-        i += 1
-
-    c.execute(query)
-    rows = c.fetchall()
+    rows = _select(c, ranch=ranch, pasture=pasture, acquisition_date=acquisition_date, order_by='id')
 
     return [dict(zip(_header, row)) for row in rows]
 
@@ -139,44 +335,14 @@ def query_singleyear_pasture_stats(db_fn, ranch=None, pasture=None, year=None,
     if end_date is None:
         end_date = '12-31'
 
-    conn = sqlite3.connect(db_fn)
+    conn = connect(db_fn)
     c = conn.cursor()
 
-    query = 'SELECT ' + \
-            ', '.join(_header) + \
-            ' FROM pasture_stats'
-
-    i = 0
-    if ranch is not None or year is not None or pasture is not None:
-        query += ' WHERE'
+    # the dates are strictly between start_date and end_date
+    rows = _select(c, ranch=ranch, pasture=pasture, after=_date(year, start_date), before=_date(year, end_date),
+                   conditions=[HAS_BIOMASS], order_by='acquisition_date, id')
 
-    if ranch is not None:
-        query += ' ranch = "{ranch}"'.format(ranch=ranch.replace('_', ' '))
-        i += 1
-
-    if pasture is not None:
-        if i > 0:
-            query += ' AND'
-        query += ' pasture = "{pasture}"'.format(pasture=pasture.replace('_', ' ').replace('Derrick Old', 'Derrick_Old'))
-        i += 1
-
-    if year is not None:
-        if i > 0:
-            query += ' AND'
-        query += " instr(acquisition_date, '{year}') > 0".format(year=year)
-        i += 1
-
-    c.execute(query)
-    rows = c.fetchall()
-
-    dates = [date(*map(int, row[-1].split('-'))) for row in rows]
-    _start_date = date(*map(int, '{}-{}'.format(year, start_date).split('-')))
-    _end_date = date(*map(int, '{}-{}'.format(year, end_date).split('-')))
-    mask = [_start_date < d < _end_date for d in dates]
-
-    rows = [dict(zip(_header, row)) for m, row in zip(mask, rows) if m]
-    rows = [d for d in rows if d['biomass_mean_gpm'] is not None]
-    rows = sorted(rows, key=lambda k: k['acquisition_date'])
+    rows = [dict(zip(_header, row)) for row in rows]
    
     for i in range(len(rows)):
         rows[i]['key'] = '{}{}{}'.format(rows[i]['pasture'], key_delimiter, rows[i]['ranch'])
@@ -187,20 +353,25 @@ def query_singleyear_pasture_stats(db_fn, ranch=None, pasture=None, year=None,
 def query_intrayear_pasture_stats(db_fn, ranch=None, pasture=None, year=None,
                                   start_date=None, end_date=None, agg_func=np.mean,
                                   key_delimiter='+'):
-    rows = query_singleyear_pasture_stats(db_fn, ranch=ranch, pasture=pasture, year=year,
-                                          start_date=start_date, end_date=end_date, agg_func=agg_func,
-                                          key_delimiter=key_delimiter)
+    if start_date is None:
+        start_date = '1-1'
 
-    keys = set('{}{}{}'.format(row['pasture'], key_delimiter, row['ranch']) for row in rows)
+    if end_date is None:
+        end_date = '12-31'
 
-    d = {key: [] for key in keys}
+    conn = connect(db_fn)
+    c = conn.cursor()
 
-    for row in rows:
-        d[row['key']].append(row)
+    groups = _aggregate_groups(c, agg_func, ('pasture', 'ranch'), ranch=ranch, pasture=pasture,
+                               after=_date(year, start_date), before=_date(year, end_date),
+                               conditions=[HAS_BIOMASS])
+
+    d = {'{}{}{}'.format(_pasture, key_delimiter, _ranch): _agg for (_pasture, _ranch), _agg in groups.items()}
+    keys = set(d)
 
     agg = []
-    for key in d:
-        agg.append(_aggregate(d[key], agg_func))
+    for key in keys:
+        agg.append(d[key])
         try:
             _pasture, _ranch = key.split(key_delimiter)
         except:
@@ -250,35 +421,29 @@ def query_singleyearmonthly_pasture_stats(db_fn, ranch=None, pasture=None, year=
     if end_date is None:
         end_date = '12-31'
 
-    rows = query_singleyear_pasture_stats(db_fn, ranch=ranch, pasture=pasture, year=year,
-                                          start_date=start_date, end_date=end_date, agg_func=agg_func,
-                                          key_delimiter=key_delimiter)
-
-    keys = set('{}{}{}'.format(row['pasture'], key_delimiter, row['ranch']) for row in rows)
-
-    monthlies = {key: [[] for i in range(12)] for key in keys}
-    for i, row in enumerate(rows):
-        if row['biomass_mean_gpm'] is None:
-            continue
-
-        if row['biomass_mean_gpm'] == 0:
-            continue
-
-        if row['coverage'] < 0.5:
-            continue
+    conn = connect(db_fn)
+    c = conn.cursor()
 
-        month_indx = int(row['acquisition_date'].split('-')[1]) - 1
+    # the pastures with a biomass estimate in the date range get 12 months
+    if _use_summaries(c, agg_func, start_date, end_date):
+        kwargs = dict(ranch=ranch, pasture=pasture, years=(year, year))
+        keys = _summary_distinct(c, ('pasture', 'ranch'), conditions=[_summary_has_biomass, _summary_inner], **kwargs)
+        groups = _summary_groups(c, agg_func, ('pasture', 'ranch', 'month'),
+                                 conditions=[_summary_valid, _summary_inner], **kwargs)
+    else:
+        kwargs = dict(ranch=ranch, pasture=pasture, after=_date(year, start_date), before=_date(year, end_date))
+        keys = _distinct(c, ('pasture', 'ranch'), conditions=[HAS_BIOMASS], **kwargs)
+        groups = _aggregate_groups(c, agg_func, ('pasture', 'ranch', 'month'), conditions=[VALID], **kwargs)
 
-        assert 0 <= month_indx <= 11, month_indx
-        monthlies[row['key']][month_indx].append(row)
+    keys = set('{}{}{}'.format(_pasture, key_delimiter, _ranch) for _pasture, _ranch in keys)
 
     agg = {}
     for key in keys:
         _pasture, _ranch = key.split(key_delimiter)
         _monthlies = []
 
-        for i, d in enumerate(monthlies[key]):
-            _monthlies.append(_aggregate(d, agg_func))
+        for i in range(12):
+            _monthlies.append(groups.get((_pasture, _ranch, i + 1)) or _aggregate([], agg_func))
             _monthlies[-1]['pasture'] = _pasture
             _monthlies[-1]['ranch'] = _ranch
             _monthlies[-1]['month'] = _month_labels[i]
@@ -301,36 +466,27 @@ def query_singleyearmonthly_ranch_stats(db_fn, ranch=None, year=None,
     if end_date is None:
         end_date = '12-31'
 
-    rows = query_singleyear_pasture_stats(db_fn, ranch=ranch, pasture=None, year=year,
-                                          start_date=start_date, end_date=end_date, agg_func=agg_func,
-                                          key_delimiter=key_delimiter)
-
-    keys = set(row['ranch'] for row in rows)
-
-    monthlies = {_ranch: [[] for i in range(12)] for _ranch in keys}
-    for i, row in enumerate(rows):
-        if row['biomass_mean_gpm'] is None:
-            continue
-
-        if row['biomass_mean_gpm'] == 0:
-            continue
-
-        if row['coverage'] < 0.5:
-            continue
-
-        _pasture, _ranch = row['pasture'], row['ranch']
+    conn = connect(db_fn)
+    c = conn.cursor()
 
-        month_indx = int(row['acquisition_date'].split('-')[1]) - 1
+    # the ranches with a biomass estimate in the date range get 12 months
+    if _use_summaries(c, agg_func, start_date, end_date):
+        kwargs = dict(ranch=ranch, years=(year, year))
+        keys = _summary_distinct(c, ('ranch',), conditions=[_summary_has_biomass, _summary_inner], **kwargs)
+        groups = _summary_groups(c, agg_func, ('ranch', 'month'), conditions=[_summary_valid, _summary_inner], **kwargs)
+    else:
+        kwargs = dict(ranch=ranch, after=_date(year, start_date), before=_date(year, end_date))
+        keys = _distinct(c, ('ranch',), conditions=[HAS_BIOMASS], **kwargs)
+        groups = _aggregate_groups(c, agg_func, ('ranch', 'month'), conditions=[VALID], **kwargs)
 
-        assert 0 <= month_indx <= 11, month_indx
-        monthlies[_ranch][month_indx].append(row)
+    keys = set(_ranch for _ranch, in keys)
 
     agg = {}
     for _ranch in keys:
         _monthlies = []
 
-        for i, d in enumerate(monthlies[_ranch]):
-            _monthlies.append(_aggregate(d, agg_func))
+        for i in range(12):
+            _monthlies.append(groups.get((_ranch, i + 1)) or _aggregate([], agg_func))
             _monthlies[-1]['ranch'] = _ranch
             _monthlies[-1]['month'] = _month_labels[i]
 
@@ -352,66 +508,27 @@ def query_seasonalprogression_pasture_stats(db_fn, ranch=None, pasture=None,
     else:
         start_year = int(start_year)
 
-    conn = sqlite3.connect(db_fn)
+    conn = connect(db_fn)
     c = conn.cursor()
 
-    query = 'SELECT ' + \
-            ', '.join(_header) + \
-            ' FROM pasture_stats'
+    # the pastures with stats in any year are reported
+    keys = set('{}{}{}'.format(_pasture, key_delimiter, _ranch) for _pasture, _ranch in _pasture_keys(c, ranch, pasture))
 
-    i = 0
-    if ranch is not None or pasture is not None:
-        query += ' WHERE'
-
-    if ranch is not None:
-        query += ' ranch = "{ranch}"'.format(ranch=ranch.replace('_', ' '))
-        i += 1
-
-    if pasture is not None:
-        if i > 0:
-            query += ' AND'
-        query += ' pasture = "{pasture}"'.format(pasture=pasture.replace('_', ' ')
-                                                                .replace('Derrick Old', 'Derrick_Old'))
-        i += 1
-
-    c.execute(query)
-    rows = c.fetchall()
-    rows = [dict(zip(_header, row)) for row in rows]
-    
-    for i in range(len(rows)):
-        rows[i]['key'] = '{}{}{}'.format(rows[i]['pasture'], key_delimiter, rows[i]['ranch'])
-            
-    keys = set('{}{}{}'.format(row['pasture'], key_delimiter, row['ranch']) for row in rows)
-
-    monthlies = {key: [[] for i in range(12)] for key in keys}
-    for i, row in enumerate(rows):
-        if row['biomass_mean_gpm'] is None:
-            continue
-
-        if row['biomass_mean_gpm'] == 0:
-            continue
-
-        if row['coverage'] < 0.5:
-            continue
-        acquisition_date = row['acquisition_date']
-        yr, mo, da = map(int, row['acquisition_date'].split('-'))
-
-        if not start_year <= yr <= end_year:
-            continue
-
-        month_indx = mo - 1
-
-        assert 0 <= month_indx <= 11, month_indx
-
-        monthlies[row['key']][month_indx].append(row)
+    if _use_summaries(c, agg_func):
+        groups = _summary_groups(c, agg_func, ('pasture', 'ranch', 'month'), ranch=ranch, pasture=pasture,
+                                 years=(start_year, end_year), conditions=[_summary_valid])
+    else:
+        groups = _aggregate_groups(c, agg_func, ('pasture', 'ranch', 'month'), ranch=ranch, pasture=pasture,
+                                   after=_date(start_year - 1, '12-31'), before=_date(end_year + 1, '1-1'),
+                                   conditions=[VALID])
 
     agg = {}
     for key in keys:
         _pasture, _ranch = key.split(key_delimiter)
         _monthlies = []
 
-        for i, d in enumerate(monthlies[key]):
-            _monthlies.append(_aggregate(d, agg_func))
+        for i in range(12):
+            _monthlies.append(groups.get((_pasture, _ranch, i + 1)) or _aggregate([], agg_func))
             _monthlies[-1]['pasture'] = _pasture
             _monthlies[-1]['ranch'] = _ranch
             _monthlies[-1]['month'] = _month_labels[i]
@@ -425,8 +542,6 @@ def query_seasonalprogression_ranch_stats(db_fn, ranch=None,
                                             start_year=None, end_year=None,
                                             agg_func=np.mean, key_delimiter='+'):
 
-    pasture = None
-
     if end_year is None:
         end_year = datetime.now().year
     else:
@@ -437,66 +552,26 @@ def query_seasonalprogression_ranch_stats(db_fn, ranch=None,
     else:
         start_year = int(start_year)
 
-    conn = sqlite3.connect(db_fn)
+    conn = connect(db_fn)
     c = conn.cursor()
 
-    query = 'SELECT ' + \
-            ', '.join(_header) + \
-            ' FROM pasture_stats'
+    # the ranches with stats in any year are reported
+    keys = set(_ranch for _pasture, _ranch in _pasture_keys(c, ranch))
 
-    i = 0
-    if ranch is not None or pasture is not None:
-        query += ' WHERE'
-
-    if ranch is not None:
-        query += ' ranch = "{ranch}"'.format(ranch=ranch.replace('_', ' '))
-        i += 1
-
-    if pasture is not None:
-        if i > 0:
-            query += ' AND'
-        query += ' pasture = "{pasture}"'.format(pasture=pasture.replace('_', ' ')
-                                                                .replace('Derrick Old', 'Derrick_Old'))
-        i += 1
-
-    c.execute(query)
-    rows = c.fetchall()
-    rows = [dict(zip(_header, row)) for row in rows]
-
-    for i in range(len(rows)):
-        rows[i]['key'] = '{}{}{}'.format(rows[i]['pasture'], key_delimiter, rows[i]['ranch'])
-            
-    keys = set(row['ranch'] for row in rows)
-
-    monthlies = {_ranch: [[] for i in range(12)] for _ranch in keys}
-    for i, row in enumerate(rows):
-        if row['biomass_mean_gpm'] is None:
-            continue
-
-        if row['biomass_mean_gpm'] == 0:
-            continue
-
-        if row['coverage'] < 0.5:
-            continue
-
-        yr, mo, da = map(int, row['acquisition_date'].split('-'))
-
-        if not start_year <= yr <= end_year:
-            continue
-
-        _pasture, _ranch = row['pasture'], row['ranch']
-
-        month_indx = mo - 1
-
-        assert 0 <= month_indx <= 11, month_indx
-        monthlies[_ranch][month_indx].append(row)
+    if _use_summaries(c, agg_func):
+        groups = _summary_groups(c, agg_func, ('ranch', 'month'), ranch=ranch,
+                                 years=(start_year, end_year), conditions=[_summary_valid])
+    else:
+        groups = _aggregate_groups(c, agg_func, ('ranch', 'month'), ranch=ranch,
+                                   after=_date(start_year - 1, '12-31'), before=_date(end_year + 1, '1-1'),
+                                   conditions=[VALID])
 
     agg = {}
     for _ranch in keys:
         _monthlies = []
 
-        for i, d in enumerate(monthlies[_ranch]):
-            _monthlies.append(_aggregate(d, agg_func))
+        for i in range(12):
+            _monthlies.append(groups.get((_ranch, i + 1)) or _aggregate([], agg_func))
             _monthlies[-1]['ranch'] = _ranch
             _monthlies[-1]['month'] = _month_labels[i]
 
@@ -530,77 +605,16 @@ def query_interyear_pasture_stats(db_fn, ranch=None, pasture=None, start_year=No
 
     return agg2
 
-    conn = sqlite3.connect(db_fn)
-    c = conn.cursor()
-
-    query = 'SELECT ' + \
-            ', '.join(_header) + \
-            ' FROM pasture_stats'
 
-    i = 0
-    if ranch is not None or pasture is not None:
-        query += ' WHERE'
-
-    if ranch is not None:
-        query += ' ranch = "{ranch}"'.format(ranch=ranch.replace('_', ' '))
-        i += 1
-
-    if pasture is not None:
-        if i > 0:
-            query += ' AND'
-        query += ' pasture = "{pasture}"'.format(pasture=pasture.replace('_', ' ').replace('Derrick Old', 'Derrick_Old'))
-        i += 1
-
-    c.execute(query)
-    rows = c.fetchall()
-
-    dates = [date(*map(int, row[-1].split('-'))) for row in rows]
-    start_year = int(start_year)
-    end_year = int(end_year)
-
-    # filter by year
-    mask = [start_year < d.year < end_year for d in dates]
-
-    for i, (d, m) in enumerate(zip(dates, mask)):
-        if not m:
-            continue
-
-        # filter by date
-        _start_date = date(*map(int, '{}-{}'.format(d.year, start_date).split('-')))
-        _end_date = date(*map(int, '{}-{}'.format(d.year, end_date).split('-')))
-        mask[i] = _start_date < d < _end_date
-
-    # build list of dicts of pasture stats
-    rows = [dict(zip(_header, row)) for m, row in zip(mask, rows) if m]
-
-    for i in range(len(rows)):
-        rows[i]['key'] = '{}{}{}'.format(rows[i]['pasture'], key_delimiter, rows[i]['ranch'])
-            
-    # remove stats that don't have biomass
-    rows = [d for d in rows if d['biomass_mean_gpm'] is not None]
-
-    # identify pasture+ranch keys
-    keys = set('{}{}{}'.format(row['pasture'], key_delimiter, row['ranch']) for row in rows)
-
-    d = {key: [] for key in keys}
-
-    # group stats by pasture+ranch
-    for row in rows:
-        d[row['key']].append(row)
-
-    # aggregate over keys
-    agg = []
-    for key in d:
-        annuals = []
-        for year in range(start_year, end_year+1):
-            annuals.append(_aggregate([row for row in d[key] if
-                                       date(*map(int, row['acquisition_date'].split('-'))).year == year], agg_func))
-        agg.append(annuals)
-        _pasture, _ranch = key.split(key_delimiter)
-        agg[-1]['pasture'] = _pasture
-        agg[-1]['ranch'] = _ranch
-
-    return agg
+def _season(start_year, end_year, start_date, end_date):
+    """
+    exclusive ('MM-DD', 'MM-DD') bounds of the season of start_date to
+    end_date. Raises ValueError if a date does not exist in one of the
+    years (e.g. 2-29)
+    """
+    for year in range(start_year, end_year + 1):
+        _date(year, start_date), _date(year, end_date)
+    return _date(2000, start_date)[5:], _date(2000, end_date)[5:]
 
 
 def query_multiyear_pasture_stats(db_fn, ranch=None, pasture=None, start_year=None, end_year=None,
@@ -617,66 +631,34 @@ def query_multiyear_pasture_stats(db_fn, ranch=None, pasture=None, start_year=No
     if end_date is None:
         end_date = '12-31'
 
-    conn = sqlite3.connect(db_fn)
+    conn = connect(db_fn)
     c = conn.cursor()
 
-    query = 'SELECT ' + \
-            ', '.join(_header) + \
-            ' FROM pasture_stats'
-
-    i = 0
-    if ranch is not None or pasture is not None:
-        query += ' WHERE'
+    start_year = int(start_year)
+    end_year = int(end_year)
 
-    if ranch is not None:
-        query += ' ranch = "{ranch}"'.format(ranch=ranch.replace('_', ' '))
-        i += 1
+    # the pastures with stats in any year are reported for the years with
+    # stats in the season
+    keys = set('{}{}{}'.format(_pasture, key_delimiter, _ranch) for _pasture, _ranch in _pasture_keys(c, ranch, pasture))
 
-    if pasture is not None:
-        if i > 0:
-            query += ' AND'
-        query += ' pasture = "{pasture}"'.format(pasture=pasture.replace('_', ' ').replace('Derrick Old', 'Derrick_Old'))
-        i += 1
+    if _use_summaries(c, agg_func, start_date, end_date):
+        kwargs = dict(ranch=ranch, pasture=pasture, years=(start_year, end_year))
+        years = _summary_distinct(c, ('year',), conditions=[_summary_inner], **kwargs)
+        groups = _summary_groups(c, agg_func, ('pasture', 'ranch', 'year'),
+                                 conditions=[_summary_valid, _summary_inner], **kwargs)
+    else:
+        kwargs = dict(ranch=ranch, pasture=pasture, season=_season(start_year, end_year, start_date, end_date),
+                      after=_date(start_year - 1, '12-31'), before=_date(end_year + 1, '1-1'))
+        years = _distinct(c, ('year',), **kwargs)
+        groups = _aggregate_groups(c, agg_func, ('pasture', 'ranch', 'year'), conditions=[VALID], **kwargs)
 
-    c.execute(query)
-    rows = c.fetchall()
-    dates = [date(*map(int, row[-1].split('-'))) for row in rows]
-    keys = set('{}{}{}'.format(row[2], key_delimiter, row[3]) for row in rows)
+    years = sorted(year for year, in years)
 
     agg = []
-    start_year = int(start_year)
-    end_year = int(end_year)
-    for year in range(start_year, end_year+1):
-        _start_date = date(*map(int, '{}-{}'.format(year, start_date).split('-')))
-        _end_date = date(*map(int, '{}-{}'.format(year, end_date).split('-')))
-        mask = [_start_date < d < _end_date for d in dates]
-        if not any(mask):
-            continue
-
-        __rows = [dict(zip(_header, row)) for m, row in zip(mask, rows) if m]
-        for i in range(len(__rows)):
-            __rows[i]['key'] = '{}{}{}'.format(__rows[i]['pasture'], key_delimiter, __rows[i]['ranch'])
-            
-        _rows = []
-        for d in __rows:
-            if d['biomass_mean_gpm'] is None:
-                continue
-                
-            if d['biomass_mean_gpm'] == 0.0:
-                continue
-                
-            if d['coverage'] < 0.5:
-                continue
-                
-            _rows.append(d)
-       
-        d = {key: [] for key in keys}
-        for row in _rows:
-            d['{}{}{}'.format(row['pasture'], key_delimiter, row['ranch'])].append(row)
-
-        for key in d:
-            agg.append(_aggregate(d[key], agg_func))
+    for year in years:
+        for key in keys:
             _pasture, _ranch = key.split(key_delimiter)
+            agg.append(groups.get((_pasture, _ranch, year)) or _aggregate([], agg_func))
             agg[-1]['pasture'] = _pasture
             agg[-1]['ranch'] = _ranch
             agg[-1]['year'] = year
@@ -684,7 +666,6 @@ def query_multiyear_pasture_stats(db_fn, ranch=None, pasture=None, start_year=No
     return sorted(agg, key=_sortkeypicker(['ranch', 'pasture', 'year']))
 
 
-
 def query_multiyear_ranch_stats(db_fn, ranch=None, pasture=None, start_year=None, end_year=None,
                                   start_date=None, end_date=None, agg_func=np.mean,
                                   key_delimiter='+'):
@@ -699,59 +680,33 @@ def query_multiyear_ranch_stats(db_fn, ranch=None, pasture=None, start_year=None
     if end_date is None:
         end_date = '12-31'
 
-    conn = sqlite3.connect(db_fn)
+    conn = connect(db_fn)
     c = conn.cursor()
 
-    query = 'SELECT ' + \
-            ', '.join(_header) + \
-            ' FROM pasture_stats'
-
-    i = 0
-    if ranch is not None or pasture is not None:
-        query += ' WHERE'
-
-    if ranch is not None:
-        query += ' ranch = "{ranch}"'.format(ranch=ranch.replace('_', ' '))
-        i += 1
-
-    if pasture is not None:
-        if i > 0:
-            query += ' AND'
-        query += ' pasture = "{pasture}"'.format(pasture=pasture.replace('_', ' ').replace('Derrick Old', 'Derrick_Old'))
-        i += 1
-
-    c.execute(query)
-    rows = c.fetchall()
-    dates = [date(*map(int, row[-1].split('-'))) for row in rows]
-
-    keys = set('{}{}{}'.format(row[2], key_delimiter, row[3]) for row in rows)
-
-    keys = set(key.split(key_delimiter)[-1] for key in keys)
-
-    agg = []
     start_year = int(start_year)
     end_year = int(end_year)
-    for year in range(start_year, end_year+1):
-        _start_date = date(*map(int, '{}-{}'.format(year, start_date).split('-')))
-        _end_date = date(*map(int, '{}-{}'.format(year, end_date).split('-')))
-        mask = [_start_date < d < _end_date for d in dates]
-        if not any(mask):
-            continue
 
-        _rows = [dict(zip(_header, row)) for m, row in zip(mask, rows) if m]
+    # the ranches with stats in any year are reported for the years with
+    # stats in the season
+    keys = set(_ranch for _pasture, _ranch in _pasture_keys(c, ranch, pasture))
 
-        for i in range(len(_rows)):
-            _rows[i]['key'] = '{}{}{}'.format(_rows[i]['pasture'], key_delimiter, _rows[i]['ranch'])
-
-        _rows = [d for d in _rows if d['biomass_mean_gpm'] is not None]
+    if _use_summaries(c, agg_func, start_date, end_date):
+        kwargs = dict(ranch=ranch, pasture=pasture, years=(start_year, end_year))
+        years = _summary_distinct(c, ('year',), conditions=[_summary_inner], **kwargs)
+        groups = _summary_groups(c, agg_func, ('ranch', 'year'),
+                                 conditions=[_summary_has_biomass, _summary_inner], **kwargs)
+    else:
+        kwargs = dict(ranch=ranch, pasture=pasture, season=_season(start_year, end_year, start_date, end_date),
+                      after=_date(start_year - 1, '12-31'), before=_date(end_year + 1, '1-1'))
+        years = _distinct(c, ('year',), **kwargs)
+        groups = _aggregate_groups(c, agg_func, ('ranch', 'year'), conditions=[HAS_BIOMASS], **kwargs)
 
-        d = {_ranch: [] for _ranch in keys}
-        for row in _rows:
-            _pasture, _ranch = row['key'].split(key_delimiter)
-            d[_ranch].append(row)
+    years = sorted(year for year, in years)
 
-        for _ranch in d:
-            agg.append(_aggregate(d[_ranch], agg_func))
+    agg = []
+    for year in years:
+        for _ranch in keys:
+            agg.append(groups.get((_ranch, year)) or _aggregate([], agg_func))
             agg[-1]['ranch'] = _ranch
             agg[-1]['year'] = year
 
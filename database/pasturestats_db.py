@@ -0,0 +1,624 @@
+"""
+Writes the pasture stats of scenes into the location databases
+(<out_dir>/sqlite3.db and <out_dir>/scenemeta_coverage.db).
+
+build_sqlite_db.py rebuilds the pasture_stats tables from the pasture stats
+csvs and the ingest upserts the rows of a scene as it is processed. Both
+normalize the rows with normalize_row so the tables are the same either
+way.
+
+pasture_stats is a view over normalized tables (see _pasture_stats_schema),
+databases with a pasture_stats table are migrated when they are opened for
+writing or with database/scripts/migrate_pasture_stats_db.py
+
+The monthly summaries (pasture_month_summary, ranch_month_summary) are
+recomputed for the month of a scene when it is upserted and in full by
+build_sqlite_db.py and the migration (see refresh_summaries)
+"""
+
+import os
+import math
+import sqlite3
+from time import time
+from datetime import date
+
+from os.path import join as _join
+
+from biomass.checkpoint import atomic_output
+
+
+PASTURE_STATS_COLUMNS = (
+    'product_id', 'key', 'pasture', 'ranch', 'total_px', 'snow_px',
+    'water_px', 'aerosol_px',
+    'valid_px', 'coverage', 'model', 'biomass_mean_gpm', 'biomass_ci90_gpm',
+    'biomass_10pct_gpm', 'biomass_50pct_gpm', 'biomass_75pct_gpm', 'biomass_90pct_gpm', 'biomass_total_kg',
+    'biomass_sd_gpm', 'summer_vi_mean_gpm', 'fall_vi_mean_gpm', 'fraction_summer',
+    'satellite', 'acquisition_date', 'wrs', 'bounds', 'wgs_bounds', 'valid_pastures_cnt',
+    'ndvi_mean', 'ndvi_sd', 'ndvi_10pct', 'ndvi_50pct', 'ndvi_75pct', 'ndvi_90pct', 'ndvi_ci90',
+    'nbr_mean', 'nbr_sd', 'nbr_10pct', 'nbr_50pct', 'nbr_75pct', 'nbr_90pct', 'nbr_ci90',
+    'nbr2_mean', 'nbr2_sd', 'nbr2_10pct', 'nbr2_50pct', 'nbr2_75pct', 'nbr2_90pct', 'nbr2_ci90',
+    'config_hash')
+
+_text_columns = ('product_id', 'key', 'pasture', 'ranch', 'model', 'satellite',
+                 'acquisition_date', 'wrs', 'bounds', 'wgs_bounds', 'config_hash')
+_integer_columns = ('total_px', 'snow_px', 'water_px', 'aerosol_px', 'valid_px', 'valid_pastures_cnt')
+
+# columns of the pasture stats csvs (see biomass.ingest.dump_pasture_stats).
+# product_id is repeated from the scene summary
+CSV_COLUMNS = (
+    'product_id', 'key', 'total_px', 'snow_px', 'water_px',
+    'aerosol_px', 'valid_px', 'coverage', 'area_ha',
+    'model', 'biomass_mean_gpm', 'biomass_ci90_gpm',
+    'biomass_10pct_gpm', 'biomass_50pct_gpm', 'biomass_75pct_gpm', 'biomass_90pct_gpm',
+    'biomass_total_kg', 'biomass_sd_gpm', 'summer_vi_mean_gpm',
+    'fall_vi_mean_gpm', 'fraction_summer',
+    '_product_id', 'satellite', 'acquisition_date',
+    'wrs', 'bounds', 'wgs_bounds', 'valid_pastures_cnt',
+    'ndvi_mean', 'ndvi_sd', 'ndvi_10pct', 'ndvi_50pct', 'ndvi_75pct', 'ndvi_90pct', 'ndvi_ci90',
+    'nbr_mean', 'nbr_sd', 'nbr_10pct', 'nbr_50pct', 'nbr_75pct', 'nbr_90pct', 'nbr_ci90',
+    'nbr2_mean', 'nbr2_sd', 'nbr2_10pct', 'nbr2_50pct', 'nbr2_75pct', 'nbr2_90pct', 'nbr2_ci90')
+
+# csvs written before the 50th percentiles were added
+_legacy_csv_columns = tuple(c for c in CSV_COLUMNS if c not in
+                            ('biomass_50pct_gpm', 'ndvi_50pct', 'nbr_50pct', 'nbr2_50pct'))
+
+# model results that are nulled when the scene has no valid pixels
+_model_columns = ('biomass_mean_gpm', 'biomass_ci90_gpm', 'biomass_10pct_gpm', 'biomass_50pct_gpm',
+                  'biomass_75pct_gpm', 'biomass_90pct_gpm', 'biomass_total_kg', 'biomass_sd_gpm',
+                  'summer_vi_mean_gpm', 'fall_vi_mean_gpm', 'fraction_summer')
+
+# columns the pasture stats queries aggregate (see database.pasturestats)
+MEASURES = ('biomass_mean_gpm', 'biomass_ci90_gpm',
+            'biomass_10pct_gpm', 'biomass_75pct_gpm', 'biomass_90pct_gpm', 'biomass_total_kg',
+            'biomass_sd_gpm', 'summer_vi_mean_gpm', 'fall_vi_mean_gpm',
+            'ndvi_mean', 'ndvi_sd', 'ndvi_10pct', 'ndvi_75pct', 'ndvi_90pct', 'ndvi_ci90',
+            'nbr_mean', 'nbr_sd', 'nbr_10pct', 'nbr_75pct', 'nbr_90pct', 'nbr_ci90',
+            'nbr2_mean', 'nbr2_sd', 'nbr2_10pct', 'nbr2_75pct', 'nbr2_90pct', 'nbr2_ci90')
+
+# rows with a biomass estimate
+HAS_BIOMASS = 'biomass_mean_gpm IS NOT NULL'
+
+# rows the monthly and annual pasture aggregates are computed from
+VALID = 'biomass_mean_gpm IS NOT NULL AND biomass_mean_gpm != 0 AND coverage >= 0.5'
+
+# pasture_stats is a view of the pasture_stats_data table and the products,
+# pastures and models dimension tables. The product, pasture and model
+# strings are stored once and the rows carry integer year, month and
+# day-of-year columns. The queries range scan the (pasture_ref,
+# acquisition_date) and (acquisition_date) indexes
+_product_columns = ('product_id', 'satellite', 'wrs', 'bounds', 'wgs_bounds')
+_pasture_columns = ('key', 'pasture', 'ranch')
+_date_columns = ('year', 'month', 'doy')
+_data_columns = tuple(c for c in PASTURE_STATS_COLUMNS if c not in _product_columns + _pasture_columns + ('model',))
+
+_pasture_stats_schema = (
+    """
+    CREATE TABLE IF NOT EXISTS products
+        (id INTEGER PRIMARY KEY, product_id TEXT NOT NULL UNIQUE, satellite TEXT, wrs TEXT,
+         bounds TEXT, wgs_bounds TEXT)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS pastures
+        (id INTEGER PRIMARY KEY, key TEXT NOT NULL UNIQUE, pasture TEXT, ranch TEXT)
+    """,
+    'CREATE INDEX IF NOT EXISTS pastures_ranch_pasture ON pastures (ranch, pasture)',
+    """
+    CREATE TABLE IF NOT EXISTS models
+        (id INTEGER PRIMARY KEY, model TEXT NOT NULL UNIQUE)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS pasture_stats_data
+        (id INTEGER PRIMARY KEY,
+         product_ref INTEGER NOT NULL REFERENCES products (id),
+         pasture_ref INTEGER NOT NULL REFERENCES pastures (id),
+         model_ref INTEGER NOT NULL REFERENCES models (id),
+         acquisition_date TEXT, year INTEGER, month INTEGER, doy INTEGER,
+         total_px INTEGER, snow_px INTEGER, water_px INTEGER, aerosol_px INTEGER,
+         valid_px INTEGER, coverage REAL, biomass_mean_gpm REAL, biomass_ci90_gpm REAL,
+         biomass_10pct_gpm REAL, biomass_50pct_gpm REAL, biomass_75pct_gpm REAL, biomass_90pct_gpm REAL,
+         biomass_total_kg REAL, biomass_sd_gpm REAL, summer_vi_mean_gpm REAL, fall_vi_mean_gpm REAL,
+         fraction_summer REAL, valid_pastures_cnt INTEGER,
+         ndvi_mean REAL, ndvi_sd REAL, ndvi_10pct REAL, ndvi_50pct REAL, ndvi_75pct REAL, ndvi_90pct REAL, ndvi_ci90 REAL,
+         nbr_mean REAL, nbr_sd REAL, nbr_10pct REAL, nbr_50pct REAL, nbr_75pct REAL, nbr_90pct REAL, nbr_ci90 REAL,
+         nbr2_mean REAL, nbr2_sd REAL, nbr2_10pct REAL, nbr2_50pct REAL, nbr2_75pct REAL, nbr2_90pct REAL, nbr2_ci90 REAL,
+         config_hash TEXT)
+    """,
+    'CREATE UNIQUE INDEX IF NOT EXISTS pasture_stats_data_product_pasture_model '
+    'ON pasture_stats_data (product_ref, pasture_ref, model_ref)',
+    'CREATE INDEX IF NOT EXISTS pasture_stats_data_pasture_date ON pasture_stats_data (pasture_ref, acquisition_date)',
+    'CREATE INDEX IF NOT EXISTS pasture_stats_data_date ON pasture_stats_data (acquisition_date)',
+    """
+    CREATE VIEW IF NOT EXISTS pasture_stats AS
+    SELECT s.id AS id, {columns}
+    FROM pasture_stats_data s
+    JOIN products p ON p.id = s.product_ref
+    JOIN pastures pa ON pa.id = s.pasture_ref
+    JOIN models m ON m.id = s.model_ref
+    """.format(columns=', '.join(('p.' if c in _product_columns else 'pa.' if c in _pasture_columns else
+                                  'm.' if c == 'model' else 's.') + c
+                                 for c in PASTURE_STATS_COLUMNS + _date_columns)))
+
+# monthly summaries of the pasture stats (count, sum and sum of squares of
+# the MEASURES) per (pasture, year, month) and (ranch, year, month). The
+# rows are split by status (0: no biomass estimate, 1: HAS_BIOMASS, 2:
+# VALID) and by year_end (acquired on Jan 1 or Dec 31, the default query
+# windows exclude these dates). They are recomputed for the months of a
+# scene when it is written
+_summary_keys = ('year', 'month', 'status', 'year_end')
+_summary_columns = ('n_rows',) + tuple('{}_{}'.format(m, agg) for m in MEASURES for agg in ('n', 'sum', 'sumsq'))
+
+_summary_status = 'CASE WHEN NOT ({}) THEN 0 WHEN {} THEN 2 ELSE 1 END'.format(HAS_BIOMASS, VALID)
+_summary_year_end = "CASE WHEN substr(acquisition_date, 6) IN ('01-01', '12-31') THEN 1 ELSE 0 END"
+
+_summary_schema = (
+    """
+    CREATE TABLE IF NOT EXISTS pasture_month_summary
+        (pasture_ref INTEGER NOT NULL REFERENCES pastures (id),
+         year INTEGER NOT NULL, month INTEGER NOT NULL, status INTEGER NOT NULL, year_end INTEGER NOT NULL,
+         n_rows INTEGER, {measures},
+         PRIMARY KEY (pasture_ref, year, month, status, year_end))
+    """.format(measures=', '.join('{} {}'.format(c, 'INTEGER' if c.endswith('_n') else 'REAL')
+                                  for c in _summary_columns[1:])),
+    'CREATE INDEX IF NOT EXISTS pasture_month_summary_year ON pasture_month_summary (year, month)',
+    """
+    CREATE TABLE IF NOT EXISTS ranch_month_summary
+        (ranch TEXT NOT NULL,
+         year INTEGER NOT NULL, month INTEGER NOT NULL, status INTEGER NOT NULL, year_end INTEGER NOT NULL,
+         n_rows INTEGER, {measures},
+         PRIMARY KEY (ranch, year, month, status, year_end))
+    """.format(measures=', '.join('{} {}'.format(c, 'INTEGER' if c.endswith('_n') else 'REAL')
+                                  for c in _summary_columns[1:])))
+
+_scenemeta_coverage_schema = """
+CREATE TABLE IF NOT EXISTS {db}scenemeta_coverage (product_id TEXT, coverage REAL)
+"""
+
+
+def _is_missing(v):
+    return v.replace('-', '') == ''
+
+
+def _value(column, v):
+    """
+    converts a csv value to the type of its column. Missing values and
+    inf/nan are None
+    """
+    if v is None:
+        return None
+
+    v = str(v)
+    if column in _text_columns:
+        return v
+
+    if _is_missing(v):
+        return None
+
+    x = float(v)
+    if math.isinf(x) or math.isnan(x):
+        return None
+
+    if column in _integer_columns and x.is_integer():
+        return int(x)
+
+    return x
+
+
+def _isfloat(v):
+    try:
+        float(v)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
+def pasture_key(key, key_delimiter='+', reverse_key=False):
+    """
+    the (key, pasture, ranch) a shapefile key is stored under in pasture_stats
+    """
+    key = key.replace('Tripple', 'Triple').replace('-RCR', '+RCR')
+    pasture, ranch = key.split(key_delimiter)
+    if reverse_key:
+        ranch, pasture = pasture, ranch
+        key = '{}{}{}'.format(pasture, key_delimiter, ranch)
+    return key, pasture, ranch
+
+
+def normalize_row(row, key_delimiter='+', reverse_key=False, config_hash=None):
+    """
+    normalizes a row of a pasture stats csv (a list of strings in
+    CSV_COLUMNS order or the legacy order without the 50th percentiles)
+    into a dict of the pasture_stats columns.
+
+    :param config_hash: pasture_stats stage hash of the scene (see
+                        biomass.ingest.stage_hashes) the row is stamped with
+    :return: the dict or None for rows without a biomass estimate
+    """
+    if len(row) == len(CSV_COLUMNS):
+        d = dict(zip(CSV_COLUMNS, row))
+    else:
+        assert len(row) == len(_legacy_csv_columns), len(row)
+        d = dict(zip(_legacy_csv_columns, row))
+
+    biomass_mean_gpm = d['biomass_mean_gpm']
+    if not _isfloat(biomass_mean_gpm) or float(biomass_mean_gpm) <= 0.0:
+        return None
+
+    rec = {column: _value(column, d.get(column)) for column in PASTURE_STATS_COLUMNS
+           if column not in ('pasture', 'ranch', 'acquisition_date')}
+
+    if rec['coverage'] is None:
+        rec['coverage'] = 0.0
+
+    if rec['valid_px'] is None:
+        rec['valid_px'] = 0
+
+    # the scene had no valid pixels
+    if rec['nbr_mean'] == -1.0:
+        rec['coverage'] = 0.0
+        rec['valid_px'] = 0
+        for column in _model_columns:
+            rec[column] = None
+
+    key, pasture, ranch = pasture_key(d['key'], key_delimiter, reverse_key)
+
+    product_id = d['product_id']
+    _date = product_id.split('_')[3]
+
+    rec['key'] = key
+    rec['pasture'] = pasture
+    rec['ranch'] = ranch
+    rec['acquisition_date'] = str(date(int(_date[:4]), int(_date[4:6]), int(_date[6:])))
+    rec['config_hash'] = config_hash
+    return rec
+
+
+def has_legacy_table(conn):
+    row = conn.execute("SELECT type FROM sqlite_master WHERE name = 'pasture_stats'").fetchone()
+    return row is not None and row[0] == 'table'
+
+
+def migrate_pasture_stats(conn):
+    """
+    moves the rows of a pasture_stats table (databases built before the
+    normalized schema) into the normalized tables. Duplicate (product_id,
+    key, model) rows are dropped (the last row wins)
+
+    :return: number of rows migrated
+    """
+    conn.execute('ALTER TABLE pasture_stats RENAME TO pasture_stats_legacy')
+    legacy_columns = [row[1] for row in conn.execute('PRAGMA table_info(pasture_stats_legacy)')]
+
+    for statement in _pasture_stats_schema:
+        conn.execute(statement)
+
+    conn.execute('INSERT OR IGNORE INTO products ({0}) SELECT {0} FROM pasture_stats_legacy ORDER BY rowid DESC'
+                 .format(', '.join(_product_columns)))
+    conn.execute('INSERT OR IGNORE INTO pastures ({0}) SELECT {0} FROM pasture_stats_legacy ORDER BY rowid DESC'
+                 .format(', '.join(_pasture_columns)))
+    conn.execute('INSERT OR IGNORE INTO models (model) SELECT model FROM pasture_stats_legacy ORDER BY rowid')
+
+    columns = [c for c in _data_columns if c in legacy_columns]
+    conn.execute("""
+        INSERT OR REPLACE INTO pasture_stats_data (product_ref, pasture_ref, model_ref, {columns}, {dates})
+        SELECT p.id, pa.id, m.id, {legacy_columns},
+               CAST(substr(l.acquisition_date, 1, 4) AS INTEGER), CAST(substr(l.acquisition_date, 6, 2) AS INTEGER),
+               CAST(strftime('%j', l.acquisition_date) AS INTEGER)
+        FROM pasture_stats_legacy l
+        JOIN products p ON p.product_id = l.product_id
+        JOIN pastures pa ON pa.key = l.key
+        JOIN models m ON m.model = l.model
+        ORDER BY l.rowid
+        """.format(columns=', '.join(columns), dates=', '.join(_date_columns),
+                   legacy_columns=', '.join('l.' + c for c in columns)))
+
+    n = conn.execute('SELECT COUNT(*) FROM pasture_stats_data').fetchone()[0]
+    conn.execute('DROP TABLE pasture_stats_legacy')
+
+    refresh_summaries(conn)
+    return n
+
+
+def ensure_pasture_stats_table(conn):
+    """
+    creates the pasture_stats tables, indexes and view. A pasture_stats
+    table of a database built before the normalized schema is migrated
+    """
+    if has_legacy_table(conn):
+        print('migrating pasture_stats to the normalized schema')
+        migrate_pasture_stats(conn)
+        return
+
+    for statement in _pasture_stats_schema:
+        conn.execute(statement)
+
+    # databases normalized before the summaries were added
+    if conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'pasture_month_summary'").fetchone()[0] == 0:
+        refresh_summaries(conn)
+
+
+def _month_range(year, month):
+    # first date of a month and of the next month
+    if month == 12:
+        return '%04i-12-01' % year, '%04i-01-01' % (year + 1)
+    return '%04i-%02i-01' % (year, month), '%04i-%02i-01' % (year, month + 1)
+
+
+def product_month(product_id):
+    """
+    (year, month) of the acquisition date of a product
+    """
+    _date = product_id.split('_')[3]
+    return int(_date[:4]), int(_date[4:6])
+
+
+def refresh_summaries(conn, months=None):
+    """
+    recomputes the monthly summaries (pasture_month_summary and
+    ranch_month_summary) from pasture_stats_data
+
+    :param months: (year, month) tuples to recompute, every month if None
+    """
+    for statement in _summary_schema:
+        conn.execute(statement)
+
+    pasture_columns = ['COUNT(*)']
+    for m in MEASURES:
+        pasture_columns += ['COUNT({})'.format(m), 'TOTAL({})'.format(m), 'TOTAL({0} * {0})'.format(m)]
+    pasture_query = """
+        INSERT INTO pasture_month_summary (pasture_ref, {keys}, {columns})
+        SELECT pasture_ref, year, month, {status}, {year_end}, {values}
+        FROM pasture_stats_data{{where}}
+        GROUP BY pasture_ref, year, month, {status}, {year_end}
+        """.format(keys=', '.join(_summary_keys), columns=', '.join(_summary_columns),
+                   status=_summary_status, year_end=_summary_year_end, values=', '.join(pasture_columns))
+
+    ranch_query = """
+        INSERT INTO ranch_month_summary (ranch, {keys}, {columns})
+        SELECT pa.ranch, {s_keys}, {values}
+        FROM pasture_month_summary s JOIN pastures pa ON pa.id = s.pasture_ref{{where}}
+        GROUP BY pa.ranch, {s_keys}
+        """.format(keys=', '.join(_summary_keys), columns=', '.join(_summary_columns),
+                   s_keys=', '.join('s.' + k for k in _summary_keys),
+                   values=', '.join('SUM(s.{})'.format(c) for c in _summary_columns))
+
+    if months is None:
+        conn.execute('DELETE FROM pasture_month_summary')
+        conn.execute('DELETE FROM ranch_month_summary')
+        conn.execute(pasture_query.format(where=''))
+        conn.execute(ranch_query.format(where=''))
+        return
+
+    for year, month in sorted(set(months)):
+        conn.execute('DELETE FROM pasture_month_summary WHERE year = ? AND month = ?', (year, month))
+        conn.execute('DELETE FROM ranch_month_summary WHERE year = ? AND month = ?', (year, month))
+        conn.execute(pasture_query.format(where=' WHERE acquisition_date >= ? AND acquisition_date < ?'),
+                     _month_range(year, month))
+        conn.execute(ranch_query.format(where=' WHERE s.year = ? AND s.month = ?'), (year, month))
+
+
+def ensure_scenemeta_coverage_table(conn, db=''):
+    """
+    :param db: schema name prefix of an attached database, e.g. 'cov.'
+    """
+    conn.execute(_scenemeta_coverage_schema.format(db=db))
+    try:
+        conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS {db}scenemeta_coverage_product_id '
+                     'ON scenemeta_coverage (product_id)'.format(db=db))
+    except sqlite3.IntegrityError:
+        conn.execute('DELETE FROM {db}scenemeta_coverage WHERE rowid NOT IN '
+                     '(SELECT MAX(rowid) FROM {db}scenemeta_coverage GROUP BY product_id)'.format(db=db))
+        conn.execute('CREATE UNIQUE INDEX {db}scenemeta_coverage_product_id '
+                     'ON scenemeta_coverage (product_id)'.format(db=db))
+
+
+def _dimension_ids(conn, table, columns, recs):
+    """
+    upserts the dimension rows of recs and returns a dict of the value of
+    the first column -> id
+    """
+    unique = columns[0]
+    query = 'INSERT INTO {table} ({columns}) VALUES ({values}) ON CONFLICT ({unique}) DO '\
+            .format(table=table, columns=', '.join(columns), values=', '.join('?' for _ in columns), unique=unique)
+    if len(columns) > 1:
+        query += 'UPDATE SET ' + ', '.join('{0} = excluded.{0}'.format(c) for c in columns[1:])
+    else:
+        query += 'NOTHING'
+
+    values = {rec[unique]: [rec[c] for c in columns] for rec in recs}
+    conn.executemany(query, values.values())
+
+    ids = {}
+    for value in values:
+        ids[value] = conn.execute('SELECT id FROM {} WHERE {} = ?'.format(table, unique), (value,)).fetchone()[0]
+    return ids
+
+
+def _date_values(acquisition_date):
+    # year, month and day of year of an acquisition date (YYYY-MM-DD)
+    d = date(*map(int, acquisition_date.split('-')))
+    return d.year, d.month, d.timetuple().tm_yday
+
+
+def insert_rows(conn, recs, upsert=False):
+    """
+    inserts normalized rows into pasture_stats. With upsert rows with the
+    same (product_id, key, model) are replaced
+    """
+    product_ids = _dimension_ids(conn, 'products', _product_columns, recs)
+    pasture_ids = _dimension_ids(conn, 'pastures', _pasture_columns, recs)
+    model_ids = _dimension_ids(conn, 'models', ('model',), recs)
+
+    columns = ('product_ref', 'pasture_ref', 'model_ref') + _data_columns + _date_columns
+    query = 'INSERT INTO pasture_stats_data ({}) VALUES ({})'\
+            .format(', '.join(columns), ', '.join('?' for _ in columns))
+
+    if upsert:
+        query += ' ON CONFLICT (product_ref, pasture_ref, model_ref) DO UPDATE SET ' + \
+                 ', '.join('{0} = excluded.{0}'.format(c) for c in _data_columns + _date_columns)
+
+    conn.executemany(query, [[product_ids[rec['product_id']], pasture_ids[rec['key']], model_ids[rec['model']]] +
+                             [rec[c] for c in _data_columns] + list(_date_values(rec['acquisition_date']))
+                             for rec in recs])
+
+
+# touched after the outputs of a scene are written. The API clears its
+# response cache when the stamp of a location changes
+_cache_stamp_fn = '.api_cache_stamp'
+
+
+def cache_stamp_fn(out_dir):
+    return _join(out_dir, _cache_stamp_fn)
+
+
+def touch_cache_stamp(out_dir):
+    """
+    records that the outputs of out_dir changed
+    """
+    with atomic_output(cache_stamp_fn(out_dir)) as tmp_fn:
+        with open(tmp_fn, 'w') as fp:
+            fp.write(str(time()))
+
+
+def read_cache_stamp(out_dir):
+    """
+    modification time of the cache stamp of out_dir (0.0 if there is none)
+    """
+    try:
+        return os.stat(cache_stamp_fn(out_dir)).st_mtime
+    except OSError:
+        return 0.0
+
+
+def _update_coverage(conn, product_id):
+    # fraction of the pastures covered (see build_scenemeta_coverage_db.py)
+    if conn.execute('SELECT COUNT(*) FROM pasture_stats WHERE product_id = ?', (product_id,)).fetchone()[0] > 0:
+        conn.execute('INSERT INTO cov.scenemeta_coverage (product_id, coverage) '
+                     'SELECT product_id, SUM(COALESCE(coverage, 0.0)) / COUNT(*) '
+                     'FROM pasture_stats WHERE product_id = ? GROUP BY product_id '
+                     'ON CONFLICT (product_id) DO UPDATE SET coverage = excluded.coverage',
+                     (product_id,))
+    else:
+        conn.execute('DELETE FROM cov.scenemeta_coverage WHERE product_id = ?', (product_id,))
+
+
+def upsert_scene(out_dir, product_id, rows, key_delimiter='+', reverse_key=False, timeout=60.0, config_hash=None):
+    """
+    upserts the pasture stats of a scene into <out_dir>/sqlite3.db and
+    updates its coverage in <out_dir>/scenemeta_coverage.db in a single
+    transaction. Rows of the scene that are no longer produced are removed.
+
+    :param rows: pasture stats csv rows (lists in CSV_COLUMNS order)
+    :param config_hash: config the rows were computed with (see normalize_row)
+    :return: number of rows written
+    """
+    recs = [normalize_row(row, key_delimiter, reverse_key, config_hash) for row in rows]
+    recs = [rec for rec in recs if rec is not None]
+    assert all(rec['product_id'] == product_id for rec in recs)
+
+    # autocommit mode, the transaction is managed explicitly
+    conn = sqlite3.connect(_join(out_dir, 'sqlite3.db'), timeout=timeout, isolation_level=None)
+    try:
+        conn.execute('ATTACH DATABASE ? AS cov', (_join(out_dir, 'scenemeta_coverage.db'),))
+        conn.execute('BEGIN IMMEDIATE')
+
+        ensure_pasture_stats_table(conn)
+        ensure_scenemeta_coverage_table(conn, db='cov.')
+
+        insert_rows(conn, recs, upsert=True)
+
+        keep = set((rec['key'], rec['model']) for rec in recs)
+        stale = [(_id,) for _id, key, model in
+                 conn.execute('SELECT id, key, model FROM pasture_stats WHERE product_id = ?', (product_id,))
+                 if (key, model) not in keep]
+        conn.executemany('DELETE FROM pasture_stats_data WHERE id = ?', stale)
+
+        refresh_summaries(conn, [product_month(product_id)])
+        _update_coverage(conn, product_id)
+        conn.execute('COMMIT')
+    except:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+    return len(recs)
+
+
+def update_scene_pastures(out_dir, product_id, rows, keys, key_delimiter='+', reverse_key=False, timeout=60.0,
+                          config_hash=None):
+    """
+    replaces the pasture stats of some of the pastures of a scene (e.g.
+    the pastures whose geometry changed) and updates the scene coverage.
+    The rows of the other pastures are left as they are
+
+    :param rows: pasture stats csv rows of the recomputed pastures
+    :param keys: shapefile keys of the recomputed and removed pastures.
+                 Their rows that are not in rows are deleted
+    :param config_hash: config the rows were computed with (see normalize_row).
+                        If specified every row of the scene is stamped with it
+    :return: number of rows written
+    """
+    recs = [normalize_row(row, key_delimiter, reverse_key, config_hash) for row in rows]
+    recs = [rec for rec in recs if rec is not None]
+    assert all(rec['product_id'] == product_id for rec in recs)
+
+    keys = set(pasture_key(key, key_delimiter, reverse_key)[0] for key in keys)
+
+    conn = sqlite3.connect(_join(out_dir, 'sqlite3.db'), timeout=timeout, isolation_level=None)
+    try:
+        conn.execute('ATTACH DATABASE ? AS cov', (_join(out_dir, 'scenemeta_coverage.db'),))
+        conn.execute('BEGIN IMMEDIATE')
+
+        ensure_pasture_stats_table(conn)
+        ensure_scenemeta_coverage_table(conn, db='cov.')
+
+        insert_rows(conn, recs, upsert=True)
+
+        keep = set((rec['key'], rec['model']) for rec in recs)
+        stale = [(_id,) for _id, key, model in
+                 conn.execute('SELECT id, key, model FROM pasture_stats WHERE product_id = ?', (product_id,))
+                 if key in keys and (key, model) not in keep]
+        conn.executemany('DELETE FROM pasture_stats_data WHERE id = ?', stale)
+
+        if config_hash is not None:
+            conn.execute('UPDATE pasture_stats_data SET config_hash = ? '
+                         'WHERE product_ref = (SELECT id FROM products WHERE product_id = ?)', (config_hash, product_id))
+
+        refresh_summaries(conn, [product_month(product_id)])
+        _update_coverage(conn, product_id)
+        conn.execute('COMMIT')
+    except:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+    return len(recs)
+
+
+def has_scene_rows(out_dir, product_id, config_hash=None, timeout=60.0):
+    """
+    True if <out_dir>/sqlite3.db has pasture stats rows of a scene
+
+    :param config_hash: if specified only rows computed with this config count
+    """
+    db_fn = _join(out_dir, 'sqlite3.db')
+    if not os.path.exists(db_fn):
+        return False
+
+    query = 'SELECT 1 FROM pasture_stats WHERE product_id = ?'
+    params = [product_id]
+    if config_hash is not None:
+        query += ' AND config_hash = ?'
+        params.append(config_hash)
+
+    conn = sqlite3.connect(db_fn, timeout=timeout)
+    try:
+        return conn.execute(query + ' LIMIT 1', params).fetchone() is not None
+    except sqlite3.OperationalError:
+        # no pasture_stats yet or a legacy table without config_hash
+        return False
+    finally:
+        conn.close()
@@ -1,6 +1,7 @@
 from os.path import join as _join
 from os.path import split as _split
 from database.pasturestats import query_scenes_coverage
+from database.connections import connect
 
 from os.path import isdir, exists
 
@@ -14,8 +15,6 @@ from all_your_base import SCRATCH, RANGESAT_DIRS
 
 from .location import Location
 
-import sqlite3
-
 
 def _scene_wrs_filter(fns, rowpath):
     return [fn for fn in fns if fn.split('_')[2] in rowpath]
@@ -40,7 +39,7 @@ def _scene_coverage_filter(location, fns, pasture_coverage_threshold=0.5, ls8_on
 def _query_all(_location):
     scn_cov_db_fn = _location.scn_cov_db_fn
 
-    conn = sqlite3.connect(scn_cov_db_fn)
+    conn = connect(scn_cov_db_fn)
     c = conn.cursor()
 
     query = 'SELECT * FROM scenemeta_coverage'
@@ -0,0 +1,58 @@
+"""
+Migrates the pasture_stats table of the location databases to the
+normalized schema (see database.pasturestats_db). The database is copied
+to sqlite3.db.bak first.
+
+usage:
+    > python3 migrate_pasture_stats_db.py Zumwalt4 Zumwalt5
+"""
+
+import sqlite3
+import shutil
+import sys
+from time import time
+from os.path import join as _join
+from os.path import exists
+
+sys.path.insert(0, '/var/www/rangesat-biomass')
+from api.app import RANGESAT_DIRS, Location
+from database.pasturestats_db import migrate_pasture_stats, has_legacy_table
+
+locations = sys.argv[1:]
+
+for location in locations:
+    _location = None
+    for rangesat_dir in RANGESAT_DIRS:
+        loc_path = _join(rangesat_dir, location)
+        if exists(loc_path):
+            _location = Location(loc_path)
+            break
+
+    assert _location is not None, location
+
+    db_fn = _join(_location.out_dir, 'sqlite3.db')
+    assert exists(db_fn), db_fn
+
+    t0 = time()
+    conn = sqlite3.connect(db_fn, isolation_level=None)
+    try:
+        if not has_legacy_table(conn):
+            print(location, 'is already migrated')
+            continue
+
+        shutil.copyfile(db_fn, db_fn + '.bak')
+
+        conn.execute('BEGIN IMMEDIATE')
+        n = migrate_pasture_stats(conn)
+        conn.execute('COMMIT')
+
+        # reclaims the space of the repeated strings
+        conn.execute('VACUUM')
+    except:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+    print('%s: migrated %i rows in %f seconds' % (location, n, time() - t0))